@@ -38,6 +38,10 @@ socketio = SocketIO(app,
 task_storage = {}
 RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
 os.makedirs(RESULTS_DIR, exist_ok=True)
+# Cache files shared by all the tasks, a task reuses the llm responses and pages fetched by the
+# others
+CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cache'))
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 
 def reload_task_storage():
@@ -158,7 +162,9 @@ def run_story_generation(task_id, prompt, model, provider):
         cd {os.path.abspath(os.path.join(os.path.dirname(__file__), '../recursive'))}
         source {env_file}
         export TASK_ENV_FILE={env_file}
-        python engine.py --filename {input_file} --output-filename {output_file} --done-flag-file {done_file} --model {model} --mode story --nodes-json-file {nodes_file}
+        python engine.py --filename {input_file} --output-filename {output_file} \\
+            --done-flag-file {done_file} --model {model} --mode story \\
+            --nodes-json-file {nodes_file} --cache-dir {CACHE_DIR} --shared-cache
         """)
 
     # Update task status to "running"
@@ -232,7 +238,9 @@ def run_report_generation(task_id, prompt, model, enable_search, searcher, provi
         cd {os.path.abspath(os.path.join(os.path.dirname(__file__), '../recursive'))}
         source {env_file}
         export TASK_ENV_FILE={env_file}
-        python engine.py --filename {input_file} --output-filename {output_file} --done-flag-file {done_file} --model {model} --searcher {searcher.get("name")} --mode report --nodes-json-file {nodes_file}
+        python engine.py --filename {input_file} --output-filename {output_file} \\
+            --done-flag-file {done_file} --model {model} --searcher {searcher.get("name")} \\
+            --mode report --nodes-json-file {nodes_file} --cache-dir {CACHE_DIR} --shared-cache
         """)
 
     os.chmod(script_path, 0o755)
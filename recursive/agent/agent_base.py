@@ -19,6 +19,11 @@ from loguru import logger
 agent_register = Register('agent_register')
     
 class Agent(ABC):
+    # True for agents without side effect on the node and the memory, they only move
+    # the node to the next status, and the engine may apply them inline
+    # (see GraphRunEngine.run_node_step)
+    passthrough = False
+
     def __init__(self, *args, **kwargs):
         self.kwargs = kwargs
         self.args = args
@@ -184,6 +189,8 @@ class DummyRandomExecutorAgent(Agent):
 
 @agent_register.register_module() 
 class DummyRandomUpdateAgent(Agent):
+    passthrough = True
+
     @overrides
     def forward(self, node, memory, *args, **kwargs) -> str:
         return None
@@ -194,6 +201,8 @@ class DummyRandomUpdateAgent(Agent):
     
 @agent_register.register_module()
 class DummyRandomPriorReflectionAgent(Agent):
+    passthrough = True
+
     @overrides
     def forward(self, node, memory, *args, **kwargs) -> str:
         return None
@@ -204,6 +213,8 @@ class DummyRandomPriorReflectionAgent(Agent):
    
 @agent_register.register_module()     
 class DummyRandomPlanningPostReflectionAgent(Agent):
+    passthrough = True
+
     @overrides
     def forward(self, node, memory, *args, **kwargs) -> str:
         return None
@@ -214,6 +225,8 @@ class DummyRandomPlanningPostReflectionAgent(Agent):
     
 @agent_register.register_module()     
 class DummyRandomExecutorPostReflectionAgent(Agent):
+    passthrough = True
+
     @overrides
     def forward(self, node, memory, *args, **kwargs) -> str:
         result = {
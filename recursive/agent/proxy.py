@@ -7,18 +7,33 @@ from recursive.agent.agent_base import agent_register
 class AgentProxy:
     """
     config.action_mapping: key is action, value is a List, 1st value is agent class, 2nd value is agent prompt version
+
+    Agents hold no state after construction, so the agent of an action is built once
+    and reused, unless extra construction args are given. The nodes of a tree share the
+    AgentProxy held by their root node, see Node.agent_proxy.
     """
+
     def __init__(self, config: Dict):
         self.config = config
         self.action_mapping = config["action_mapping"]
+        self.agents = {}
 
     def proxy(self, action, *args, **kwargs):
+        cacheable = len(args) == 0 and len(kwargs) == 0
+        if cacheable and action in self.agents:
+            return self.agents[action]
         agent_cls, input_kwargs = self.action_mapping[action]
         kwargs.update(input_kwargs)
         agent = agent_register.module_dict[agent_cls](
             *args, **kwargs
         )
+        if cacheable:
+            self.agents[action] = agent
         return agent
+
+    def is_passthrough(self, action):
+        agent_cls, _ = self.action_mapping[action]
+        return agent_register.module_dict[agent_cls].passthrough
         
 if __name__ == "__main__":
     config = {
@@ -4,10 +4,18 @@ import json
 import fcntl
 from loguru import logger
 import threading
+import queue
+import atexit
 import os
 import datetime
-import copy
-from copy import deepcopy
+import time
+import sqlite3
+import zlib
+from collections import OrderedDict
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 def string_to_md5(string):
     md5 = hashlib.md5()
@@ -35,10 +43,17 @@ def json_default_dumps(data):
     return str(data)
 
 
+# Same canonical form as
+# json.dumps(obj, sort_keys=True, ensure_ascii=False, default=json_default_dumps)
+canonical_encoder = json.JSONEncoder(sort_keys=True, ensure_ascii=False, default=json_default_dumps)
+
+
 def obj_to_hash(obj):
-    s = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=json_default_dumps)
-    ret = string_to_md5(s)
-    return ret
+    """
+    md5 of the canonical JSON of obj. encode runs the C encoder, iterencode would not. md5 is
+    kept so that the recorded caches keep their keys.
+    """
+    return hashlib.md5(canonical_encoder.encode(obj).encode("utf-8")).hexdigest()
 
 def get_data_list_from_jsonl(fn):
     with open(fn) as f:
@@ -75,7 +90,7 @@ class FileLock:
         self.file.close()
   
 def get_omit_json(data, max_str_len=100, max_list_len=10, to_str=True):
-    data = copy.deepcopy(data)
+    # dfs builds new containers, data is never modified and needs no copy
     max_str_len = 10000
     def dfs(cur_data):
         if isinstance(cur_data, (list, tuple)):
@@ -103,32 +118,252 @@ def get_omit_json(data, max_str_len=100, max_list_len=10, to_str=True):
     ret = json.dumps(data, indent=2, ensure_ascii=False) if to_str else data
     return ret      
         
+
+class CacheMissError(Exception):
+    """
+    Raised by a strict cache when the call is not recorded
+    """
+    def __init__(self, fn, name, key):
+        super().__init__(f'Cache miss in strict mode {fn=}: {name=}: {key=}')
+        self.fn = fn
+        self.name = name
+        self.key = key
+
+
+class BlobStore:
+    """
+    Content-addressed store of compressed texts, {folder}/{digest[:2]}/{digest}.{codec}, digest
+    is the sha256 of the text, so a page reached through several urls is stored once.
+    zstd when the zstandard package is installed, zlib otherwise; both are readable.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.codec = "zst" if zstandard is not None else "z"
+
+    def path(self, digest, codec):
+        return f'{self.folder}/{digest[:2]}/{digest}.{codec}'
+
+    def put(self, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        fn = self.path(digest, self.codec)
+        if os.path.exists(fn):
+            return digest
+        if self.codec == "zst":
+            data = zstandard.ZstdCompressor(level=3).compress(data)
+        else:
+            data = zlib.compress(data, 6)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp_fn = f'{fn}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_fn, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_fn, fn)
+        return digest
+
+    def size(self, digest):
+        for codec in ("zst", "z"):
+            fn = self.path(digest, codec)
+            if os.path.exists(fn):
+                return os.path.getsize(fn)
+        return 0
+
+    def remove(self, digest):
+        for codec in ("zst", "z"):
+            fn = self.path(digest, codec)
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def get(self, digest):
+        for codec in ("zst", "z"):
+            fn = self.path(digest, codec)
+            if not os.path.exists(fn):
+                continue
+            with open(fn, 'rb') as f:
+                data = f.read()
+            if codec == "zst":
+                if zstandard is None:
+                    raise Exception(f'The zstandard package is needed to read {fn}')
+                data = zstandard.ZstdDecompressor().decompress(data)
+            else:
+                data = zlib.decompress(data)
+            return data.decode('utf-8')
+        return None
+
+    def gc(self, live_digests, min_age=3600):
+        """
+        Remove the blobs not in live_digests. Recent blobs are kept, their cache line may not
+        be written yet.
+        """
+        if not os.path.isdir(self.folder):
+            return 0
+        now = time.time()
+        removed = 0
+        for sub in os.listdir(self.folder):
+            for name in os.listdir(f'{self.folder}/{sub}'):
+                fn = f'{self.folder}/{sub}/{name}'
+                if name.split('.')[0] in live_digests or now - os.path.getmtime(fn) < min_age:
+                    continue
+                os.remove(fn)
+                removed += 1
+        return removed
+
+
+def blob_digest(value):
+    return value.get('blob') if isinstance(value, dict) else None
+
+
+def blob_bytes(value):
+    # The compressed size of the blob of a value, counted for max_bytes
+    return value.get('blob_bytes', 0) if isinstance(value, dict) else 0
+
+
+# Default limits per cache namespace, ttl in seconds, None means unbounded.
+# Search results and web pages go stale, llm results never expire.
+CACHE_LIMITS = {
+    "search": {"max_entries": 200000, "max_bytes": 1 << 30, "ttl": 7 * 24 * 3600},
+    "web_page": {"max_entries": 100000, "max_bytes": 2 << 30, "ttl": 30 * 24 * 3600},
+    "llm": {"max_entries": None, "max_bytes": None, "ttl": None},
+}
+
+
+def parse_datatime(s):
+    try:
+        return datetime.datetime.strptime(s, "%Y-%m-%d_%H:%M:%S").timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
 class Cache:
+    """
+    strict: for offline replay, every get_cache must hit, a miss raises CacheMissError
+    (and is counted in misses, as some callers swallow exceptions and retry)
+
+    max_entries, max_bytes (the bytes of the lines, plus the compressed size of their blobs)
+    and ttl (seconds since the entry was added) bound the cache, the least recently used
+    entries are evicted first. The JSONL file is compacted to the same bounds once the
+    overwritten and evicted lines outnumber the live ones.
+
+    shared: several processes use the same file (e.g. the engine tasks of the backend),
+    a key missing in memory is looked up again after reading the lines the other
+    processes appended since the last read, so their results are visible immediately.
+
+    blobs: large texts are kept compressed in a BlobStore ({fn}.blobs) by put_blob, the
+    cached value only holds the digest and the size; get_blob reads them back. The blob of an
+    evicted or expired entry is removed once no live entry refers to it; a blob removed while
+    another process still refers to it reads as None, a miss.
+
+    write_behind: add only updates the memory and queues the line, a writer thread appends
+    the queued lines in batches (every flush_interval seconds or flush_size lines) with one
+    fsync, so the calling threads never wait for the disk. flush() waits for the queue to
+    be written, it runs at exit as well.
+
+    get_stats() returns the hits, misses, bytes served, lookup time and time saved per
+    cache_name since the last reset_stats(). The latency of a call, from its miss to its
+    save_cache, is stored with the entry, a later hit counts it as time saved.
+    """
     name_mode_to_cache = {}
-    cache_lock = threading.Lock()
-    def __init__(self, fn, mode='rw'):
+    registry_lock = threading.Lock()
+    compact_min_lines = 1000
+    flush_interval = 1.0
+    flush_size = 256
+    FLUSH = object()
+
+    def __init__(self, fn, mode='rw', strict=False, max_entries=None, max_bytes=None, ttl=None,
+                 shared=False, blobs=False, write_behind=False):
         self.fn = fn
         self.info_fn = f'{fn}_info.jsonl'
+        # Per cache, the llm, search and web page caches do not wait for each other
+        self.cache_lock = threading.Lock()
         self.mode = mode
-        if 'r' in mode:
-            try:
-                self.cache_kv = self.read_cache()
-            except Exception as e:
-                print(f'Fail to fetch in cache {fn=}, {e=}')
-                self.cache_kv = {}
-        else:
-            self.cache_kv = {}
-
+        self.strict = strict
+        self.misses = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self.blob_store = BlobStore(f'{fn}.blobs') if blobs else None
+        self.write_queue = None
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        # key -> start time of the calls that missed, until their save_cache
+        self.call_starts = {}
         if 'w' in mode:
             os.makedirs(os.path.dirname(fn), exist_ok=True)
+        self.open()
+        if write_behind and 'w' in mode:
+            self.start_writer()
+
+    @property
+    def bounded(self):
+        return self.max_entries is not None or self.max_bytes is not None or self.ttl is not None
+
+    def open(self):
+        # key -> value in LRU order, key -> (size, add timestamp, call latency)
+        self.cache_kv = OrderedDict()
+        self.entry_meta = {}
+        self.total_bytes = 0
+        # digest -> live entries referring to the blob
+        self.blob_refs = {}
+        self.disk_lines = 0
+        # How far the file has been read, and which file it was (a compaction replaces it)
+        self.offset = 0
+        self.file_id = None
+        if 'r' in self.mode:
+            try:
+                self.read_cache()
+            except Exception as e:
+                print(f'Fail to fetch in cache {self.fn=}, {e=}')
+                self.cache_kv = OrderedDict()
+                self.entry_meta = {}
+                self.total_bytes = 0
 
         # print(f'cache_size: {len(self.cache_kv)}')
-    
+
+    # ======= LRU bookkeeping, called with cache_lock held or before sharing =======
+    def _put(self, key, value, size, add_ts, latency=None):
+        self._pop(key, drop_blob=False)
+        size += blob_bytes(value)
+        self.cache_kv[key] = value
+        self.entry_meta[key] = (size, add_ts, latency)
+        self.total_bytes += size
+        digest = blob_digest(value)
+        if digest is not None:
+            self.blob_refs[digest] = self.blob_refs.get(digest, 0) + 1
+        self._evict()
+
+    def _pop(self, key, drop_blob=True):
+        """
+        drop_blob: remove the blob of the entry if no other entry refers to it, False when the
+        entry is overwritten
+        """
+        if key in self.cache_kv:
+            digest = blob_digest(self.cache_kv.pop(key))
+            self.total_bytes -= self.entry_meta.pop(key)[0]
+            if digest is None:
+                return
+            self.blob_refs[digest] -= 1
+            if self.blob_refs[digest] == 0:
+                del self.blob_refs[digest]
+                if drop_blob and self.blob_store is not None:
+                    self.blob_store.remove(digest)
+
+    def _expired(self, key, now=None):
+        if self.ttl is None:
+            return False
+        now = time.time() if now is None else now
+        return now - self.entry_meta[key][1] > self.ttl
+
+    def _evict(self):
+        while len(self.cache_kv) > 0 and (
+                (self.max_entries is not None and len(self.cache_kv) > self.max_entries) or
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            self._pop(next(iter(self.cache_kv)))
+
     @staticmethod
     def get_cache(fn, mode='rw'):
         os.makedirs(os.path.dirname(fn), exist_ok=True)
         with FileLock(f'{fn}.lock'):
-            with Cache.cache_lock:
+            with Cache.registry_lock:
                 key = (fn, mode)
                 d = Cache.name_mode_to_cache
                 if key not in d:
@@ -138,59 +373,748 @@ class Cache:
         return d[key]
 
     def read_cache(self):
-        if not os.path.isfile(self.fn):
-            return {}
+        self.read_new_lines()
 
-        data_list = get_data_list_from_jsonl(self.fn)
-        cache_kv = {}
-        for data in data_list:
-            key = data['key']
-            value = data['value']
-            cache_kv[key] = value
-        
-        return cache_kv
+    def read_new_lines(self):
+        """
+        Load the lines appended to the file since the last read, called with cache_lock held
+        or before the cache is shared. Only complete lines are read, a line being written
+        by another process is read next time.
+        """
+        try:
+            stat = os.stat(self.fn)
+        except FileNotFoundError:
+            return
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self.file_id or stat.st_size < self.offset:
+            # Compacted by another process, read the new file from the start
+            self.file_id = file_id
+            self.offset = 0
+            self.disk_lines = 0
+        if stat.st_size == self.offset:
+            return
+
+        now = time.time()
+        with open(self.fn, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                self.disk_lines += 1
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line partially written by a killed process
+                    continue
+                add_ts = parse_datatime(data.get('add_time'))
+                add_ts = add_ts if add_ts is not None else now
+                if self.ttl is not None and now - add_ts > self.ttl:
+                    self._pop(data['key'])
+                    continue
+                self._put(data['key'], data['value'], len(line), add_ts, data.get('latency'))
+
+    def encode_line(self, key, value, hint=None, latency=None):
+        data = dict(key=key, value=value)
+        data['add_time'] = get_datatime(mode=1)
+        if hint is not None:
+            data['hint'] = hint
+        if latency is not None:
+            data['latency'] = round(latency, 3)
+        return (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
 
-    def add(self, key, value, hint=None):
+    def add(self, key, value, hint=None, latency=None):
         if 'w' not in self.mode:
             return
 
+        if self.write_queue is not None:
+            line = self.encode_line(key, value, hint, latency) if value is not None else None
+            with self.cache_lock:
+                if value is None:
+                    self._pop(key)
+                    return
+                self._put(key, value, len(line), time.time(), latency)
+            self.write_queue.put(line)
+            return
+
         with FileLock(f'{self.fn}.lock'):
-            with Cache.cache_lock:
+            with self.cache_lock:
                 # Overwrite
                 # if self.has(key):
                 #     return
-                self.cache_kv[key] = value
-                if value is not None:
-                    data = dict(key=key, value=value)
-                    data['add_time'] = get_datatime(mode=1)
-                    if hint is not None:
-                        data['hint'] = hint
-
-                    append_jsonl(self.fn, data)
-    
+                if value is None:
+                    self._pop(key)
+                    return
+                line = self.encode_line(key, value, hint, latency)
+                if self.shared:
+                    # Catch up first, the file lock keeps the others from appending until the
+                    # line is written
+                    self.read_new_lines()
+                with open(self.fn, 'ab') as f:
+                    f.write(line)
+                self.disk_lines += 1
+                if self.shared:
+                    self.offset += len(line)
+                self._put(key, value, len(line), time.time(), latency)
+                if self.disk_lines > max(2 * len(self.cache_kv), self.compact_min_lines):
+                    self.compact()
+
+    # ======= Write behind =======
+    def start_writer(self):
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True,
+                                       name=f'cache-writer-{os.path.basename(self.fn)}')
+        self.writer.start()
+        atexit.register(self.flush)
+
+    def writer_loop(self):
+        while True:
+            batch = [self.write_queue.get()]
+            deadline = time.time() + self.flush_interval
+            while batch[-1] is not Cache.FLUSH and len(batch) < self.flush_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.write_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                items = [item for item in batch if item is not Cache.FLUSH]
+                if len(items) > 0:
+                    self.write_batch(items)
+            except Exception as e:
+                logger.error(f'Fail to write {len(batch)} entries to cache {self.fn}: {e!r}')
+            finally:
+                for _ in batch:
+                    self.write_queue.task_done()
+
+    def write_batch(self, lines):
+        data = b''.join(lines)
+        with FileLock(f'{self.fn}.lock'):
+            with self.cache_lock:
+                if self.shared:
+                    self.read_new_lines()
+                start = self.offset
+            # The file lock keeps the other processes out, the readers of this one are not blocked
+            with open(self.fn, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            with self.cache_lock:
+                self.disk_lines += len(lines)
+                if self.shared and self.offset == start:
+                    self.offset += len(data)
+                if self.disk_lines > max(2 * len(self.cache_kv), self.compact_min_lines):
+                    self.compact()
+
+    def flush(self):
+        """
+        Wait until the queued entries are on disk
+        """
+        if self.write_queue is None:
+            return
+        self.write_queue.put(Cache.FLUSH)
+        self.write_queue.join()
+
+    def put_blob(self, text):
+        """
+        The value to cache for text: its digest in the blob store and the compressed size
+        """
+        digest = self.blob_store.put(text)
+        return {'blob': digest, 'blob_bytes': self.blob_store.size(digest)}
+
+    def get_blob(self, digest):
+        return self.blob_store.get(digest)
+
+    def compact(self):
+        """
+        Rewrite the JSONL file with one line per live entry, in LRU order and within the bounds.
+        Called with the file lock held; the lines appended by other processes since this one
+        loaded the file are kept, as least recently used.
+        """
+        if not os.path.isfile(self.fn):
+            return
+        entries = OrderedDict()
+        now = time.time()
+        # Bytes, as read_new_lines counts them for max_bytes
+        with open(self.fn, 'rb') as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                add_ts = parse_datatime(data.get('add_time'))
+                if self.ttl is not None and add_ts is not None and now - add_ts > self.ttl:
+                    continue
+                entries.pop(data['key'], None)
+                entries[data['key']] = line
+        for key in self.cache_kv:
+            if key in entries:
+                entries.move_to_end(key)
+        kept = []
+        total_bytes = 0
+        live_digests = set()
+        for key in reversed(entries):
+            line = entries[key]
+            size = len(line)
+            value = json.loads(line)['value'] if self.blob_store is not None else None
+            size += blob_bytes(value)
+            if self.max_entries is not None and len(kept) >= self.max_entries:
+                break
+            if self.max_bytes is not None and total_bytes + size > self.max_bytes:
+                break
+            kept.append(line)
+            total_bytes += size
+            if blob_digest(value) is not None:
+                live_digests.add(blob_digest(value))
+        if self.blob_store is not None:
+            self.blob_store.gc(live_digests)
+        tmp_fn = f'{self.fn}.tmp'
+        with open(tmp_fn, 'wb') as f:
+            f.writelines(reversed(kept))
+        os.replace(tmp_fn, self.fn)
+        stat = os.stat(self.fn)
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.offset = stat.st_size
+        logger.info(f'Compact cache {self.fn}: {self.disk_lines} -> {len(kept)} lines')
+        self.disk_lines = len(kept)
+
+    def lookup(self, key):
+        """
+        (value, size, call latency) of key, None on a miss
+        """
+        with self.cache_lock:
+            if key not in self.cache_kv and self.shared:
+                self.read_new_lines()
+            if key not in self.cache_kv:
+                return None
+            if self._expired(key):
+                self._pop(key)
+                return None
+            self.cache_kv.move_to_end(key)
+            size, _, latency = self.entry_meta[key]
+            return self.cache_kv[key], size, latency
+
     def get(self, key):
-        return self.cache_kv.get(key)
-    
+        entry = self.lookup(key)
+        return entry[0] if entry is not None else None
+
     def has(self, key):
-        return key in self.cache_kv
-    
-    def get_cache(self, name, call_args_dict):
-        obj = deepcopy(call_args_dict)
-        obj["cache_name"] = name
-        key = obj_to_hash(obj)
-        if self.has(key):
+        with self.cache_lock:
+            if key not in self.cache_kv and self.shared:
+                self.read_new_lines()
+            return key in self.cache_kv and not self._expired(key)
+
+    def make_key(self, name, call_args_dict):
+        """
+        The cache key of a call, compute it once per call and pass it to get_cache and save_cache.
+        The args are neither copied nor modified, see obj_to_hash.
+        """
+        return obj_to_hash({**call_args_dict, "cache_name": name})
+
+    def get_cache(self, name, call_args_dict, strict=None, key=None):
+        """
+        strict overrides self.strict, for the composite calls whose miss falls back to cached calls
+        """
+        key = self.make_key(name, call_args_dict) if key is None else key
+        start = time.perf_counter()
+        entry = self.lookup(key)
+        lookup_time = time.perf_counter() - start
+        if entry is not None:
             logger.debug(f'HIT cache：{name=}: {key=}')
-            return self.get(key) 
+            value, size, latency = entry
+            self.record(name, hits=1, bytes_served=size, lookup_time=lookup_time,
+                        time_saved=latency if latency is not None else 0.0)
+            return value
         else:
+            self.record(name, misses=1, lookup_time=lookup_time)
+            with self.stats_lock:
+                if len(self.call_starts) > 10000:
+                    # Calls that failed and never saved
+                    self.call_starts.clear()
+                self.call_starts[key] = time.time()
+            if self.strict if strict is None else strict:
+                self.misses += 1
+                logger.error(f'MISS cache in strict mode：{name=}: {key=}')
+                raise CacheMissError(self.fn, name, key)
             return None
-    
-    def save_cache(self, name, call_args_dict, value):
-        obj = deepcopy(call_args_dict)
-        obj["cache_name"] = name
-        show_obj = get_omit_json(obj)
-        key = obj_to_hash(obj)
-        
-        if value is not None:
-            logger.debug(f'ADD cache：{name=}: {key=}')
-            self.add(key, value, hint=show_obj)
-            
\ No newline at end of file
+
+    def save_cache(self, name, call_args_dict, value, key=None):
+        if value is None or 'w' not in self.mode:
+            return
+        key = self.make_key(name, call_args_dict) if key is None else key
+        show_obj = get_omit_json({**call_args_dict, "cache_name": name})
+        with self.stats_lock:
+            call_start = self.call_starts.pop(key, None)
+        latency = time.time() - call_start if call_start is not None else None
+        self.record(name, stores=1, call_time=latency if latency is not None else 0.0)
+        logger.debug(f'ADD cache：{name=}: {key=}')
+        self.add(key, value, hint=show_obj, latency=latency)
+
+    # ======= Metrics =======
+    def record(self, name, **increments):
+        with self.stats_lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {"hits": 0, "near_hits": 0, "misses": 0, "stores": 0,
+                                           "bytes_served": 0, "lookup_time": 0.0,
+                                           "time_saved": 0.0, "call_time": 0.0}
+            for k, v in increments.items():
+                stat[k] += v
+
+    def get_stats(self):
+        """
+        Counters per cache_name, times in seconds. time_saved sums the recorded call latency of
+        the hits, call_time the latency of the calls that missed and were stored.
+        """
+        with self.stats_lock:
+            stats = {name: dict(stat) for name, stat in self.stats.items()}
+        for stat in stats.values():
+            lookups = stat["hits"] + stat["misses"]
+            stat["hit_rate"] = stat["hits"] / lookups if lookups > 0 else 0.0
+            stat["avg_lookup_ms"] = 1000 * stat["lookup_time"] / lookups if lookups > 0 else 0.0
+        return stats
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {}
+
+
+class SqliteCache(Cache):
+    """
+    Cache backed by an indexed SQLite file ({fn}.sqlite), the values stay on disk and a
+    lookup is a primary key query, so opening a multi-GB cache is instant.
+
+    WAL mode lets the engine threads and the other processes sharing the file read
+    while one writes. The JSONL file of the same fn, if any, is migrated once when the
+    SQLite file does not exist yet.
+
+    The bounds apply to the file: a hit refreshes access_time (at most once a minute per
+    entry), and every evict_interval adds the expired and least recently used rows are deleted.
+    """
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+              "add_time TEXT, hint TEXT, access_time REAL, latency REAL)")
+    COLUMNS = "(key, value, add_time, hint, access_time, latency)"
+    evict_interval = 1000
+    touch_interval = 60
+
+    def open(self):
+        self.db_fn = f'{self.fn}.sqlite'
+        self.local = threading.local()
+        self.adds = 0
+        self.pending = {}
+        if not os.path.isfile(self.db_fn) and os.path.isfile(self.fn):
+            # The processes of a shared cache or of the batch shards may open it at once
+            with FileLock(f'{self.fn}.lock'):
+                if not os.path.isfile(self.db_fn):
+                    SqliteCache.migrate_from_jsonl(self.fn, self.db_fn)
+        if 'w' in self.mode:
+            conn = self.connection()
+            conn.execute(self.SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+            # Files created before the bounds and the metrics were added
+            for column in ("access_time", "latency"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE cache ADD COLUMN {column} REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_access_time ON cache (access_time)")
+            conn.commit()
+            if self.bounded:
+                self.evict()
+        conn = self.connection()
+        self.has_latency = conn is not None and "latency" in [
+            row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+
+    def connection(self):
+        # sqlite3 connections can not be shared across threads, one per thread
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if 'w' in self.mode:
+                conn = sqlite3.connect(self.db_fn, timeout=60)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            elif os.path.isfile(self.db_fn):
+                conn = sqlite3.connect(f'file:{self.db_fn}?mode=ro', uri=True, timeout=60)
+            else:
+                return None
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def migrate_from_jsonl(jsonl_fn, db_fn=None, batch_size=1000):
+        """
+        One-shot migration of a JSONL cache file, streamed line by line, the last value of a
+        key wins
+        """
+        db_fn = db_fn if db_fn is not None else f'{jsonl_fn}.sqlite'
+        tmp_fn = f'{db_fn}.{os.getpid()}.{threading.get_ident()}.tmp'
+        logger.info(f'Migrate cache {jsonl_fn} to {db_fn}')
+        conn = sqlite3.connect(tmp_fn)
+        conn.execute(SqliteCache.SCHEMA)
+        sql = f"INSERT OR REPLACE INTO cache {SqliteCache.COLUMNS} VALUES (?, ?, ?, ?, ?, ?)"
+        cnt = 0
+        batch = []
+        now = time.time()
+        with open(jsonl_fn) as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line partially written by a killed process
+                    continue
+                if data.get('value') is None:
+                    continue
+                hint = data.get('hint')
+                add_ts = parse_datatime(data.get('add_time'))
+                if hint is not None and not isinstance(hint, str):
+                    hint = json.dumps(hint, ensure_ascii=False)
+                batch.append((data['key'], json.dumps(data['value'], ensure_ascii=False),
+                              data.get('add_time'), hint, add_ts if add_ts is not None else now,
+                              data.get('latency')))
+                if len(batch) >= batch_size:
+                    conn.executemany(sql, batch)
+                    cnt += len(batch)
+                    batch = []
+        conn.executemany(sql, batch)
+        cnt += len(batch)
+        conn.commit()
+        conn.close()
+        os.replace(tmp_fn, db_fn)
+        logger.info(f'Migrated {cnt} entries to {db_fn}')
+        return cnt
+
+    def ttl_cutoff(self):
+        # add_time is "%Y-%m-%d_%H:%M:%S", it compares in time order as a string
+        return datetime.datetime.fromtimestamp(time.time() - self.ttl).strftime("%Y-%m-%d_%H:%M:%S")
+
+    def evict(self):
+        conn = self.connection()
+        with conn:
+            if self.ttl is not None:
+                conn.execute("DELETE FROM cache WHERE add_time < ?", (self.ttl_cutoff(),))
+            if self.max_entries is not None:
+                conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                             "ORDER BY access_time DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            if self.max_bytes is not None:
+                conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM (SELECT key, "
+                             "SUM(LENGTH(value) + IFNULL(json_extract(value, '$.blob_bytes'), 0)) "
+                             "OVER (ORDER BY access_time DESC, rowid DESC) "
+                             "AS total FROM cache) WHERE total > ?)", (self.max_bytes,))
+        if self.blob_store is not None:
+            live_digests = set(row[0] for row in conn.execute(
+                "SELECT json_extract(value, '$.blob') FROM cache "
+                "WHERE json_extract(value, '$.blob') IS NOT NULL"))
+            self.blob_store.gc(live_digests)
+
+    def add(self, key, value, hint=None, latency=None):
+        if 'w' not in self.mode or value is None:
+            return
+        row = (key, json.dumps(value, ensure_ascii=False), get_datatime(mode=1), hint, time.time(),
+               latency)
+        if self.write_queue is not None:
+            # Served from pending until the writer thread has inserted it
+            with self.cache_lock:
+                self.pending[key] = (row, value)
+            self.write_queue.put(row)
+            return
+        self.write_batch([row])
+
+    def write_batch(self, rows):
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO cache {self.COLUMNS} VALUES (?, ?, ?, ?, ?, ?)", rows)
+        if self.write_queue is not None:
+            with self.cache_lock:
+                for row in rows:
+                    # Unless the key was added again meanwhile
+                    if self.pending.get(row[0], (None,))[0] is row:
+                        del self.pending[row[0]]
+        # Evict each time the adds cross a multiple of evict_interval
+        evicts = self.adds // self.evict_interval
+        self.adds += len(rows)
+        if self.bounded and self.adds // self.evict_interval > evicts:
+            self.evict()
+
+    def _row(self, key, columns):
+        conn = self.connection()
+        if conn is None:
+            return None
+        if self.ttl is None:
+            return conn.execute(f"SELECT {columns} FROM cache WHERE key = ?", (key,)).fetchone()
+        return conn.execute(f"SELECT {columns} FROM cache WHERE key = ? AND add_time >= ?",
+                            (key, self.ttl_cutoff())).fetchone()
+
+    def lookup(self, key):
+        with self.cache_lock:
+            if key in self.pending:
+                row, value = self.pending[key]
+                return value, len(row[1]), row[5]
+        touch = 'w' in self.mode and self.bounded
+        # Files of older versions may lack these columns, the read-only ones are not migrated
+        row = self._row(key, "value, {}, {}".format("access_time" if touch else "NULL",
+                                                    "latency" if self.has_latency else "NULL"))
+        if row is None:
+            return None
+        now = time.time()
+        if touch and (row[1] is None or now - row[1] > self.touch_interval):
+            conn = self.connection()
+            with conn:
+                conn.execute("UPDATE cache SET access_time = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]), len(row[0]), row[2]
+
+    def has(self, key):
+        with self.cache_lock:
+            if key in self.pending:
+                return True
+        return self._row(key, "1") is not None
+
+
+CACHE_BACKENDS = {
+    "jsonl": Cache,
+    "sqlite": SqliteCache,
+}
+
+
+# ======= Maintenance tools, python -m recursive.cache {compact,stats,export,import} =======
+def cache_role(fn):
+    """
+    search, llm or web_page for the files named {cache_key}-{name} by set_caches
+    """
+    return os.path.basename(fn).rsplit('-', 1)[-1]
+
+
+def open_cache(fn, backend=None, mode='rw', write_behind=False):
+    """
+    backend None: sqlite when only {fn}.sqlite exists, jsonl otherwise.
+    mode '' only reads the file through iter_cache_lines, the entries are not loaded.
+    Only the web_page caches keep their values in a blob store, as in set_caches.
+    """
+    if backend is None:
+        backend = "sqlite" if os.path.isfile(f'{fn}.sqlite') and not os.path.isfile(fn) else "jsonl"
+    blobs = cache_role(fn) == "web_page" or os.path.isdir(f'{fn}.blobs')
+    return CACHE_BACKENDS[backend](fn, mode=mode, blobs=blobs, write_behind=write_behind)
+
+
+def iter_cache_lines(cache):
+    """
+    Yield the stored entries as dicts with key, value, add_time and hint, in write order.
+    A JSONL cache yields every line, overwritten ones included.
+    """
+    if isinstance(cache, SqliteCache):
+        conn = cache.connection()
+        if conn is None:
+            return
+        for key, value, add_time, hint, latency in conn.execute(
+                "SELECT key, value, add_time, hint, {} FROM cache ORDER BY rowid".format(
+                    "latency" if cache.has_latency else "NULL")):
+            yield dict(key=key, value=json.loads(value), add_time=add_time, hint=hint,
+                       latency=latency)
+        return
+    if not os.path.isfile(cache.fn):
+        return
+    with open(cache.fn) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def entry_labels(data):
+    """
+    (cache_name, model) of an entry, read from its hint
+    """
+    try:
+        hint = json.loads(data['hint']) if isinstance(data.get('hint'), str) else data.get('hint')
+    except json.JSONDecodeError:
+        hint = None
+    if not isinstance(hint, dict):
+        return "unknown", None
+    return hint.get("cache_name", "unknown"), hint.get("model")
+
+
+def latest_entries(cache, cache_name=None, model=None):
+    """
+    The latest entry of each key, filtered by cache_name and model
+    """
+    entries = OrderedDict()
+    for data in iter_cache_lines(cache):
+        if data.get('value') is None:
+            continue
+        name, entry_model = entry_labels(data)
+        # It is the latest write of a key that counts, whether it matches or not
+        entries.pop(data['key'], None)
+        if (cache_name is None or name == cache_name) and (model is None or entry_model == model):
+            entries[data['key']] = data
+    return entries
+
+
+def compact_cache(cache):
+    if isinstance(cache, SqliteCache):
+        if cache.bounded:
+            cache.evict()
+        cache.connection().execute("VACUUM")
+        return
+    with FileLock(f'{cache.fn}.lock'):
+        with cache.cache_lock:
+            cache.compact()
+
+
+def cache_stats(cache, recorded=()):
+    """
+    Entries, overwritten lines and value bytes per cache_name, entries per model. call_time sums
+    the recorded latency of the live entries, what recomputing them would cost.
+    recorded: Cache.get_stats of the runs using the cache, their hits and misses are summed
+    """
+    stats = {}
+    live = {}
+    for data in iter_cache_lines(cache):
+        name, model = entry_labels(data)
+        size = len(json.dumps(data.get('value'), ensure_ascii=False))
+        latency = data.get('latency') or 0.0
+        stat = stats.setdefault(name, {"entries": 0, "lines": 0, "overwritten": 0, "bytes": 0,
+                                       "call_time": 0.0, "models": {}})
+        stat["lines"] += 1
+        if data['key'] in live:
+            old_name, old_model, old_size, old_latency = live[data['key']]
+            old_stat = stats[old_name]
+            old_stat["entries"] -= 1
+            old_stat["bytes"] -= old_size
+            old_stat["call_time"] -= old_latency
+            old_stat["overwritten"] += 1
+            if old_model is not None:
+                old_stat["models"][old_model] -= 1
+        live[data['key']] = (name, model, size, latency)
+        stat["entries"] += 1
+        stat["bytes"] += size
+        stat["call_time"] += latency
+        if model is not None:
+            stat["models"][model] = stat["models"].get(model, 0) + 1
+    for run_stats in recorded:
+        for name, run_stat in run_stats.items():
+            stat = stats.setdefault(name, {"entries": 0, "lines": 0, "overwritten": 0, "bytes": 0,
+                                           "call_time": 0.0, "models": {}})
+            for counter in ("hits", "near_hits", "misses"):
+                stat[counter] = stat.get(counter, 0) + run_stat.get(counter, 0)
+    for stat in stats.values():
+        if "hits" in stat:
+            lookups = stat["hits"] + stat["misses"]
+            stat["hit_rate"] = stat["hits"] / lookups if lookups > 0 else 0.0
+    return stats
+
+
+def recorded_cache_stats(fn, stats_files):
+    """
+    The stats of the cache fn in the cache_stats.json files written by the runs
+    """
+    recorded = []
+    for stats_file in stats_files:
+        with open(stats_file) as f:
+            run_stats = json.load(f)
+        if cache_role(fn) in run_stats:
+            recorded.append(run_stats[cache_role(fn)])
+    return recorded
+
+
+def export_cache(cache, out_fn, cache_name=None, model=None):
+    """
+    Write the matching entries to a JSONL bundle (gzip when out_fn ends with .gz), the
+    blobs are inlined as blob_text so the bundle is self-contained
+    """
+    import gzip
+    cnt = 0
+    opener = gzip.open if out_fn.endswith('.gz') else open
+    with opener(out_fn, 'wt', encoding='utf-8') as f:
+        for data in latest_entries(cache, cache_name=cache_name, model=model).values():
+            value = data['value']
+            if isinstance(value, dict) and 'blob' in value and cache.blob_store is not None:
+                text = cache.get_blob(value['blob'])
+                if text is None:
+                    logger.warning(f"Skip {data['key']}, its blob {value['blob']} is missing")
+                    continue
+                data = {**data, 'blob_text': text}
+            f.write(json.dumps(data, ensure_ascii=False) + '\n')
+            cnt += 1
+    return cnt
+
+
+def import_cache(cache, bundle_fn, overwrite=False):
+    """
+    Add the entries of an exported bundle, the existing keys are kept unless overwrite
+    """
+    import gzip
+    added = 0
+    skipped = 0
+    opener = gzip.open if bundle_fn.endswith('.gz') else open
+    with opener(bundle_fn, 'rt', encoding='utf-8') as f:
+        for line in f:
+            data = json.loads(line)
+            if not overwrite and cache.has(data['key']):
+                skipped += 1
+                continue
+            value = data['value']
+            if 'blob_text' in data:
+                value = {**value, **cache.put_blob(data['blob_text'])}
+            cache.add(data['key'], value, hint=data.get('hint'), latency=data.get('latency'))
+            added += 1
+    cache.flush()
+    return added, skipped
+
+
+def define_args():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Maintenance of the search, llm and web_page caches")
+    parser.add_argument("--backend", type=str, default=None, choices=["jsonl", "sqlite"],
+                        help="Default: sqlite when only {fn}.sqlite exists")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="Keep the latest value of each key, drop the broken lines")
+    compact_parser.add_argument("fn", nargs="+")
+    compact_parser.add_argument("--max-entries", type=int, default=None)
+    compact_parser.add_argument("--max-bytes", type=int, default=None)
+    compact_parser.add_argument("--ttl", type=float, default=None, help="Seconds")
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="Entries, overwritten lines, bytes, hits and misses per cache_name")
+    stats_parser.add_argument("fn", nargs="+")
+    stats_parser.add_argument("--run-stats", type=str, nargs="+", default=[],
+                              help="cache_stats.json files of the runs, for the hits and misses")
+
+    export_parser = subparsers.add_parser(
+        "export", help="Write a filtered bundle to pre-warm another machine")
+    export_parser.add_argument("fn")
+    export_parser.add_argument("out")
+    export_parser.add_argument("--cache-name", type=str, default=None,
+                               help="e.g. OpenAIApiProxy.call")
+    export_parser.add_argument("--model", type=str, default=None)
+
+    import_parser = subparsers.add_parser("import", help="Add the entries of a bundle to a cache")
+    import_parser.add_argument("bundle")
+    import_parser.add_argument("fn")
+    import_parser.add_argument("--overwrite", action="store_true")
+    return parser
+
+
+if __name__ == "__main__":
+    args = define_args().parse_args()
+    if args.command == "compact":
+        for fn in args.fn:
+            cache = open_cache(fn, args.backend)
+            cache.max_entries, cache.max_bytes = args.max_entries, args.max_bytes
+            cache.ttl = args.ttl
+            compact_cache(cache)
+    elif args.command == "stats":
+        stats = {fn: cache_stats(open_cache(fn, args.backend, mode=''),
+                                 recorded_cache_stats(fn, args.run_stats)) for fn in args.fn}
+        print(json.dumps(stats, indent=2, ensure_ascii=False))
+    elif args.command == "export":
+        cnt = export_cache(open_cache(args.fn, args.backend, mode=''), args.out,
+                           cache_name=args.cache_name, model=args.model)
+        print(f'Exported {cnt} entries to {args.out}')
+    else:
+        added, skipped = import_cache(open_cache(args.fn, args.backend, write_behind=True),
+                                      args.bundle, overwrite=args.overwrite)
+        print(f'Imported {added} entries into {args.fn}, kept {skipped} existing ones')
@@ -0,0 +1,275 @@
+# coding: utf8
+import os
+import json
+import shutil
+import dill as pickle
+from collections import deque
+from loguru import logger
+from recursive.graph import TaskStatus, NodeType
+
+
+def atomic_write(fn, content, mode="w"):
+    tmp_fn = "{}.tmp".format(fn)
+    with open(tmp_fn, mode) as f:
+        f.write(content)
+    os.replace(tmp_fn, fn)
+
+
+def write_snapshot(engine, folder, step):
+    """
+    Save the nodes, the memory and the article of engine as one unit: the files go into
+    {folder}/snapshots/{step}, which is published by replacing checkpoint.json last, so a
+    killed process leaves the previous snapshot or the new one, never a mix of both.
+    nodes.json and article.txt are copied to the folder for the viewers.
+    """
+    snapshot_dir = "{}/snapshots/{}".format(folder, step)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    nodes_json = json.dumps(engine.root_node.to_json(), indent=4, ensure_ascii=False)
+    atomic_write("{}/nodes.pkl".format(snapshot_dir), pickle.dumps(engine.root_node), mode="wb")
+    atomic_write("{}/nodes.json".format(snapshot_dir), nodes_json)
+    engine.memory.save(snapshot_dir)
+    atomic_write("{}/article.txt".format(snapshot_dir), engine.memory.article)
+    atomic_write("{}/checkpoint.json".format(folder),
+                 json.dumps({"step": step, "snapshot": "snapshots/{}".format(step)}))
+
+    atomic_write("{}/nodes.json".format(folder), nodes_json)
+    atomic_write("{}/article.txt".format(folder), engine.memory.article)
+    for name in os.listdir("{}/snapshots".format(folder)):
+        if name != str(step):
+            shutil.rmtree("{}/snapshots/{}".format(folder, name), ignore_errors=True)
+
+
+def snapshot_folder(folder):
+    """
+    Folder of the files of the published snapshot, the folder itself for the checkpoints
+    written before the snapshots had their own folder
+    """
+    checkpoint_file = "{}/checkpoint.json".format(folder)
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            snapshot = json.load(f).get("snapshot")
+        if snapshot is not None:
+            return "{}/{}".format(folder, snapshot)
+    return folder
+
+
+def iter_tree(root_node):
+    queue = deque([root_node])
+    while len(queue) > 0:
+        node = queue.popleft()
+        yield node
+        queue.extend(node.topological_task_queue)
+
+
+class CheckpointJournal:
+    """
+    Incremental checkpoint of a GraphRunEngine run.
+
+    Files in the folder:
+        - snapshots/N/{nodes.pkl, nodes.json, memory.jsonl, article.txt}: the last compacted
+          snapshot, see write_snapshot
+        - checkpoint.json: {"step": N, "snapshot": "snapshots/N"}, the published snapshot
+        - journal.jsonl: one line per step after the snapshot, only holds the
+          status/result deltas of the nodes touched in the step and the new
+          part of the memory
+
+    Each step costs an append proportional to what the step changed; the whole
+    tree is only serialized every snapshot_interval steps.
+    """
+
+    def __init__(self, folder, snapshot_interval=50):
+        self.folder = folder
+        self.snapshot_interval = snapshot_interval
+        self.journal_file = "{}/journal.jsonl".format(folder)
+        self.checkpoint_file = "{}/checkpoint.json".format(folder)
+        self.last_snapshot_step = None
+        # What has been written for each node, key is hashkey
+        self.journaled = {}
+        self.article_len = 0
+        self.search_cnt = 0
+        self.global_start_index = None
+
+    # ======= Write =======
+    def _remember(self, node):
+        self.journaled[node.hashkey] = {
+            "status": node.status,
+            "task_info": json.dumps(node.task_info, ensure_ascii=False, sort_keys=True,
+                                    default=str),
+            "result": dict(node.result),
+            "inner": len(node.topological_task_queue) > 0,
+        }
+
+    def snapshot(self, engine, step):
+        write_snapshot(engine, self.folder, step)
+        # The snapshot contains everything, start a new journal; killed before, the replay
+        # skips the lines up to the step of the snapshot
+        open(self.journal_file, "w").close()
+
+        self.journaled = {}
+        for node in iter_tree(engine.root_node):
+            self._remember(node)
+        self.article_len = len(engine.memory.article)
+        self.search_cnt = len(engine.memory.all_search_results)
+        self.global_start_index = engine.memory.global_start_index
+        self.last_snapshot_step = step
+
+    def _node_delta(self, node):
+        known = self.journaled.get(node.hashkey)
+        delta = {"hashkey": node.hashkey}
+        if known is None or known["status"] != node.status:
+            delta["status"] = node.status.name
+        task_info = json.dumps(node.task_info, ensure_ascii=False, sort_keys=True, default=str)
+        if known is None or known["task_info"] != task_info:
+            delta["task_info"] = node.task_info
+        results = {action: entry for action, entry in node.result.items()
+                   if known is None or known["result"].get(action) is not entry}
+        if len(results) > 0:
+            delta["result"] = results
+        if len(node.topological_task_queue) > 0 and (known is None or not known["inner"]):
+            delta["raw_plan"] = node.raw_plan
+            delta["inner_graph"] = [{
+                "nid": inner_node.nid,
+                "hashkey": inner_node.hashkey,
+                "node_type": inner_node.node_type.name,
+                "task_info": inner_node.task_info,
+                "parent_nids": [parent.nid
+                                for parent in inner_node.node_graph_info["parent_nodes"]],
+            } for inner_node in node.inner_graph.node_list]
+            # Replay builds the inner nodes fresh, their own deltas go on top of that
+            for inner_node in node.inner_graph.node_list:
+                self.journaled[inner_node.hashkey] = {
+                    "status": TaskStatus.NOT_READY,
+                    "task_info": json.dumps(inner_node.task_info, ensure_ascii=False,
+                                            sort_keys=True, default=str),
+                    "result": {},
+                    "inner": False,
+                }
+        self._remember(node)
+        return delta
+
+    def record(self, engine, step, nodes, force_snapshot=False):
+        """
+        Checkpoint after a step, nodes are the nodes touched in the step
+        """
+        if force_snapshot or self.last_snapshot_step is None or \
+                step - self.last_snapshot_step >= self.snapshot_interval:
+            self.snapshot(engine, step)
+            return
+
+        entry = {"step": step, "nodes": []}
+        seen = set()
+        for node in nodes:
+            if node.hashkey in seen:
+                continue
+            seen.add(node.hashkey)
+            entry["nodes"].append(self._node_delta(node))
+
+        memory = engine.memory
+        memory_delta = {}
+        if len(memory.article) != self.article_len:
+            offset = min(self.article_len, len(memory.article))
+            memory_delta["article"] = [offset, memory.article[offset:]]
+            self.article_len = len(memory.article)
+        if len(memory.all_search_results) != self.search_cnt:
+            offset = min(self.search_cnt, len(memory.all_search_results))
+            memory_delta["all_search_results"] = [offset, memory.all_search_results[offset:]]
+            self.search_cnt = len(memory.all_search_results)
+        if memory.global_start_index != self.global_start_index:
+            memory_delta["global_start_index"] = memory.global_start_index
+            self.global_start_index = memory.global_start_index
+        if len(memory_delta) > 0:
+            entry["memory"] = memory_delta
+
+        with open(self.journal_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+    # ======= Replay =======
+    @staticmethod
+    def read_snapshot_step(folder):
+        checkpoint_file = "{}/checkpoint.json".format(folder)
+        if not os.path.exists(checkpoint_file):
+            return None
+        with open(checkpoint_file) as f:
+            return json.load(f)["step"]
+
+    @staticmethod
+    def _build_inner_graph(node, records):
+        id2node = {}
+        inner_nodes = []
+        for record in records:
+            inner_node = node.__class__(
+                config=node.config,
+                nid=record["nid"],
+                node_graph_info={
+                    "outer_node": node,
+                    "root_node": node.node_graph_info["root_node"],
+                    "parent_nodes": [],
+                    "layer": node.node_graph_info["layer"] + 1
+                },
+                task_info=record["task_info"],
+                node_type=NodeType[record["node_type"]]
+            )
+            inner_node.hashkey = record["hashkey"]
+            id2node[str(record["nid"])] = inner_node
+            inner_nodes.append(inner_node)
+        for inner_node, record in zip(inner_nodes, records):
+            inner_node.node_graph_info["parent_nodes"] = [id2node[str(nid)]
+                                                          for nid in record["parent_nids"]]
+        node.inner_graph.clear()
+        for inner_node in inner_nodes:
+            node.inner_graph.add_node(inner_node)
+        for inner_node in inner_nodes:
+            for parent_node in inner_node.node_graph_info["parent_nodes"]:
+                node.inner_graph.add_edge(parent_node, inner_node)
+        node.inner_graph.topological_sort()
+        return inner_nodes
+
+    @staticmethod
+    def replay(engine, folder):
+        """
+        Apply the journal on the snapshot loaded into engine, return the last replayed step
+        """
+        step = CheckpointJournal.read_snapshot_step(folder)
+        journal_file = "{}/journal.jsonl".format(folder)
+        if step is None or not os.path.exists(journal_file):
+            return step
+
+        hashkey2node = {node.hashkey: node for node in iter_tree(engine.root_node)}
+        memory = engine.memory
+        with open(journal_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be partially written when the process is killed
+                    logger.warning("Skip broken journal line in {}".format(journal_file))
+                    break
+                if entry["step"] <= step:
+                    continue
+                # Build the new inner graphs first, the deltas of the inner nodes follow
+                for delta in entry["nodes"]:
+                    if "inner_graph" in delta:
+                        node = hashkey2node[delta["hashkey"]]
+                        node.raw_plan = delta["raw_plan"]
+                        inner_nodes = CheckpointJournal._build_inner_graph(
+                            node, delta["inner_graph"])
+                        for inner_node in inner_nodes:
+                            hashkey2node[inner_node.hashkey] = inner_node
+                for delta in entry["nodes"]:
+                    node = hashkey2node[delta["hashkey"]]
+                    if "status" in delta:
+                        node.status = TaskStatus[delta["status"]]
+                    if "task_info" in delta:
+                        node.task_info = delta["task_info"]
+                    node.result.update(delta.get("result", {}))
+                memory_delta = entry.get("memory", {})
+                if "article" in memory_delta:
+                    offset, text = memory_delta["article"]
+                    memory.article = memory.article[:offset] + text
+                if "all_search_results" in memory_delta:
+                    offset, pages = memory_delta["all_search_results"]
+                    memory.all_search_results = memory.all_search_results[:offset] + pages
+                if "global_start_index" in memory_delta:
+                    memory.global_start_index = memory_delta["global_start_index"]
+                step = entry["step"]
+        return step
@@ -6,17 +6,33 @@ from recursive.graph import TaskStatus, RegularDummyNode, NodeType
 from recursive.utils.display import display_graph, display_plan
 from recursive.agent.proxy import AgentProxy
 from recursive.memory import Memory, article
+from recursive.scheduler import ReadyQueue
+from recursive.checkpoint import CheckpointJournal, atomic_write, iter_tree, write_snapshot, \
+    snapshot_folder
 import random
 from pprint import pprint
 import dill as pickle
 import json
 import argparse
+import os
+import time
+import resource
 from loguru import logger
 import traceback
 from recursive.memory import caches
-from recursive.cache import Cache
+from recursive.cache import CACHE_BACKENDS, CACHE_LIMITS
 from recursive.utils.get_index import get_report_with_ref
+from recursive.utils.tracer import tracer
+from recursive.near_cache import enable_near_cache
+from recursive.llm.llm import configure_http_pool
+from recursive.llm.retry import configure_retry
+from recursive.llm.rate_limit import configure_rate_limits
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# Actions that are skipped by dummy agents, no need to display the plan after them
+SILENT_ACTIONS = ("update", "prior_reflect", "planning_post_reflect", "execute_post_reflect")
 
 
 class GraphRunEngine:
@@ -26,6 +42,14 @@ class GraphRunEngine:
     def __init__(self, root_node, memory_format, config):
         self.root_node = root_node
         self.memory = Memory(root_node, format=memory_format, config=config)
+        # In parallel mode, each concurrently running node gets its own block of
+        # search result indices, so the citation indices never collide
+        self.parallel_index_stride = config.get("parallel_index_stride", 1000)
+        self.executor = None
+        # Built when the run starts, None means falling back to the BFS and forward_exam
+        self.ready_queue = None
+        # Apply the actions of passthrough agents in the same step as the real action
+        self.collapse_passthrough = config.get("collapse_passthrough", True)
 
     def find_need_next_step_nodes(self, single=False):
         nodes = []
@@ -46,30 +70,40 @@ class GraphRunEngine:
         else:
             return None
 
-    def save(self, folder):
-        # save root_node
-        # save memory
-        # save article while running
-        root_node_file = "{}/nodes.pkl".format(folder)
-        root_node_json_file = "{}/nodes.json".format(folder)
-        article_file = "{}/article.txt".format(folder)
-        with open(root_node_file, "wb") as f:
-            pickle.dump(self.root_node, f)
-
-        with open(root_node_json_file, "w") as f:
-            json.dump(self.root_node.to_json(), f, indent=4, ensure_ascii=False)
-
-        self.memory.save(folder)
-
-        with open(article_file, 'w', encoding='utf-8') as file:
-            file.write(self.memory.article)
+    def save(self, folder, step):
+        # save root_node, memory and article as one snapshot, published when complete,
+        # so a killed process always leaves a consistent checkpoint
+        write_snapshot(self, folder, step)
 
     def load(self, folder):
-        root_node_file = "{}/nodes.pkl".format(folder)
+        snapshot_dir = snapshot_folder(folder)
+        root_node_file = "{}/nodes.pkl".format(snapshot_dir)
         with open(root_node_file, "rb") as f:
             self.root_node = pickle.load(f)
 
-        self.memory = self.memory.load(folder)
+        self.memory.root_node = self.root_node
+        self.memory.init()
+        self.memory = self.memory.load(snapshot_dir)
+        # Journal mode, apply the steps after the last snapshot
+        return CheckpointJournal.replay(self, folder)
+
+    @staticmethod
+    def has_checkpoint(folder):
+        return CheckpointJournal.read_snapshot_step(folder) is not None and \
+            os.path.exists("{}/nodes.pkl".format(snapshot_folder(folder)))
+
+    def dump_bench(self, bench_file, stats, wall_time):
+        bench = dict(stats)
+        bench["wall_time"] = wall_time
+        bench["steps_per_sec"] = stats["steps"] / wall_time if wall_time > 0 else 0.0
+        bench["checkpoint_time_per_step"] = stats["checkpoint_time"] / max(stats["steps"], 1)
+        # ru_maxrss is in KB on linux
+        bench["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        bench["node_cnt"] = sum(1 for _ in iter_tree(self.root_node))
+        bench["cache_misses"] = {name: cache.misses for name, cache in caches.items()
+                                 if cache is not None}
+        logger.info("Bench: {}".format(json.dumps(bench)))
+        atomic_write(bench_file, json.dumps(bench, indent=4))
 
     def forward_exam(self, node, verbose):
         # The exam order is bottom-up hierarchically, and top-down based on dependencies.
@@ -81,6 +115,30 @@ class GraphRunEngine:
                 self.forward_exam(inner_node, verbose)
             node.do_exam(verbose)
 
+    def run_node_step(self, node, memory, *action_args, **action_kwargs):
+        """
+        Do the next action of node. With collapse_passthrough, the passthrough actions
+        before and after the real action are done inline, the status transitions are the
+        same as doing them in separate steps. Return the names of the actions done.
+        """
+        if not self.collapse_passthrough:
+            action_name, action_result = node.next_action_step(memory, *action_args,
+                                                               **action_kwargs)
+            return [action_name]
+        action_names = []
+        real_action_done = False
+        while True:
+            action_name = node.next_action_name(memory, *action_args, **action_kwargs)
+            if action_name is None:
+                break
+            passthrough = node.agent_proxy.is_passthrough(action_name)
+            if not passthrough and real_action_done:
+                break
+            node.next_action_step(memory, *action_args, **action_kwargs)
+            action_names.append(action_name)
+            real_action_done = real_action_done or not passthrough
+        return action_names
+
     def forward_one_step_not_parallel(self, full_step=False, select_node_hashkey=None, log_fn=None,
                                       nodes_json_file=None, *action_args, **action_kwargs):
         # Find tasks that need to enter the next step
@@ -93,6 +151,8 @@ class GraphRunEngine:
                 raise Exception(
                     "Error, the select node {} can not be executed".format(select_node_hashkey))
             need_next_step_node = node
+        elif self.ready_queue is not None:
+            need_next_step_node = self.ready_queue.peek()
         else:
             need_next_step_node = self.find_need_next_step_nodes(single=True)
         if need_next_step_node is None:
@@ -107,6 +167,7 @@ class GraphRunEngine:
 
             return "done"
         logger.info("select node: {}".format(need_next_step_node.task_str()))
+        tracer.annotate(hashkey=need_next_step_node.hashkey, status=need_next_step_node.status.name)
         # Execute the next step for this node
         # Update Memory
         self.memory.update_infos([need_next_step_node])
@@ -117,45 +178,170 @@ class GraphRunEngine:
                 json.dump(self.root_node.to_json(), f, indent=4, ensure_ascii=False)
 
         if not full_step:
-            action_name, action_result = need_next_step_node.next_action_step(self.memory,
-                                                                              *action_args,
-                                                                              **action_kwargs)
+            action_names = self.run_node_step(need_next_step_node, self.memory,
+                                              *action_args, **action_kwargs)
         else:
-            action_name = need_next_step_node.next_full_action_step(self.memory)
+            action_names = [need_next_step_node.next_full_action_step(self.memory)]
 
-        verbose = action_name not in ("update", "prior_reflect",
-                                      "planning_post_reflect",
-                                      "execute_post_reflect")
+        tracer.annotate(actions=",".join(action_names))
+        verbose = any(action_name not in SILENT_ACTIONS for action_name in action_names)
 
         # After the action ends, update the entire graph status. When in parallel, should wait for all parallel tasks to complete before executing uniformly
-        self.forward_exam(self.root_node, verbose)
+        if self.ready_queue is not None:
+            self.ready_queue.notify(need_next_step_node, verbose)
+        else:
+            self.forward_exam(self.root_node, verbose)
+
+        if verbose:
+            display_plan(self.root_node.inner_graph)
+
+    def forward_one_step_parallel(self, nodes_json_file=None, *action_args, **action_kwargs):
+        # Find all the tasks that can enter the next step, in the BFS order
+        if self.ready_queue is not None:
+            need_next_step_nodes = self.ready_queue.ready_nodes()
+        else:
+            need_next_step_nodes = self.find_need_next_step_nodes(single=False)
+        if len(need_next_step_nodes) == 0:
+            logger.info("All Done")
+            display_plan(self.root_node.inner_graph)
+            if nodes_json_file:
+                with open(nodes_json_file, "w") as f:
+                    json.dump(self.root_node.to_json(), f, indent=4, ensure_ascii=False)
+            return "done"
+        logger.info("select {} nodes: \n{}".format(
+            len(need_next_step_nodes), "\n".join(node.task_str() for node in need_next_step_nodes)))
+        tracer.annotate(nodes=len(need_next_step_nodes))
+        self.memory.update_infos(need_next_step_nodes)
+
+        if nodes_json_file:
+            with open(nodes_json_file, "w") as f:
+                json.dump(self.root_node.to_json(), f, indent=4, ensure_ascii=False)
+
+        if len(need_next_step_nodes) == 1:
+            views = [self.memory]
+        else:
+            # Each node runs on its own view of the memory with a block of search indices,
+            # the views are merged back in the BFS order and their indices made contiguous,
+            # so the article and the search indices are deterministic
+            base_index = self.memory.global_start_index
+            stride = self.parallel_index_stride
+            views = [self.memory.fork(global_start_index=base_index + idx * stride)
+                     for idx in range(len(need_next_step_nodes))]
+        base_article = self.memory.article
+        base_search_cnt = len(self.memory.all_search_results)
+
+        futures = [self.executor.submit(self.run_node_step, node, view,
+                                        *action_args, **action_kwargs)
+                   for node, view in zip(need_next_step_nodes, views)]
+        action_names = []
+        errors = []
+        for future in futures:
+            try:
+                action_names.extend(future.result())
+            except Exception as e:
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+
+        if len(views) > 1:
+            for idx, (node, view) in enumerate(zip(need_next_step_nodes, views)):
+                view_start_index = base_index + idx * self.parallel_index_stride
+                used = view.global_start_index - view_start_index
+                if used > self.parallel_index_stride:
+                    logger.warning(
+                        "Node {} used {} search indices, exceeds parallel_index_stride {}".format(
+                            node.task_str(), used, self.parallel_index_stride))
+                self.memory.merge(view, base_article, base_search_cnt, view_start_index,
+                                  results=node.result)
+
+        tracer.annotate(actions=",".join(action_names))
+        verbose = any(action_name not in SILENT_ACTIONS for action_name in action_names)
+        # Exam once after the whole batch completed
+        if self.ready_queue is not None:
+            for node in need_next_step_nodes:
+                self.ready_queue.notify(node, verbose)
+        else:
+            self.forward_exam(self.root_node, verbose)
 
         if verbose:
             display_plan(self.root_node.inner_graph)
 
     def forward_one_step_untill_done(self, full_step=False,
                                      parallel=False,
+                                     max_workers=4,
                                      save_folder=None,
                                      nl=False,
                                      nodes_json_file=None,
+                                     checkpoint_mode="full",
+                                     snapshot_interval=50,
+                                     resume=False,
+                                     bench_file=None,
                                      *action_args, **action_kwargs):
-        self.root_node.status = TaskStatus.READY
-        for step in range(10000):
-            logger.info("Step {}".format(step))
-            ret = self.forward_one_step_not_parallel(
-                full_step=False,
-                log_fn="logs/temp/{}".format(step),
-                nodes_json_file=nodes_json_file,
-                *action_args,
-                **action_kwargs
-            )
-            self.save(save_folder)
-            if ret == "done":
-                break
+        start_step = 0
+        run_start = time.time()
+        # Engine overhead, the step time includes the agents, which are served by the cache in
+        # offline mode
+        stats = {"steps": 0, "step_time": 0.0, "checkpoint_time": 0.0}
+        if resume and self.has_checkpoint(save_folder):
+            # Continue from the next activatable node of the last checkpoint
+            start_step = self.load(save_folder) + 1
+            logger.info("Resume from {}, continue at step {}".format(save_folder, start_step))
+        else:
+            self.root_node.status = TaskStatus.READY
+            # Stale journal of a previous run in the same folder must not be replayed
+            if os.path.exists("{}/journal.jsonl".format(save_folder)):
+                os.remove("{}/journal.jsonl".format(save_folder))
+        self.ready_queue = ReadyQueue(self.root_node)
+        journal = None
+        if checkpoint_mode == "journal":
+            journal = CheckpointJournal(save_folder, snapshot_interval)
+        if parallel:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix="engine_worker")
+        try:
+            for step in range(start_step, 10000):
+                logger.info("Step {}".format(step))
+                step_start = time.time()
+                with tracer.span("engine.step", cat="engine", step=step):
+                    if parallel:
+                        ret = self.forward_one_step_parallel(
+                            nodes_json_file=nodes_json_file,
+                            *action_args,
+                            **action_kwargs
+                        )
+                    else:
+                        ret = self.forward_one_step_not_parallel(
+                            full_step=False,
+                            log_fn="logs/temp/{}".format(step),
+                            nodes_json_file=nodes_json_file,
+                            *action_args,
+                            **action_kwargs
+                        )
+                checkpoint_start = time.time()
+                touched_nodes = self.ready_queue.drain_changed()
+                with tracer.span("engine.checkpoint", cat="engine", step=step,
+                                 mode=checkpoint_mode):
+                    if journal is not None:
+                        journal.record(self, step, touched_nodes, force_snapshot=(ret == "done"))
+                    else:
+                        self.save(save_folder, step)
+                stats["steps"] += 1
+                stats["step_time"] += checkpoint_start - step_start
+                stats["checkpoint_time"] += time.time() - checkpoint_start
+                if ret == "done":
+                    break
 
-            if step > 3000:
-                logger.error("Step > 3000, break")
-                break
+                if step > 3000:
+                    logger.error("Step > 3000, break")
+                    break
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            if tracer.enabled:
+                tracer.export("{}/trace.json".format(save_folder))
+            if bench_file is not None:
+                self.dump_bench(bench_file, stats, time.time() - run_start)
 
         if step <= 3000:
             final_answer = self.root_node.get_node_final_result()["result"]
@@ -181,13 +367,78 @@ def read_jsonl(filename: str, jsonl_format=True) -> List[Dict]:
     return data
 
 
+def check_offline_misses():
+    misses = {name: cache.misses for name, cache in caches.items()
+              if cache is not None and cache.misses > 0}
+    if len(misses) > 0:
+        raise Exception("Offline replay missed the recorded caches: {}".format(misses))
+
+
+def flush_caches():
+    """
+    Wait for the write-behind caches, the shard processes of batch_writing exit without atexit
+    """
+    for cache in caches.values():
+        if cache is not None:
+            cache.flush()
+
+
+def reset_cache_stats():
+    for cache in caches.values():
+        if cache is not None:
+            cache.reset_stats()
+
+
+def dump_cache_stats(stats_file):
+    """
+    Hits, misses, bytes served, lookup time and time saved per cache and cache_name, see
+    Cache.get_stats
+    """
+    stats = {name: cache.get_stats() for name, cache in caches.items() if cache is not None}
+    atomic_write(stats_file, json.dumps(stats, indent=4, ensure_ascii=False))
+
+
+def set_caches(root_folder, cache_key, offline=False, cache_dir=None, cache_backend="jsonl",
+               cache_limits=None, shared_cache=False):
+    """
+    cache search, llm and web page results. offline replays a recorded run: the caches are
+    read only, and every call must be served by them.
+    cache_limits overrides CACHE_LIMITS per name, e.g. {"llm": {"max_bytes": 1e9}}; an offline
+    replay ignores the limits, a recorded entry must not expire.
+    shared_cache: the cache files are used by concurrent runs, which see each other's results
+    The cache lines are written behind by a thread per cache, see flush_caches
+    """
+    if cache_dir is None:
+        cache_dir = "{}/../cache".format(root_folder)
+    mode = "r" if offline else "rw"
+    cache_cls = CACHE_BACKENDS[cache_backend]
+    cache_limits = cache_limits if cache_limits is not None else {}
+    for name in ("search", "llm", "web_page"):
+        limits = {} if offline else {**CACHE_LIMITS[name], **cache_limits.get(name, {})}
+        caches[name] = cache_cls("{}/{}-{}".format(cache_dir, cache_key, name), mode=mode,
+                                 strict=offline, shared=shared_cache, blobs=(name == "web_page"),
+                                 write_behind=True, **limits)
+
+
 def story_writing(input_filename,
                   output_filename,
                   start,
                   end,
                   done_flag_file,
                   global_use_model,
-                  nodes_json_file=None):
+                  nodes_json_file=None,
+                  parallel=False,
+                  max_workers=4,
+                  checkpoint_mode="full",
+                  resume=False,
+                  cache_key=None,
+                  trace=False,
+                  offline=False,
+                  cache_dir=None,
+                  cache_backend="jsonl",
+                  cache_limits=None,
+                  shared_cache=False,
+                  near_cache=None):
 
     config = {
         "language": "en",
@@ -291,8 +542,15 @@ def story_writing(input_filename,
     import pathlib
     root_folder = "{}/{}".format(str(pathlib.Path(output_filename).parent.parent),
                                  "records")
-    caches["search"] = Cache("{}/../cache/{}-{}-search".format(root_folder, start, end))
-    caches["llm"] = Cache("{}/../cache/{}-{}-llm".format(root_folder, start, end))
+    if trace:
+        # Each task folder gets a trace.json
+        tracer.enable()
+    # shards of a batch run share the cache files of the whole range
+    if cache_key is None:
+        cache_key = "shared" if shared_cache else "{}-{}".format(start, end)
+    set_caches(root_folder, cache_key, offline=offline, cache_dir=cache_dir,
+               cache_backend=cache_backend, cache_limits=cache_limits, shared_cache=shared_cache)
+    enable_near_cache(near_cache)
 
     import os
     if os.path.exists(output_filename):
@@ -301,7 +559,7 @@ def story_writing(input_filename,
         print("Has Done {} item, left {} items to run".format(len(done_ques), len(filtered_items)))
         items = filtered_items
 
-    output_f = open(output_filename, "w", encoding="utf8")
+    output_f = open(output_filename, "a", encoding="utf8")
     print("Need Run {} items".format(len(items)), flush=True)
 
     for item in items:
@@ -332,15 +590,28 @@ def story_writing(input_filename,
         os.makedirs(folder, exist_ok=True)
         custom_format = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <level>{message}</level>"
         log_id = logger.add("{}/engine.log".format(folder), format=custom_format)
+        reset_cache_stats()
         try:
             # result = engine.forward_one_step_untill_done(save_folder=folder, to_run_check_str = check_str)
             result = engine.forward_one_step_untill_done(
-                save_folder=folder, nl=True, nodes_json_file=nodes_json_file)
+                save_folder=folder, nl=True, nodes_json_file=nodes_json_file,
+                parallel=parallel, max_workers=max_workers,
+                checkpoint_mode=checkpoint_mode, resume=resume,
+                bench_file="{}/bench.json".format(folder) if offline else None)
+            if offline:
+                # Some callers swallow the CacheMissError and retry, the counters catch them
+                check_offline_misses()
         except Exception as e:
             logger.error("Encounter exception: {}\nWhen Process {}".format(
                 traceback.format_exc(), question))
+            if offline:
+                raise
             continue
+        finally:
+            dump_cache_stats("{}/cache_stats.json".format(folder))
 
+        # The results are on disk before the item is recorded as done
+        flush_caches()
         item["result"] = result
         output_f.write(json.dumps(item, ensure_ascii=False) + "\n")
         output_f.flush()
@@ -348,6 +619,7 @@ def story_writing(input_filename,
         logger.remove(log_id)
 
     # output_f.close()
+    flush_caches()
     if done_flag_file is not None:
         with open(done_flag_file, "w") as f:
             f.write("done")
@@ -361,7 +633,19 @@ def report_writing(input_filename,
                    global_use_model,
                    searcher,
                    nodes_json_file=None,
-                   today_date=None):
+                   today_date=None,
+                   parallel=False,
+                   max_workers=4,
+                   checkpoint_mode="full",
+                   resume=False,
+                   cache_key=None,
+                   trace=False,
+                   offline=False,
+                   cache_dir=None,
+                   cache_backend="jsonl",
+                   cache_limits=None,
+                   shared_cache=False,
+                   near_cache=None):
     # Use current date if not provided
     if today_date is None:
         today_date = datetime.now().strftime("%b %d, %Y")
@@ -521,9 +805,15 @@ def report_writing(input_filename,
     import pathlib
     root_folder = "{}/{}".format(str(pathlib.Path(output_filename).parent.parent),
                                  "records")
-    caches["search"] = Cache("{}/../cache/{}-{}-search".format(root_folder,
-                             start, end))  # cache search and llm result
-    caches["llm"] = Cache("{}/../cache/{}-{}-llm".format(root_folder, start, end))
+    if trace:
+        # Each task folder gets a trace.json
+        tracer.enable()
+    # shards of a batch run share the cache files of the whole range
+    if cache_key is None:
+        cache_key = "shared" if shared_cache else "{}-{}".format(start, end)
+    set_caches(root_folder, cache_key, offline=offline, cache_dir=cache_dir,
+               cache_backend=cache_backend, cache_limits=cache_limits, shared_cache=shared_cache)
+    enable_near_cache(near_cache)
 
     import os
     if os.path.exists(output_filename):
@@ -562,16 +852,29 @@ def report_writing(input_filename,
 
         custom_format = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <level>{message}</level>"
         log_id = logger.add("{}/engine.log".format(folder), format=custom_format)
+        reset_cache_stats()
         try:
             result = engine.forward_one_step_untill_done(
-                save_folder=folder, nl=True, nodes_json_file=nodes_json_file)
+                save_folder=folder, nl=True, nodes_json_file=nodes_json_file,
+                parallel=parallel, max_workers=max_workers,
+                checkpoint_mode=checkpoint_mode, resume=resume,
+                bench_file="{}/bench.json".format(folder) if offline else None)
+            if offline:
+                # Some callers swallow the CacheMissError and retry, the counters catch them
+                check_offline_misses()
         except Exception as e:
             logger.error("Encounter exception: {}\nWhen Process {}".format(
                 traceback.format_exc(), question))
+            if offline:
+                raise
             continue
+        finally:
+            dump_cache_stats("{}/cache_stats.json".format(folder))
 
         result = get_report_with_ref(engine.root_node.to_json(), result)
 
+        # The results are on disk before the item is recorded as done
+        flush_caches()
         item["result"] = result
         output_f.write(json.dumps(item, ensure_ascii=False) + "\n")
         output_f.flush()
@@ -581,11 +884,107 @@ def report_writing(input_filename,
 
         logger.remove(log_id)
 
+    flush_caches()
     if done_flag_file is not None:
         with open(done_flag_file, "w") as f:
             f.write("done")
 
 
+def item_key(mode, item):
+    # The key used to judge whether an item is done, same as story_writing and report_writing
+    return item["ori"]["inputs"] if mode == "story" else item["prompt"]
+
+
+def run_shard(mode, kwargs):
+    if mode == "story":
+        story_writing(**kwargs)
+    else:
+        report_writing(**kwargs)
+
+
+def batch_writing(mode, input_filename, output_filename, start, end, done_flag_file,
+                  workers, **kwargs):
+    """
+    Shard the items across workers processes, each shard is run by story_writing or
+    report_writing with its own input and output file next to output_filename, all the
+    shards share the cache files and the records folder. The shard outputs are merged
+    into output_filename, including the ones left by an interrupted batch run, so each
+    shard resumes independently. A nodes_json_file becomes one file per shard, e.g.
+    nodes.shard0.json, nodes.shard1.json.
+    """
+    import pathlib
+    data = read_jsonl(input_filename)
+    start = 0 if start is None else start
+    end = len(data) if end is None else end
+    items = data[start:end]
+    output_path = pathlib.Path(output_filename)
+    shard_pattern = "{}.shard*.jsonl".format(output_path.stem)
+
+    def merge_shards():
+        merged = read_jsonl(output_filename) if os.path.exists(output_filename) else []
+        shard_files = sorted(str(fn) for fn in output_path.parent.glob(shard_pattern)
+                             if not str(fn).endswith(".input.jsonl"))
+        for shard_file in shard_files:
+            merged.extend(read_jsonl(shard_file))
+        # Keep the input order, the item finished last wins
+        key2item = {item_key(mode, item): item for item in merged}
+        order = {item_key(mode, item): idx for idx, item in enumerate(items)}
+        merged = sorted(key2item.values(),
+                        key=lambda item: order.get(item_key(mode, item), len(order)))
+        atomic_write(output_filename,
+                     "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in merged))
+        for fn in output_path.parent.glob(shard_pattern):
+            os.remove(str(fn))
+        return set(key2item.keys())
+
+    done_keys = merge_shards()
+    left_items = [item for item in items if item_key(mode, item) not in done_keys]
+    print("Has Done {} item, left {} items to run in {} workers".format(
+        len(items) - len(left_items), len(left_items), workers), flush=True)
+
+    shard_size = (len(left_items) + workers - 1) // workers
+    shard_args = []
+    for shard_idx in range(workers):
+        shard_items = left_items[shard_idx * shard_size: (shard_idx + 1) * shard_size]
+        if len(shard_items) == 0:
+            continue
+        shard_prefix = "{}/{}.shard{}".format(output_path.parent, output_path.stem, shard_idx)
+        shard_input = "{}.input.jsonl".format(shard_prefix)
+        with open(shard_input, "w", encoding="utf8") as f:
+            for item in shard_items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        shard_kwargs = dict(kwargs)
+        shard_kwargs.update({
+            "input_filename": shard_input,
+            "output_filename": "{}.jsonl".format(shard_prefix),
+            "start": None,
+            "end": None,
+            "done_flag_file": None,
+            "cache_key": "shared" if kwargs.get("shared_cache") else "{}-{}".format(start, end),
+            # The shards see each other's cached results as they are written
+            "shared_cache": True,
+        })
+        if kwargs.get("nodes_json_file"):
+            # Each shard shows the node tree of its own current item
+            nodes_json_path = pathlib.Path(kwargs["nodes_json_file"])
+            shard_kwargs["nodes_json_file"] = "{}/{}.shard{}{}".format(
+                nodes_json_path.parent, nodes_json_path.stem, shard_idx, nodes_json_path.suffix)
+        shard_args.append(shard_kwargs)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_shard, mode, shard_kwargs) for shard_kwargs in shard_args]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                logger.error("Shard worker failed: {}".format(traceback.format_exc()))
+
+    done_keys = merge_shards()
+    if done_flag_file is not None and all(item_key(mode, item) in done_keys for item in items):
+        with open(done_flag_file, "w") as f:
+            f.write("done")
+
+
 def define_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--filename", type=str, required=True)
@@ -603,18 +1002,111 @@ def define_args():
     parser.add_argument("--start", type=int, default=None)
     parser.add_argument("--end", type=int, default=None)
     parser.add_argument("--done-flag-file", type=str, default=None)
-    parser.add_argument("--need-continue", action="store_true")
+    parser.add_argument("--need-continue", action="store_true",
+                        help="Resume the interrupted items from the checkpoints in their "
+                             "record folders")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Execute all the activatable nodes of each step concurrently")
+    parser.add_argument("--max-workers", type=int, default=4,
+                        help="Maximum number of nodes executed concurrently in parallel mode")
+    parser.add_argument("--checkpoint-mode", type=str, choices=["full", "journal"], default="full",
+                        help="full: dump the whole tree every step; "
+                             "journal: append step deltas with periodic snapshots")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to shard the items across")
+    parser.add_argument("--offline", action="store_true",
+                        help="Replay a recorded run: serve every llm, search and web page call "
+                             "from the caches, fail on a miss, and write bench.json to each task "
+                             "folder")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="Folder of the cache files, default is the cache folder next to the "
+                             "records folder")
+    parser.add_argument("--cache-backend", type=str, default="jsonl", choices=["jsonl", "sqlite"],
+                        help="sqlite: indexed cache files, the existing jsonl caches are migrated "
+                             "on first open")
+    parser.add_argument("--cache-limits", type=json.loads, default=None,
+                        help='JSON overriding the cache bounds per name, e.g. '
+                             '{"search": {"ttl": 86400}, "llm": {"max_entries": 100000}}')
+    parser.add_argument("--shared-cache", action="store_true",
+                        help="the cache files in --cache-dir are shared by concurrent runs, which "
+                             "see each other's results as soon as they are written; the cache key "
+                             "defaults to 'shared'")
+    parser.add_argument("--near-cache", type=str, nargs="*", default=None,
+                        help="SITE[:THRESHOLD], llm call sites whose cache misses may reuse the "
+                             "result of a nearly identical prompt, e.g. selector summarizer:0.9 "
+                             "(default threshold 0.95)")
+    parser.add_argument("--http-pool-size", type=int, default=None,
+                        help="Keep-alive connections per llm base url, default LLM_HTTP_POOL_SIZE "
+                             "or 32; at least the concurrent llm calls (engine workers times "
+                             "selector threads)")
+    parser.add_argument("--llm-retry-deadline", type=float, default=None,
+                        help="Seconds an llm call is retried for with exponential backoff, "
+                             "default LLM_RETRY_DEADLINE or 600")
+    parser.add_argument("--rate-limit", type=str, nargs="*", default=None,
+                        help="PROVIDER[/MODEL]:rpm=N,tpm=N, client side limits of the llm calls "
+                             "shared by all the threads of the run, e.g. "
+                             "OpenAI/gpt-4o:rpm=500,tpm=30000 Anthropic:rpm=50")
+    parser.add_argument("--rate-limit-dir", type=str, default=None,
+                        help="Keep the --rate-limit buckets in files of this folder, shared by all "
+                             "the processes of the host")
+    parser.add_argument("--trace", action="store_true",
+                        help="Record spans of the run and export trace.json (Chrome trace format) "
+                             "to each task folder")
     return parser
 
 
 if __name__ == "__main__":
     parser = define_args()
     args = parser.parse_args()
-    if args.mode == "story":
+    if args.http_pool_size is not None:
+        # The environment carries it to the batch_writing shard processes
+        os.environ["LLM_HTTP_POOL_SIZE"] = str(args.http_pool_size)
+        configure_http_pool(args.http_pool_size)
+    if args.llm_retry_deadline is not None:
+        os.environ["LLM_RETRY_DEADLINE"] = str(args.llm_retry_deadline)
+        configure_retry(deadline=args.llm_retry_deadline)
+    if args.rate_limit is not None or args.rate_limit_dir is not None:
+        if args.rate_limit is not None:
+            os.environ["LLM_RATE_LIMITS"] = " ".join(args.rate_limit)
+        if args.rate_limit_dir is not None:
+            os.environ["LLM_RATE_LIMIT_DIR"] = args.rate_limit_dir
+        configure_rate_limits(os.getenv("LLM_RATE_LIMITS", "").split(),
+                              os.getenv("LLM_RATE_LIMIT_DIR") or None)
+    if args.workers > 1:
+        kwargs = {
+            "global_use_model": args.model,
+            "nodes_json_file": args.nodes_json_file,
+            "parallel": args.parallel,
+            "max_workers": args.max_workers,
+            "checkpoint_mode": args.checkpoint_mode,
+            "resume": args.need_continue,
+            "trace": args.trace,
+            "offline": args.offline,
+            "cache_dir": args.cache_dir,
+            "cache_backend": args.cache_backend,
+            "cache_limits": args.cache_limits,
+            "shared_cache": args.shared_cache,
+            "near_cache": args.near_cache,
+        }
+        if args.mode == "report":
+            kwargs.update({"searcher": args.searcher, "today_date": args.today_date})
+        batch_writing(args.mode, args.filename, args.output_filename,
+                      args.start, args.end, args.done_flag_file, args.workers, **kwargs)
+    elif args.mode == "story":
         story_writing(args.filename, args.output_filename,
                       args.start, args.end, args.done_flag_file, args.model,
-                      nodes_json_file=args.nodes_json_file)
+                      nodes_json_file=args.nodes_json_file,
+                      parallel=args.parallel, max_workers=args.max_workers,
+                      checkpoint_mode=args.checkpoint_mode, resume=args.need_continue,
+                      trace=args.trace, offline=args.offline, cache_dir=args.cache_dir,
+                      cache_backend=args.cache_backend, cache_limits=args.cache_limits,
+                      shared_cache=args.shared_cache, near_cache=args.near_cache)
     else:
         report_writing(args.filename, args.output_filename,
                        args.start, args.end, args.done_flag_file, args.model, args.searcher,
-                       nodes_json_file=args.nodes_json_file, today_date=args.today_date)
+                       nodes_json_file=args.nodes_json_file, today_date=args.today_date,
+                       parallel=args.parallel, max_workers=args.max_workers,
+                       checkpoint_mode=args.checkpoint_mode, resume=args.need_continue,
+                       trace=args.trace, offline=args.offline, cache_dir=args.cache_dir,
+                       cache_backend=args.cache_backend, cache_limits=args.cache_limits,
+                       shared_cache=args.shared_cache, near_cache=args.near_cache)
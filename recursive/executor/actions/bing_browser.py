@@ -1,7 +1,9 @@
 import json
+import hashlib
 import logging
 import os
 import warnings
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import concurrent
 from typing import List, Optional, Tuple, Type, Union
@@ -13,8 +15,11 @@ from recursive.executor.actions.parser import BaseParser, JsonParser
 from recursive.executor.actions.register import tool_register
 from recursive.executor.actions.selector_and_summazier import selector, summarizier
 from recursive.memory import caches
+from recursive.cache import CacheMissError
+from recursive.utils.tracer import tracer
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+import trafilatura
 from trafilatura import extract
 import httpx
 import concurrent.futures
@@ -24,6 +29,38 @@ from dotenv import load_dotenv
 
 load_dotenv(dotenv_path='api_key.env')
 
+# Part of the extraction cache key, bump it when the extract options change
+EXTRACTOR_VERSION = "trafilatura-{}-txt-tables".format(trafilatura.__version__)
+
+# How long a failed fetch is remembered, in seconds, by error class. Until then the url
+# is skipped instead of paying the timeout again.
+NEGATIVE_TTL = {
+    "http_4xx": 24 * 3600,
+    "http_429": 300,
+    "http_5xx": 600,
+    "timeout": 3600,
+    "connect": 3600,
+    "other": 1800,
+}
+
+
+def page_digest(text):
+    # The digest of the page in the blob store
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def fetch_error_class(exc):
+    if isinstance(exc, httpx.HTTPStatusError):
+        status_code = exc.response.status_code
+        if status_code == 429:
+            return "http_429"
+        return "http_4xx" if status_code < 500 else "http_5xx"
+    if isinstance(exc, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(exc, httpx.ConnectError):
+        return "connect"
+    return "other"
+
 
 class WebPageHelper:
     """Helper class to process web pages.
@@ -179,7 +216,9 @@ class WebPageHelper:
             ],
         )
 
+    @tracer.trace("WebPageHelper.download_webpage", cat="fetch")
     def download_webpage(self, url: str, overwrite_cache=False):
+        tracer.annotate(url=url)
         # cached
         web_page_cache = caches["web_page"]
         # Load Cache
@@ -188,13 +227,24 @@ class WebPageHelper:
             "url": url,
         }
 
-        if web_page_cache is not None and not overwrite_cache:
-            cache_result = web_page_cache.get_cache(
-                name=cache_name,
-                call_args_dict=call_args_dict
-            )
-            if cache_result is not None:
-                return cache_result["result"]
+        cache_key = None
+        if web_page_cache is not None:
+            cache_key = web_page_cache.make_key(cache_name, call_args_dict)
+        if web_page_cache is not None and (not overwrite_cache or web_page_cache.strict):
+            # Each fetch counts once in the stats: a negative as a hit of the failures, else a
+            # hit or a miss of the pages
+            error = self.cached_fetch_error(web_page_cache, url, cache_key)
+            if error is not None:
+                tracer.annotate(cache="negative", error=error)
+                return None
+            text = self.cached_webpage(web_page_cache, cache_key)
+            if text is not None:
+                tracer.annotate(cache="hit")
+                return text
+            if web_page_cache.strict:
+                web_page_cache.misses += 1
+                raise CacheMissError(web_page_cache.fn, cache_name, cache_key)
+        tracer.annotate(cache="miss")
 
         try:
             import random
@@ -202,6 +252,7 @@ class WebPageHelper:
                 res = client.get(url, timeout=4)
             if res.status_code >= 400:
                 res.raise_for_status()
+            tracer.annotate(status_code=res.status_code, bytes=len(res.content))
             encoding = detect(res.content)['encoding']
             res.encoding = encoding
             # save cache
@@ -209,31 +260,162 @@ class WebPageHelper:
                 web_page_cache.save_cache(
                     name=cache_name,
                     call_args_dict=call_args_dict,
-                    value={"result": res.text}
+                    value=({"result": res.text} if web_page_cache.blob_store is None
+                           else web_page_cache.put_blob(res.text)),
+                    key=cache_key
                 )
             return res.text
         except httpx.HTTPError as exc:
-            logger.error(f"Error while requesting {exc.request.url!r} - {exc!r}")
+            tracer.annotate(error=repr(exc))
+            logger.error(f"Error while requesting {url!r} - {exc!r}")
+            if web_page_cache is None:
+                return None
+            # A failed refetch keeps the page fetched before, and is not remembered as a failure
+            text = self.page_text(web_page_cache, web_page_cache.get(cache_key))
+            if text is not None:
+                return text
+            error = fetch_error_class(exc)
+            web_page_cache.save_cache(
+                name=self.FETCH_ERROR_CACHE_NAME,
+                call_args_dict={"url": url, "error": error},
+                value={"error": error, "failed_at": time.time()}
+            )
+            return None
+
+    # Failures are cached apart from the pages, by url and error class
+    FETCH_ERROR_CACHE_NAME = "WebPageHelper.download_webpage.error"
+
+    def cached_webpage(self, web_page_cache, cache_key):
+        """
+        The page cached under cache_key, None if there is none
+        """
+        cache_result = web_page_cache.get_cache(name="WebPageHelper.download_webpage",
+                                                call_args_dict=None, key=cache_key, strict=False)
+        return self.page_text(web_page_cache, cache_result)
+
+    def page_text(self, web_page_cache, cache_result):
+        if cache_result is None or "error" in cache_result:
+            return None
+        # Legacy entries hold the page, the others its digest in the blob store
+        if "result" in cache_result:
+            return cache_result["result"]
+        text = web_page_cache.get_blob(cache_result["blob"])
+        if text is None:
+            logger.warning(f"Missing web page blob {cache_result['blob']}")
+        return text
+
+    def cached_fetch_error(self, web_page_cache, url, cache_key):
+        """
+        The class of a recent failure to fetch url, None if there is none or the page is cached.
+        Offline replay repeats the recorded failures whatever their age
+        """
+        page = web_page_cache.get(cache_key)
+        if page is not None and "error" not in page:
+            return None
+        # Older caches hold the failures under the page key
+        results = [page]
+        for error in NEGATIVE_TTL:
+            key = web_page_cache.make_key(self.FETCH_ERROR_CACHE_NAME, {"url": url, "error": error})
+            results.append(web_page_cache.get(key))
+        for cache_result in results:
+            if cache_result is None or "error" not in cache_result:
+                continue
+            age = time.time() - cache_result["failed_at"]
+            ttl = NEGATIVE_TTL.get(cache_result["error"], NEGATIVE_TTL["other"])
+            if web_page_cache.strict or age < ttl:
+                web_page_cache.record(self.FETCH_ERROR_CACHE_NAME, hits=1)
+                return cache_result["error"]
+        return None
+
+    def extract_article(self, html):
+        return extract(
+            html,
+            # include_tables=False,
+            include_tables=True,
+            include_comments=False,
+            output_format="txt",
+        )
+
+    EXTRACT_CACHE_NAME = "WebPageHelper.extract_article"
+
+    def cached_page_digest(self, web_page_cache, url):
+        """
+        The digest of the page of url in the cache, None if it is not cached. Not counted in
+        the stats, the download counts the page lookups
+        """
+        cache_result = web_page_cache.get(web_page_cache.make_key(
+            "WebPageHelper.download_webpage", {"url": url}))
+        if cache_result is None or "error" in cache_result:
             return None
+        if "blob" in cache_result:
+            return cache_result["blob"]
+        return page_digest(cache_result["result"])
+
+    def cached_extraction(self, web_page_cache, url, digest):
+        cache_result = web_page_cache.get_cache(
+            name=self.EXTRACT_CACHE_NAME,
+            call_args_dict={"url": url, "extractor": EXTRACTOR_VERSION, "page": digest},
+            strict=False
+        )
+        if cache_result is None:
+            return None
+        if "text" in cache_result:
+            return cache_result["text"]
+        return web_page_cache.get_blob(cache_result["blob"])
 
     def urls_to_articles(self, urls):
+        """
+        The extracted text is cached by url, EXTRACTOR_VERSION and the digest of the page in
+        the web_page cache, a hit skips both the download and the extraction, a page fetched
+        again with another content is extracted again. Each url counts once in the stats of
+        the extractions, a miss falls back to download_webpage which counts its own lookup.
+        """
+        web_page_cache = caches["web_page"]
+        extracted = {}
+        digests = {}
+        if web_page_cache is not None:
+            for u in urls:
+                digests[u] = self.cached_page_digest(web_page_cache, u)
+                if digests[u] is None:
+                    # Looked up once the page is downloaded
+                    continue
+                text = self.cached_extraction(web_page_cache, u, digests[u])
+                if text is not None:
+                    extracted[u] = text
+
+        missed_urls = [u for u in urls if u not in extracted]
         with concurrent.futures.ThreadPoolExecutor(
             max_workers=self.max_thread_num
         ) as executor:
-            htmls = list(executor.map(self.download_webpage, urls))
-
-        articles = {}
+            htmls = list(executor.map(self.download_webpage, missed_urls))
 
-        for h, u in zip(htmls, urls):
+        for h, u in zip(htmls, missed_urls):
             if h is None:
                 continue
-            article_text = extract(
-                h,
-                # include_tables=False,
-                include_tables=True,
-                include_comments=False,
-                output_format="txt",
-            )
+            digest = page_digest(h)
+            if web_page_cache is not None and digests[u] is None:
+                article_text = self.cached_extraction(web_page_cache, u, digest)
+                if article_text is not None:
+                    extracted[u] = article_text
+                    continue
+            with tracer.span("WebPageHelper.extract_article", cat="fetch", url=u, bytes=len(h)):
+                article_text = self.extract_article(h)
+            extracted[u] = article_text if article_text is not None else ""
+            if web_page_cache is not None:
+                text = extracted[u]
+                if web_page_cache.blob_store is None:
+                    value = {"text": text, "chars": len(text)}
+                else:
+                    value = {**web_page_cache.put_blob(text), "chars": len(text)}
+                web_page_cache.save_cache(
+                    name=self.EXTRACT_CACHE_NAME,
+                    call_args_dict={"url": u, "extractor": EXTRACTOR_VERSION, "page": digest},
+                    value=value
+                )
+
+        articles = {}
+        for u in urls:
+            article_text = extracted.get(u)
             if article_text is not None and len(article_text) > self.min_char_count:
                 articles[u] = {"text": article_text}
 
@@ -320,7 +502,9 @@ class SerpApiSearch(BaseSearch):
         self.usage = 0
         return {"SerpApiSearch": usage}
 
+    @tracer.trace("SerpApiSearch.search", cat="search")
     def search(self, query, exclude_urls: List[str] = [], overwrite_cache=False):
+        tracer.annotate(query=query)
         search_cache = caches["search"]
         cache_name = "SerpApiSearch"
         call_args_dict = {
@@ -331,15 +515,20 @@ class SerpApiSearch(BaseSearch):
         print("overwrite_cache", overwrite_cache)
 
         url_to_results = {}
-        if search_cache is not None and not overwrite_cache:
+        cache_key = None
+        if search_cache is not None:
+            cache_key = search_cache.make_key(cache_name, call_args_dict)
+        if search_cache is not None and (not overwrite_cache or search_cache.strict):
             cache_result = search_cache.get_cache(
                 name=cache_name,
-                call_args_dict=call_args_dict
+                call_args_dict=call_args_dict,
+                key=cache_key
             )
             if cache_result is not None:
                 url_to_results = cache_result
 
         # No Cache, True Call
+        tracer.annotate(cache="hit" if len(url_to_results) > 0 else "miss")
         if len(url_to_results) == 0:
             queries = [query]
             self.usage += len(queries)
@@ -367,7 +556,8 @@ class SerpApiSearch(BaseSearch):
                 search_cache.save_cache(
                     name=cache_name,
                     call_args_dict=call_args_dict,
-                    value=url_to_results
+                    value=url_to_results,
+                    key=cache_key
                 )
         results = sorted(list(url_to_results.values()), key=lambda x: x["position"])
         pos2results = {}
@@ -434,7 +624,9 @@ class Searxng(BaseSearch):
         self.usage = 0
         return {"Searxng": usage}
 
+    @tracer.trace("Searxng.search", cat="search")
     def search(self, query, exclude_urls: List[str] = [], overwrite_cache=False):
+        tracer.annotate(query=query)
         search_cache = caches["search"]
         cache_name = "Searxng"
         call_args_dict = {
@@ -445,15 +637,20 @@ class Searxng(BaseSearch):
         print("overwrite_cache", overwrite_cache)
 
         url_to_results = {}
-        if search_cache is not None and not overwrite_cache:
+        cache_key = None
+        if search_cache is not None:
+            cache_key = search_cache.make_key(cache_name, call_args_dict)
+        if search_cache is not None and (not overwrite_cache or search_cache.strict):
             cache_result = search_cache.get_cache(
                 name=cache_name,
-                call_args_dict=call_args_dict
+                call_args_dict=call_args_dict,
+                key=cache_key
             )
             if cache_result is not None:
                 url_to_results = cache_result
 
         # No Cache, True Call
+        tracer.annotate(cache="hit" if len(url_to_results) > 0 else "miss")
         if len(url_to_results) == 0:
             queries = [query]
             self.usage += len(queries)
@@ -482,7 +679,8 @@ class Searxng(BaseSearch):
                 search_cache.save_cache(
                     name=cache_name,
                     call_args_dict=call_args_dict,
-                    value=url_to_results
+                    value=url_to_results,
+                    key=cache_key
                 )
         results = sorted(list(url_to_results.values()), key=lambda x: x["position"])
 
@@ -648,12 +846,16 @@ class BingBrowser(BaseAction):
         return new_search_results
 
     def __select_and_summarize(self, search_results, question, think, N, query_list):
-        search_results = selector(search_results, question, think, N, query_list,
-                                  self.language, self.selector_max_workers,
-                                  self.selector_model)
-        search_results = summarizier(search_results, question, think,
-                                     self.language, self.summarizier_max_workers,
-                                     self.summarizer_model)
+        with tracer.span("selector", cat="search", pages=len(search_results),
+                         model=self.selector_model):
+            search_results = selector(search_results, question, think, N, query_list,
+                                      self.language, self.selector_max_workers,
+                                      self.selector_model)
+        with tracer.span("summarizier", cat="search", pages=len(search_results),
+                         model=self.summarizer_model):
+            search_results = summarizier(search_results, question, think,
+                                         self.language, self.summarizier_max_workers,
+                                         self.summarizer_model)
         return search_results
 
     @tool_api()
@@ -696,9 +898,13 @@ class BingBrowser(BaseAction):
             "searcher": self.searcher_name,
         }
 
+        # A miss falls back to the search, fetch and llm calls, which are cached by themselves
+        cache_key = search_cache.make_key(cache_name, call_args_dict)
         cache_result = search_cache.get_cache(
             name=cache_name,
-            call_args_dict=call_args_dict
+            call_args_dict=call_args_dict,
+            strict=False,
+            key=cache_key
         )
 
         # disable cache
@@ -737,7 +943,8 @@ class BingBrowser(BaseAction):
             search_cache.save_cache(
                 name=cache_name,
                 call_args_dict=call_args_dict,
-                value=default_result
+                value=default_result,
+                key=cache_key
             )
             return default_result
 
@@ -771,7 +978,8 @@ class BingBrowser(BaseAction):
         search_cache.save_cache(
             name=cache_name,
             call_args_dict=call_args_dict,
-            value=search_result
+            value=search_result,
+            key=cache_key
         )
 
         return search_result
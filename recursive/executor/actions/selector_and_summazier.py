@@ -4,6 +4,7 @@ import tqdm
 from concurrent.futures import ThreadPoolExecutor
 import threading
 from recursive.llm.llm import OpenAIApiProxy
+from recursive.utils.tracer import tracer
 import time
 from recursive.utils.file_io import parse_hierarchy_tags_result
 from loguru import logger
@@ -88,7 +89,9 @@ Agent正在通过多轮的搜索解决用户问题，你将对**其中一轮搜
     # def predict_with_cache(self, *args, **kwargs):
     #     return es_cache.call_with_cache(self.predict, *args, **kwargs)
 
+    @tracer.trace("EvidenceSelector.predict", cat="search")
     def predict(self, page, temperature=0.01, max_new_tokens=10, do_sample=False):
+        tracer.annotate(url=page.get("url"))
 
         # 发送 POST 请求
         cnt = 0
@@ -100,7 +103,9 @@ Agent正在通过多轮的搜索解决用户问题，你将对**其中一轮搜
                     {"role": "user", "content": page["to_run_prompt"]},
                     
                 ]
-                response = self.llm.call(messages=msg, model=self.model, overwrite_cache = (cnt > 0 or cnt2 > 0))
+                response = self.llm.call(messages=msg, model=self.model,
+                                         overwrite_cache=(cnt > 0 or cnt2 > 0),
+                                         near_cache_site="selector")
                 if response is None:
                     page["select_response"] = ""
                     page["judgement"] =  0
@@ -257,7 +262,9 @@ Organize and extract as required, focusing solely on the webpage content itself.
     # def predict_with_cache(self, *args, **kwargs):
     #     return es_cache.call_with_cache(self.predict, *args, **kwargs)
 
+    @tracer.trace("Summarizier.predict", cat="search")
     def predict(self, page, temperature=0.01, max_new_tokens=10, do_sample=False):
+        tracer.annotate(url=page.get("url"))
 
         # 发送 POST 请求
         cnt = 0
@@ -267,7 +274,8 @@ Organize and extract as required, focusing solely on the webpage content itself.
                     {"role": "system", "content": self.en_sys_pe if self.language == "en" else self.zh_sys_pe},
                     {"role": "user", "content": page["to_run_prompt"]},
                 ]
-                response = self.llm.call(messages=msg, model=self.model, overwrite_cache=(cnt > 0))
+                response = self.llm.call(messages=msg, model=self.model, overwrite_cache=(cnt > 0),
+                                         near_cache_site="summarizer")
                 
                 if response is None:
                     page["summarizier_response"] = ""
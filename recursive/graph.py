@@ -4,6 +4,7 @@ from enum import Enum
 from typing import List, Dict
 from recursive.utils.register import Register
 from recursive.agent.proxy import AgentProxy
+from recursive.utils.tracer import tracer
 from abc import ABC, abstractmethod
 from datetime import datetime
 from overrides import overrides
@@ -151,25 +152,57 @@ class AbstractNode(ABC):
         self.raw_plan = None # raw plan returned by planner, represented in JSON format
         self.node_type = node_type  # Node type
         self.status = TaskStatus.NOT_READY  # Execution status, default is NOT_READY
-        self.agent_proxy = AgentProxy(config)
         
         # Result
         self.result = {}
         
-        # -------- States -------
-        self.status_list = {
-            "silence": [],
-            "suspend": [],
-            "activate": []
-        }
+        self.compile_status()
 
-        # Status-Condtion-Action-NextStatus mapping
-        self.status_action_mapping = {}
-        # Status-Condtion-NextStatus mapping
-        self.status_exam_mapping = {}
-        
+    # -------- States -------
+    # The status tables only depend on the node class, define_status is called
+    # once per class and its tables are shared by all the nodes of the class
+    status_list = {
+        "silence": [],
+        "suspend": [],
+        "activate": []
+    }
+    # Status-Condtion-Action-NextStatus mapping
+    status_action_mapping = {}
+    # Status-Condtion-NextStatus mapping
+    status_exam_mapping = {}
+
+    STATUS_TABLES = ("status_list", "status_action_mapping", "status_exam_mapping")
+
+    def compile_status(self):
+        cls = self.__class__
+        if cls.__dict__.get("_status_compiled", False):
+            return
         self.define_status()
         self.check_status_valid()
+        for name in self.STATUS_TABLES:
+            setattr(cls, name, self.__dict__.pop(name))
+        cls._status_compiled = True
+
+    @property
+    def agent_proxy(self):
+        # One AgentProxy per tree, held by the root node, so it goes away with the tree
+        root_node = self.node_graph_info["root_node"] or self
+        agent_proxy = root_node.__dict__.get("_agent_proxy")
+        if agent_proxy is None or agent_proxy.config is not self.config:
+            agent_proxy = root_node._agent_proxy = AgentProxy(self.config)
+        return agent_proxy
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("_agent_proxy", None)
+        return state
+
+    def __setstate__(self, state):
+        # Nodes pickled by older versions carry their own status tables and AgentProxy
+        for name in self.STATUS_TABLES + ("agent_proxy",):
+            state.pop(name, None)
+        self.__dict__.update(state)
+        self.compile_status()
  
     @property
     def required_task_info_keys(self):
@@ -353,6 +386,17 @@ class AbstractNode(ABC):
     
         return action_name, result
 
+    def next_action_name(self, memory, *args, **kwargs):
+        """
+        The action next_action_step would do, None if the node is not activate
+        """
+        if not self.is_activate:
+            return None
+        for condition_func, action_name, next_status in self.status_action_mapping[self.status]:
+            if condition_func(self, memory, *args, **kwargs):
+                return action_name
+        return None
+
     # ======= Exam =======
     def do_exam(self, verbose):
         if not self.is_suspend:
@@ -505,9 +549,11 @@ class AbstractNode(ABC):
     
     def do_action(self, action_name, memory, *args, **kwargs):
         agent = self.agent_proxy.proxy(action_name)
-        result = getattr(self, action_name)(
-            agent, memory, *args, **kwargs   
-        )
+        with tracer.span(action_name, cat="agent", hashkey=self.hashkey, nid=self.nid,
+                         agent=self.config["action_mapping"][action_name][0]):
+            result = getattr(self, action_name)(
+                agent, memory, *args, **kwargs
+            )
         # Saving information
         self.result[action_name] = {
             "result": result,
@@ -4,13 +4,19 @@ import json
 import os
 import requests
 from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
-import copy
 # import boto3
 from botocore.config import Config
-import time
+import threading
+from urllib.parse import urlsplit
 from loguru import logger
 from recursive.memory import caches
+from recursive.cache import CacheMissError
+from recursive.near_cache import near_cache_sites, near_lookup, near_add
+from recursive.utils.tracer import tracer
+from recursive.llm.retry import default_retry_policy
+from recursive.llm.rate_limit import get_limiter, estimate_tokens
+from recursive.llm.stream import (
+    emit, read_openai_stream, read_anthropic_stream, read_client_stream, read_gemini_stream)
 from dotenv import load_dotenv
 import google.generativeai as genai
 from openai import OpenAI
@@ -63,21 +69,128 @@ def format_tool_response_to_claude(tool_response):
     return response_new
 
 
+# Keep-alive sessions shared by all the OpenAIApiProxy instances of the process, one per base url,
+# their pools hold http_pool_size connections, set it to the number of concurrent llm calls
+http_pool_size = int(os.getenv("LLM_HTTP_POOL_SIZE", 32))
+sessions = {}
+openai_clients = {}
+sessions_lock = threading.Lock()
+
+
+def configure_http_pool(pool_size):
+    """
+    Resize the pools, the sessions opened so far are replaced
+    """
+    global http_pool_size
+    with sessions_lock:
+        http_pool_size = pool_size
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+def get_session(url):
+    parts = urlsplit(url)
+    base_url = "{}://{}".format(parts.scheme, parts.netloc)
+    with sessions_lock:
+        session = sessions.get(base_url)
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=http_pool_size)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            sessions[base_url] = session
+        return session
+
+
+def get_openai_client(base_url, api_key):
+    with sessions_lock:
+        client = openai_clients.get((base_url, api_key))
+        if client is None:
+            client = OpenAI(base_url=base_url, api_key=api_key)
+            openai_clients[(base_url, api_key)] = client
+        return client
+
+
+# Base url of a provider without a <provider>_BASE_URL env, Mock is the local load testing
+# server of recursive.llm.mock
+DEFAULT_BASE_URLS = {"Mock": "http://127.0.0.1:8765/v1"}
+
+# OpenAI compatible providers known to accept stream_options, the others stream without the usage
+STREAM_USAGE_PROVIDERS = ("OpenAI", "DeepSeek", "QWen", "Mock")
+
+LLM_CACHE_NAME = "OpenAIApiProxy.call"
+
+
+def lookup_cache(llm_cache, call_args_dict, cache_key, near_site, stream_callback):
+    """
+    The cached result of a call, exact or near duplicate, None on a miss. A hit is replayed to
+    stream_callback as one delta.
+    """
+    cache_result = llm_cache.get_cache(LLM_CACHE_NAME, call_args_dict, key=cache_key,
+                                       strict=False if near_site is not None else None)
+    if cache_result is not None:
+        tracer.annotate(cache="hit")
+    elif near_site is not None:
+        cache_result = near_lookup(llm_cache, near_site, call_args_dict)
+        if cache_result is None:
+            if llm_cache.strict:
+                llm_cache.misses += 1
+                raise CacheMissError(llm_cache.fn, LLM_CACHE_NAME, cache_key)
+            return None
+        tracer.annotate(cache="near")
+        llm_cache.record(LLM_CACHE_NAME, near_hits=1)
+        # Stored under the exact key too, the replays and the next runs hit it exactly
+        llm_cache.save_cache(LLM_CACHE_NAME, call_args_dict, cache_result, key=cache_key)
+    else:
+        return None
+    if stream_callback is not None:
+        content = cache_result[0]["message"]["content"]
+        emit(stream_callback, content, content)
+    return cache_result
+
+
+def acquire_limit(provider, model, messages):
+    """
+    Wait for the rate limits of the provider and model, (limiter, estimated tokens) to
+    reconcile once the usage is known
+    """
+    limiter = get_limiter(provider, model)
+    if limiter is None:
+        return None, 0
+    estimated_tokens = estimate_tokens(messages)
+    limiter.acquire(estimated_tokens)
+    return limiter, estimated_tokens
+
+
+def reconcile_limit(limiter, estimated_tokens, used_tokens):
+    if limiter is not None and used_tokens is not None:
+        limiter.reconcile(estimated_tokens, used_tokens)
+
+
+def store_result(llm_cache, call_args_dict, cache_key, near_site, result):
+    # llm_cache is None for the no_cache calls
+    if llm_cache is None:
+        return
+    llm_cache.save_cache(LLM_CACHE_NAME, call_args_dict, result, key=cache_key)
+    if near_site is not None:
+        near_add(llm_cache, near_site, call_args_dict, cache_key)
+
+
+def read_response(response, use_official, stream_callback):
+    if stream_callback is None:
+        return response.json()
+    if use_official == "anthropic":
+        return read_anthropic_stream(response, stream_callback)
+    return read_openai_stream(response, stream_callback)
+
+
 class OpenAIApiProxy():
-    def __init__(self, verbose=True):
-        retry_strategy = Retry(
-            total=5,  # Maximum number of retry attempts (including the initial request)
-            backoff_factor=1,  # Wait time factor between retries
-            status_forcelist=[429, 500, 502, 503, 504],  # List of status codes that require retry
-            allowed_methods=["POST"]  # Only retry POST requests
-        )
-        adapter = HTTPAdapter()
-        self.session = requests.Session()
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
-        self.MAX_RETRIES = 100
-        self.BACKOFF_FACTOR = 0.1
-        self.RETRY_CODES = (400, 401, 429, 404, 500, 502, 503, 504, 529)
+    def __init__(self, verbose=True, retry_policy=None):
+        """
+        retry_policy: recursive.llm.retry.RetryPolicy, default_retry_policy when None
+        """
+        self.retry_policy = retry_policy if retry_policy is not None else default_retry_policy
         self.verbose = verbose
 
     def call_embedding(self, model, text):
@@ -93,41 +206,30 @@ class OpenAIApiProxy():
             "encoding_format": "float",
         }
 
-        for attempt in range(self.MAX_RETRIES):
-            current_headers = headers.copy()
-            try:
-                response = self.session.post(
-                    url,
-                    headers=current_headers,
-                    json=params_gpt,
-                    timeout=300,
-                    proxies=None
-                )
-                if response.status_code not in self.RETRY_CODES:
-                    response.raise_for_status()
-                    break  # Successful response, exit the loop
-                else:
-                    # print(f"Received status code {response.status_code} at attempt={attempt + 1}. Retrying... {current_headers['x-api-key']=}")
-                    print(
-                        f"Received status code {response.status_code} at attempt={attempt + 1}. Retrying..., the response is {response.text}", flush=True)
-
-            except requests.exceptions.RequestException as e:
-                print(f"Error making request (attempt {attempt + 1}): {e}", flush=True)
-                if attempt == self.MAX_RETRIES - 1:  # Last attempt
-                    raise  # Re-raise the last exception if all attempts fail
-
-            # Implement exponential backoff
-            if attempt < self.MAX_RETRIES - 1:  # No need to sleep after the last attempt
-                sleep_time = self.BACKOFF_FACTOR
-                print(f"Waiting for {sleep_time} seconds before next attempt...", flush=True)
-                time.sleep(sleep_time)
+        response = self.retry_policy.run(
+            lambda timeout: get_session(url).post(url, headers=headers, json=params_gpt,
+                                                  timeout=timeout, proxies=None),
+            describe="Embedding {}".format(model))
+        response.raise_for_status()
 
         data = response.json()
         return data
 
-    def call(self, model, messages, no_cache=False, overwrite_cache=False, tools=None, temperature=None, headers={}, use_official=None, **kwargs):
+    @tracer.trace("OpenAIApiProxy.call", cat="llm")
+    def call(self, model, messages, no_cache=False, overwrite_cache=False, tools=None,
+             temperature=None, headers={}, use_official=None, near_cache_site=None,
+             retry_deadline=None, stream_callback=None, **kwargs):
+        """
+        near_cache_site: label of the call site, when enabled in recursive.near_cache an exact
+        cache miss may be served by a call with a nearly identical prompt
+        retry_deadline: seconds the http call may be retried for, the deadline of the retry
+        policy when None
+        stream_callback: on_delta(delta, text), stream the response, see recursive.llm.stream
+        """
         assert tools is None
-        messages = copy.deepcopy(messages)
+        tracer.annotate(model=model)
+        # The anthropic branch pops the system message, the caller's list is left alone
+        messages = list(messages)
 
         is_gpt = True if "gpt" in model or "o1" in model else False
 
@@ -135,7 +237,8 @@ class OpenAIApiProxy():
         model = model.split("/")[1]
 
         api_key = str(os.getenv(provider+"_KEY"))
-        url = str(os.getenv(provider+"_BASE_URL")) + "/chat/completions"
+        base_url = os.getenv(provider+"_BASE_URL", DEFAULT_BASE_URLS.get(provider))
+        url = str(base_url) + "/chat/completions"
         params_gpt = {
             "model": model,
             "messages": messages,
@@ -181,15 +284,22 @@ class OpenAIApiProxy():
 
         # Cache
 
+        llm_cache, call_args_dict, cache_key, near_site = None, None, None, None
         if not no_cache:
-            cache_name = "OpenAIApiProxy.call"
-            from copy import deepcopy
-            call_args_dict = deepcopy(params_gpt)
+            call_args_dict = {**params_gpt, "messages": list(messages)}
             llm_cache = caches["llm"]
-            if not overwrite_cache:
-                cache_result = llm_cache.get_cache(cache_name, call_args_dict)
+            cache_key = llm_cache.make_key(LLM_CACHE_NAME, call_args_dict)
+            near_site = near_cache_site if near_cache_site in near_cache_sites else None
+            # Offline replay serves the retries from the cache as well
+            if not overwrite_cache or llm_cache.strict:
+                cache_result = lookup_cache(llm_cache, call_args_dict, cache_key, near_site,
+                                            stream_callback)
                 if cache_result is not None:
                     return cache_result
+            tracer.annotate(cache="miss")
+
+        # Only the calls going to the provider count against its limits
+        limiter, estimated_tokens = acquire_limit(provider, model, messages)
 
         if use_official == 'anthropic':
             headers = {
@@ -206,11 +316,8 @@ class OpenAIApiProxy():
                 site_url = os.getenv('OPENROUTER_REFERER', '')
                 site_name = os.getenv('OPENROUTER_TITLE', '')
 
-                # Initialize OpenAI client with OpenRouter base URL
-                client = OpenAI(
-                    base_url="https://openrouter.ai/api/v1",
-                    api_key=api_key,
-                )
+                # OpenAI client with OpenRouter base URL, shared like the sessions
+                client = get_openai_client("https://openrouter.ai/api/v1", api_key)
 
                 # Prepare extra headers
                 extra_headers = {}
@@ -220,6 +327,8 @@ class OpenAIApiProxy():
                     extra_headers["X-Title"] = site_name
 
                 # Create completion
+                if stream_callback is not None:
+                    kwargs = {**kwargs, "stream": True, "stream_options": {"include_usage": True}}
                 completion = client.chat.completions.create(
                     extra_headers=extra_headers,
                     model=model,  # e.g. "google/gemini-2.5-pro-preview"
@@ -228,16 +337,23 @@ class OpenAIApiProxy():
                     **kwargs
                 )
 
+                if stream_callback is not None:
+                    content, usage = read_client_stream(completion, stream_callback)
+                else:
+                    content = completion.choices[0].message.content
+                    usage = completion.usage
+
+                reconcile_limit(limiter, estimated_tokens,
+                                usage.total_tokens if usage is not None else None)
+
                 # Format response to match expected output
                 result = [{
                     "message": {
-                        "content": completion.choices[0].message.content
+                        "content": content
                     }
                 }]
 
-                # Cache if needed
-                if not no_cache:
-                    llm_cache.save_cache(cache_name, call_args_dict, result)
+                store_result(llm_cache, call_args_dict, cache_key, near_site, result)
 
                 return result
 
@@ -285,25 +401,29 @@ class OpenAIApiProxy():
                 chat = gemini_model.start_chat(
                     history=gemini_messages[:-1] if gemini_messages else [])
                 last_message = gemini_messages[-1]["parts"][0]["text"] if gemini_messages else ""
-                response = chat.send_message(last_message)
+                response = chat.send_message(last_message, stream=stream_callback is not None)
+                if stream_callback is not None:
+                    content = read_gemini_stream(response, stream_callback)
+                else:
+                    content = response.text
 
                 # Get token usage estimates for Gemini
                 # Gemini doesn't provide token counts directly, so we use a rough estimate
                 # This is a simplified approach - for production, consider using a proper tokenizer
                 input_tokens = sum(len(msg.get("parts", [{}])[0].get(
                     "text", "").split()) * 1.3 for msg in gemini_messages)
-                output_tokens = len(response.text.split()) * 1.3
+                output_tokens = len(content.split()) * 1.3
+                tracer.annotate(input_tokens=int(input_tokens), output_tokens=int(output_tokens))
+                reconcile_limit(limiter, estimated_tokens, int(input_tokens + output_tokens))
 
                 # Format response to match what call_llm expects - simple message with content
                 result = [{
                     "message": {
-                        "content": response.text
+                        "content": content
                     }
                 }]
 
-                # Cache if needed
-                if not no_cache:
-                    llm_cache.save_cache(cache_name, call_args_dict, result)
+                store_result(llm_cache, call_args_dict, cache_key, near_site, result)
 
                 return result
 
@@ -311,40 +431,37 @@ class OpenAIApiProxy():
                 logger.error(f"Error with Gemini API: {e}")
                 raise
 
-        for attempt in range(self.MAX_RETRIES):
-            current_headers = headers.copy()
-            try:
-                response = self.session.post(
-                    url,
-                    headers=current_headers,
-                    json=params_gpt,
-                    timeout=300,
-                )
-                if response.status_code not in self.RETRY_CODES:
-                    response.raise_for_status()
-                    break  # Successful response, exit the loop
-                else:
-                    if "maximum context length is" in str(response.text) or "maximum length" in str(response.text):
-                        logger.error("Error Process {} with the maximum context length exceeds. Sys messages is {}".format(
-                            model, messages[0]))
-                        # just return None
-                        return None
-
-                    print(
-                        f"Received status code {response.status_code} at attempt={attempt + 1}. Retrying..., the response is {response.text}", flush=True)
-
-            except requests.exceptions.RequestException as e:
-                print(f"Error making request (attempt {attempt + 1}): {e}", flush=True)
-                if attempt == self.MAX_RETRIES - 1:  # Last attempt
-                    raise  # Re-raise the last exception if all attempts fail
-
-            # Implement exponential backoff
-            if attempt < self.MAX_RETRIES - 1:  # No need to sleep after the last attempt
-                sleep_time = self.BACKOFF_FACTOR
-                print(f"Waiting for {sleep_time} seconds before next attempt...", flush=True)
-                time.sleep(sleep_time)
-
-        data = response.json()
+        stream = stream_callback is not None
+        if stream:
+            # Added after the cache key, the streamed and the plain calls share the cache
+            params_gpt["stream"] = True
+            if provider in STREAM_USAGE_PROVIDERS:
+                params_gpt["stream_options"] = {"include_usage": True}
+
+        def send(timeout):
+            response = get_session(url).post(url, headers=headers, json=params_gpt,
+                                             timeout=timeout, stream=stream)
+            if response.ok:
+                # Read in the attempt, a body broken before the first delta is retried
+                response.data = read_response(response, use_official, stream_callback)
+            return response
+
+        # Retried with backoff until the deadline, the client errors come back at once;
+        # a stream broken after the first deltas is not retried
+        response = self.retry_policy.run(send, deadline=retry_deadline,
+                                         describe="{} {}".format(provider, model))
+        if not response.ok:
+            if "maximum context length is" in str(response.text) or \
+                    "maximum length" in str(response.text):
+                logger.error("Error Process {} with the maximum context length exceeds. "
+                             "Sys messages is {}".format(model, messages[0]))
+                # just return None
+                return None
+            logger.error("{} {} failed with status code {}: {}".format(
+                provider, model, response.status_code, response.text))
+            response.raise_for_status()
+
+        data = response.data
 
         if self.verbose:
             logger.info("Response: {}".format(json.dumps(data, ensure_ascii=False, indent=4)))
@@ -358,6 +475,9 @@ class OpenAIApiProxy():
         if input_tokens_key in data.get('usage', {}) and output_tokens_key in data.get('usage', {}):
             input_tokens = data.get('usage', {})[input_tokens_key]
             output_tokens = data.get('usage', {})[output_tokens_key]
+            tracer.annotate(input_tokens=input_tokens, output_tokens=output_tokens,
+                            reasoning_tokens=output_reason_tokens)
+            reconcile_limit(limiter, estimated_tokens, input_tokens + output_tokens)
             if model == "gpt-4o":
                 ip = 2.50
                 op = 10.00
@@ -387,16 +507,14 @@ class OpenAIApiProxy():
             result = data["content"][0]["text"]
             # make the format consistent
             data = [{"message": {"content": result}}]
-            if not no_cache:
-                llm_cache.save_cache(cache_name, call_args_dict, data)
+            store_result(llm_cache, call_args_dict, cache_key, near_site, data)
             return data
 
         if 'choices' not in data:
             raise RuntimeError(
                 f"No 'choices' in response: {data}. Possibly, the API key is invalid.")
 
-        if not no_cache:
-            llm_cache.save_cache(cache_name, call_args_dict, data['choices'])
+        store_result(llm_cache, call_args_dict, cache_key, near_site, data['choices'])
         return data['choices']
 
 
@@ -0,0 +1,405 @@
+# coding: utf8
+"""
+Local mock of the llm and search providers, for load testing the engine and the backend
+without network and api quota.
+
+One ThreadingHTTPServer serves
+    - POST /v1/chat/completions: OpenAI compatible, canned outputs valid for the
+      atom/planning/execute/search agent/select/summarize prompts
+    - GET /search?q=xxx&format=json: Searxng compatible search results
+    - GET /page/<page_id>: the web pages linked by the search results
+
+Usage:
+    python -m recursive.llm.mock --port 8765 --llm-latency lognormal:2:0.5 --failure-rate 0.02
+
+    # then run the engine with
+    export Mock_BASE_URL=http://127.0.0.1:8765/v1 Mock_KEY=mock
+    export Searxng_BASE_URL=http://127.0.0.1:8765/search Searxng_KEY=mock
+    python engine.py --model Mock/mock-model --searcher Searxng --mode report ...
+
+With --plan-fanout N the plans have N independent branches, for load testing the parallel mode
+(engine.py --parallel).
+
+The outputs are deterministic given the prompt, so the caches behave as with a real provider.
+"""
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from loguru import logger
+
+
+LOREM = ("the mock provider writes this sentence to stand in for real model output "
+         "so that the engine can be exercised end to end without network").split()
+
+
+class Latency:
+    """
+    Latency distribution in seconds, spec is one of
+        fixed:MEAN
+        uniform:LOW:HIGH
+        exp:MEAN
+        lognormal:MEAN:SIGMA  (MEAN is the mean of the distribution, not of the log)
+    """
+
+    def __init__(self, spec="fixed:0"):
+        self.spec = spec
+        parts = spec.split(":")
+        self.kind = parts[0]
+        self.args = [float(x) for x in parts[1:]]
+        if self.kind not in ("fixed", "uniform", "exp", "lognormal"):
+            raise Exception("Unknown latency distribution: {}".format(spec))
+
+    def sample(self, rng=random):
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.args[0], self.args[1])
+        if self.kind == "exp":
+            return rng.expovariate(1.0 / self.args[0]) if self.args[0] > 0 else 0.0
+        mean, sigma = self.args
+        if mean <= 0:
+            return 0.0
+        return rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+
+
+def stable_rng(*keys):
+    # Same prompt, same output
+    seed = hashlib.md5("\x00".join(str(k) for k in keys).encode("utf-8")).hexdigest()
+    return random.Random(int(seed[:16], 16))
+
+
+def filler(rng, n_words):
+    return " ".join(rng.choice(LOREM) for _ in range(max(n_words, 1)))
+
+
+class MockResponder:
+    """
+    Canned outputs for the prompts of the repo, the kind of prompt is recognized by the
+    output tags it asks for
+    """
+
+    def __init__(self, plan_rate=0.3, output_tokens=300, plan_fanout=0):
+        # Probability that the atom judgement says complex
+        self.plan_rate = plan_rate
+        # 0: a chain of dependent sub tasks; N: N independent branches of a search or think
+        # task and the write task depending on it, so the parallel mode has ready siblings
+        self.plan_fanout = plan_fanout
+        # Words of the free text outputs
+        self.output_tokens = output_tokens
+
+    def kind(self, text):
+        if "<atomic_task_determination>" in text:
+            return "atom"
+        if "**sub_tasks**" in text:
+            return "planning"
+        if "current_turn_search_querys" in text:
+            return "search_agent"
+        if "<answer>" in text and ("satisfy" in text or "满足" in text):
+            return "select"
+        return "text"
+
+    def respond(self, messages):
+        text = "\n".join(str(msg.get("content", "")) for msg in messages)
+        rng = stable_rng(text)
+        kind = self.kind(text)
+        body = filler(rng, self.output_tokens)
+        if kind == "atom":
+            determination = "complex" if rng.random() < self.plan_rate else "atomic"
+            content = ("<think>\n{}\n</think>\n<result>\n<atomic_task_determination>\n{}\n"
+                       "</atomic_task_determination>\n</result>").format(
+                filler(rng, 30), determination)
+        elif kind == "planning":
+            with_search = "`search`" in text
+            sub_tasks = []
+            if self.plan_fanout > 0:
+                for branch in range(self.plan_fanout):
+                    first_id, write_id = str(2 * branch + 1), str(2 * branch + 2)
+                    if with_search:
+                        sub_tasks.append({"id": first_id, "task_type": "search",
+                                          "goal": "mock search " + filler(rng, 6),
+                                          "dependency": []})
+                    else:
+                        sub_tasks.append({"id": first_id, "task_type": "think",
+                                          "goal": "mock analysis " + filler(rng, 6),
+                                          "dependency": []})
+                    sub_tasks.append({"id": write_id, "task_type": "write",
+                                      "goal": "mock section " + filler(rng, 6),
+                                      "length": "300 words", "dependency": [first_id]})
+            else:
+                if with_search:
+                    sub_tasks.append({"id": "1", "task_type": "search",
+                                      "goal": "mock search " + filler(rng, 6), "dependency": []})
+                sub_tasks.append({"id": "2", "task_type": "think",
+                                  "goal": "mock analysis " + filler(rng, 6),
+                                  "dependency": ["1"] if with_search else []})
+                for idx in (3, 4):
+                    sub_tasks.append({"id": str(idx), "task_type": "write",
+                                      "goal": "mock section " + filler(rng, 6),
+                                      "length": "300 words", "dependency": [str(idx - 1)]})
+            plan = {"id": "", "task_type": "write", "goal": "mock", "dependency": [],
+                    "sub_tasks": sub_tasks}
+            content = "<think>\n{}\n</think>\n<result>\n{}\n</result>".format(
+                filler(rng, 30), json.dumps(plan, ensure_ascii=False))
+        elif kind == "search_agent":
+            # Search once, finish when the results of the previous turn are in the prompt
+            if "<web_page index=" in text:
+                querys = []
+            else:
+                querys = ["mock query {}".format(filler(rng, 4)) for _ in range(2)]
+            content = ("<observation>\n{}\n</observation>\n<missing_info>\n{}\n</missing_info>\n"
+                       "<planning_and_think>\n{}\n</planning_and_think>\n"
+                       "<current_turn_query_think>\n{}\n</current_turn_query_think>\n"
+                       "<current_turn_search_querys>\n{}\n</current_turn_search_querys>").format(
+                filler(rng, 40), filler(rng, 10), filler(rng, 20), filler(rng, 10),
+                json.dumps(querys))
+        elif kind == "select":
+            answer = rng.choice(["rich and fully satisfy", "fully satisfy", "partially satisfy",
+                                 "not satisfy"])
+            content = "<think>\n{}\n</think>\n<answer>\n{}\n</answer>".format(
+                filler(rng, 20), answer)
+        else:
+            # writer, reasoner, summarizer, search merge and final aggregate
+            content = ("<think>\n{0}\n</think>\n<content>\n{1}\n</content>\n"
+                       "<article>\n{1}\n</article>\n<result>\n{1}\n</result>").format(
+                filler(rng, 20), body)
+        return kind, content
+
+    def completion(self, params):
+        messages = params.get("messages", [])
+        kind, content = self.respond(messages)
+        prompt_tokens = sum(len(str(msg.get("content", ""))) for msg in messages) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": "mock-{}".format(hashlib.md5(content.encode("utf-8")).hexdigest()[:16]),
+            "object": "chat.completion",
+            "model": params.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "input_tokens": prompt_tokens,
+                "output_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "mock_kind": kind,
+        }
+
+
+class MockSearch:
+    """
+    Searxng compatible results, the pages are served by the same server
+    """
+
+    def __init__(self, base_url, topk=10):
+        self.base_url = base_url
+        self.topk = topk
+
+    def search(self, query, count=None):
+        rng = stable_rng("search", query)
+        count = int(count) if count else self.topk
+        results = []
+        for idx in range(count):
+            page_id = "{}-{}".format(hashlib.md5(query.encode("utf-8")).hexdigest()[:12], idx)
+            results.append({
+                "url": "{}/page/{}".format(self.base_url, page_id),
+                "title": "Mock page {} for {}".format(idx, query),
+                "content": filler(rng, 30),
+                "positions": [idx + 1],
+                "engine": "mock",
+            })
+        return {"query": query, "number_of_results": len(results), "results": results}
+
+    def page(self, page_id):
+        rng = stable_rng("page", page_id)
+        paragraphs = "\n".join("<p>{}.</p>".format(filler(rng, 60)) for _ in range(6))
+        return ("<html><head><title>Mock page {0}</title></head>"
+                "<body><article><h1>Mock page {0}</h1>\n{1}\n</article></body></html>").format(
+            page_id, paragraphs)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Set by serve()
+    settings = None
+    responder = None
+    searcher = None
+    lock = threading.Lock()
+    stats = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _send(self, code, body, content_type="application/json", headers={}):
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _fail(self, endpoint):
+        # Simulated provider failures, retried by the callers
+        if random.random() < self.settings["failure_rate"]:
+            self._count("{}_failed".format(endpoint))
+            code = random.choice(self.settings["failure_codes"])
+            # Like the real providers, a rate limit says when to come back
+            headers = {"Retry-After": str(self.settings["retry_after"])} if code == 429 else {}
+            self._send(code, json.dumps({"error": {"message": "mock failure", "code": code}}),
+                       headers=headers)
+            return True
+        return False
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if not path.endswith("/chat/completions"):
+            self._send(404, json.dumps({"error": "not found"}))
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        params = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.settings["llm_latency"].sample())
+        if self._fail("llm"):
+            return
+        self._count("llm")
+        if params.get("stream"):
+            try:
+                self._stream(params, self.responder.completion(params))
+            except (BrokenPipeError, ConnectionResetError):
+                # The client aborted the stream
+                self._count("llm_aborted")
+            return
+        self._send(200, json.dumps(self.responder.completion(params), ensure_ascii=False))
+
+    def _stream(self, params, data):
+        # Server sent chat.completion.chunk events, a few words each, the connection closes at
+        # the end
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        words = data["choices"][0]["message"]["content"].split(" ")
+        chunks = [" ".join(words[i:i + 8]) + (" " if i + 8 < len(words) else "")
+                  for i in range(0, len(words), 8)]
+        for i, content in enumerate(chunks):
+            chunk = {"id": data["id"], "object": "chat.completion.chunk", "model": data["model"],
+                     "choices": [{"index": 0, "delta": {"content": content},
+                                  "finish_reason": "stop" if i == len(chunks) - 1 else None}]}
+            event = "data: {}\n\n".format(json.dumps(chunk, ensure_ascii=False))
+            self.wfile.write(event.encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.settings["chunk_latency"])
+        if params.get("stream_options", {}).get("include_usage"):
+            chunk = {"id": data["id"], "object": "chat.completion.chunk", "model": data["model"],
+                     "choices": [], "usage": data["usage"]}
+            self.wfile.write("data: {}\n\n".format(json.dumps(chunk)).encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/search":
+            query = parse_qs(url.query)
+            time.sleep(self.settings["search_latency"].sample())
+            if self._fail("search"):
+                return
+            self._count("search")
+            self._send(200, json.dumps(self.searcher.search(query.get("q", [""])[0],
+                                                            query.get("count", [None])[0])))
+        elif url.path.startswith("/page/"):
+            time.sleep(self.settings["page_latency"].sample())
+            if self._fail("page"):
+                return
+            self._count("page")
+            self._send(200, self.searcher.page(url.path[len("/page/"):]),
+                       content_type="text/html; charset=utf-8")
+        elif url.path == "/stats":
+            with self.lock:
+                self._send(200, json.dumps(self.stats))
+        else:
+            self._send(404, json.dumps({"error": "not found"}))
+
+
+def serve(host="127.0.0.1", port=8765, llm_latency="fixed:0", search_latency="fixed:0",
+          page_latency="fixed:0", failure_rate=0.0, failure_codes=(429, 500, 503), retry_after=1,
+          chunk_latency=0.0, plan_rate=0.3, output_tokens=300, topk=10, plan_fanout=0,
+          background=False):
+    MockHandler.settings = {
+        "llm_latency": Latency(llm_latency),
+        "search_latency": Latency(search_latency),
+        "page_latency": Latency(page_latency),
+        "failure_rate": failure_rate,
+        "failure_codes": list(failure_codes),
+        "retry_after": retry_after,
+        "chunk_latency": chunk_latency,
+    }
+    MockHandler.stats = {}
+    MockHandler.responder = MockResponder(plan_rate=plan_rate, output_tokens=output_tokens,
+                                          plan_fanout=plan_fanout)
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    # The bound port, port 0 picks a free one
+    port = server.server_address[1]
+    MockHandler.searcher = MockSearch("http://{}:{}".format(host, port), topk=topk)
+    logger.info("Mock provider on http://{}:{}, llm at /v1/chat/completions, "
+                "searxng at /search".format(host, port))
+    if background:
+        thread = threading.Thread(target=server.serve_forever, name="mock_provider", daemon=True)
+        thread.start()
+        return server
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
+
+
+def define_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--llm-latency", type=str, default="fixed:0",
+                        help="fixed:MEAN, uniform:LOW:HIGH, exp:MEAN or lognormal:MEAN:SIGMA, "
+                             "in seconds")
+    parser.add_argument("--search-latency", type=str, default="fixed:0")
+    parser.add_argument("--page-latency", type=str, default="fixed:0")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="Probability of a request failing with one of --failure-codes")
+    parser.add_argument("--failure-codes", type=int, nargs="+", default=[429, 500, 503])
+    parser.add_argument("--retry-after", type=float, default=1,
+                        help="Retry-After seconds of the 429 failures")
+    parser.add_argument("--chunk-latency", type=float, default=0.0,
+                        help="Seconds between the chunks of a streamed completion")
+    parser.add_argument("--plan-rate", type=float, default=0.3,
+                        help="Probability of judging a task as complex, which makes it planned")
+    parser.add_argument("--output-tokens", type=int, default=300,
+                        help="Words of the free text outputs")
+    parser.add_argument("--plan-fanout", type=int, default=0,
+                        help="0: plans are a chain of dependent sub tasks; N: N independent "
+                             "branches, which the parallel mode of the engine runs concurrently")
+    parser.add_argument("--topk", type=int, default=10, help="Search results per query")
+    return parser
+
+
+if __name__ == "__main__":
+    args = define_args().parse_args()
+    serve(host=args.host, port=args.port, llm_latency=args.llm_latency,
+          search_latency=args.search_latency, page_latency=args.page_latency,
+          failure_rate=args.failure_rate, failure_codes=args.failure_codes,
+          retry_after=args.retry_after, chunk_latency=args.chunk_latency,
+          plan_rate=args.plan_rate, output_tokens=args.output_tokens, topk=args.topk,
+          plan_fanout=args.plan_fanout)
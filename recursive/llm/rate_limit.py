@@ -0,0 +1,194 @@
+# coding: utf8
+"""
+Client side rate limits of the llm calls, token buckets of requests per minute and tokens per
+minute keyed by provider/model, so that all the thread pools of a run together stay under the
+limits of the provider instead of finding them with 429s.
+
+Limits are given as PROVIDER[/MODEL]:rpm=N,tpm=N, e.g. OpenAI/gpt-4o:rpm=500,tpm=30000 or
+Anthropic:rpm=50, the model entry wins over the provider one. With a state dir the buckets are
+files shared by all the processes of the host (batch_writing shards, concurrent runs).
+
+A call acquires one request and its estimated prompt tokens up front, and reconciles with the
+usage returned by the provider afterwards.
+"""
+import os
+import re
+import json
+import time
+import threading
+from loguru import logger
+from recursive.cache import FileLock
+from recursive.utils.tracer import tracer
+
+# "provider/model" or "provider" -> {"rpm": N, "tpm": N}
+rate_limits = {}
+rate_limit_dir = None
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def parse_rate_limit(spec):
+    key, _, budgets = spec.partition(":")
+    limit = {}
+    for budget in budgets.split(","):
+        name, _, value = budget.partition("=")
+        if name not in ("rpm", "tpm") or not value:
+            raise Exception("Bad rate limit {}, expect PROVIDER[/MODEL]:rpm=N,tpm=N".format(spec))
+        limit[name] = float(value)
+    return key, limit
+
+
+def configure_rate_limits(specs, state_dir=None):
+    """
+    specs: ["OpenAI/gpt-4o:rpm=500,tpm=30000", "Anthropic:rpm=50", ...]
+    state_dir: share the buckets with the other processes of the host through files in it
+    """
+    global rate_limit_dir
+    with limiters_lock:
+        rate_limits.clear()
+        for spec in specs or []:
+            key, limit = parse_rate_limit(spec)
+            rate_limits[key] = limit
+        rate_limit_dir = state_dir
+        if state_dir is not None:
+            os.makedirs(state_dir, exist_ok=True)
+        limiters.clear()
+
+
+def estimate_tokens(messages):
+    """
+    Rough prompt tokens before the call, 4 chars per token of latin text and 1 per CJK char
+    """
+    text = "".join(str(message.get("content", "")) for message in messages)
+    non_ascii = len(re.findall(r"[^\x00-\x7f]", text))
+    return (len(text) - non_ascii) // 4 + non_ascii + 4 * len(messages)
+
+
+class RateLimiter:
+    """
+    Token buckets of one provider/model, refilled continuously at rpm and tpm per minute and
+    holding at most a minute of budget.
+
+    The buckets may go into debt: a prompt larger than the rest of the minute still goes once
+    the bucket is full, and a call that used more tokens than estimated delays the next ones.
+    """
+
+    def __init__(self, key, rpm=None, tpm=None, state_file=None):
+        self.key = key
+        self.capacity = {"requests": rpm, "tokens": tpm}
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        now = time.time()
+        self.state = {name: [capacity, now] for name, capacity in self.capacity.items()
+                      if capacity is not None}
+
+    def _load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            self.state.update({name: state[name] for name in self.state if name in state})
+        except (json.JSONDecodeError, OSError):
+            # Broken by a killed process, start over from full buckets
+            pass
+
+    def _store(self):
+        if self.state_file is None:
+            return
+        tmp_fn = "{}.{}.tmp".format(self.state_file, os.getpid())
+        with open(tmp_fn, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_fn, self.state_file)
+
+    def _update(self, func):
+        # The file lock makes the read, modify and write of the state atomic across processes
+        with self.lock:
+            if self.state_file is None:
+                return func()
+            with FileLock("{}.lock".format(self.state_file)):
+                self._load()
+                result = func()
+                self._store()
+                return result
+
+    def _refill(self, now):
+        for name, (level, updated) in self.state.items():
+            capacity = self.capacity[name]
+            self.state[name] = [min(capacity, level + (now - updated) * capacity / 60), now]
+
+    def _try_take(self, amounts):
+        """
+        Take the amounts and return 0, or return the seconds to wait before trying again
+        """
+        now = time.time()
+        self._refill(now)
+        wait = 0
+        for name, amount in amounts.items():
+            if name not in self.state:
+                continue
+            capacity = self.capacity[name]
+            missing = min(amount, capacity) - self.state[name][0]
+            if missing > 0:
+                wait = max(wait, missing * 60 / capacity)
+        if wait > 0:
+            return wait
+        for name, amount in amounts.items():
+            if name in self.state:
+                self.state[name][0] -= amount
+        return 0
+
+    def acquire(self, tokens):
+        start = time.time()
+        amounts = {"requests": 1, "tokens": tokens}
+        while True:
+            wait = self._update(lambda: self._try_take(amounts))
+            if wait == 0:
+                break
+            # At least 10ms, a wait of a rounding error would spin
+            time.sleep(min(max(wait, 0.01), 5))
+        waited = time.time() - start
+        if waited > 1:
+            logger.info("Rate limit of {} delayed the call by {:.2f}s".format(self.key, waited))
+        tracer.annotate(rate_limit_wait=round(waited, 3))
+        return waited
+
+    def reconcile(self, estimated, used):
+        """
+        Correct the tokens bucket once the provider reported the usage of the call
+        """
+        if "tokens" not in self.state or used is None:
+            return
+
+        def adjust():
+            self._refill(time.time())
+            self.state["tokens"][0] -= used - estimated
+        self._update(adjust)
+
+
+def get_limiter(provider, model):
+    """
+    The limiter of provider/model, None if it has no limit
+    """
+    key = "{}/{}".format(provider, model)
+    with limiters_lock:
+        if key in limiters:
+            return limiters[key]
+        limit_key = key if key in rate_limits else provider
+        limiter = None
+        if limit_key in rate_limits:
+            # The model entries have a bucket each, the provider entry one for all its models
+            state_file = None
+            if rate_limit_dir is not None:
+                state_file = "{}/{}.json".format(rate_limit_dir, re.sub(r"[^\w.-]", "_", limit_key))
+            limiter = limiters.get(limit_key)
+            if limiter is None:
+                limiter = limiters[limit_key] = RateLimiter(limit_key, state_file=state_file,
+                                                            **rate_limits[limit_key])
+        limiters[key] = limiter
+        return limiter
+
+
+# The batch_writing shards inherit the limits from the environment
+configure_rate_limits(os.getenv("LLM_RATE_LIMITS", "").split(),
+                      os.getenv("LLM_RATE_LIMIT_DIR") or None)
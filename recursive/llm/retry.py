@@ -0,0 +1,166 @@
+# coding: utf8
+"""
+Retry policy of the llm http calls: exponential backoff with full jitter, the wait asked by the
+provider (Retry-After and the rate limit reset headers) is honoured, the client errors that can
+not succeed on a retry (400, 401, 403, 404, ...) fail at once, and the retries stop at a deadline
+per call instead of after a number of attempts.
+"""
+import os
+import re
+import time
+import random
+import requests
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from loguru import logger
+from recursive.utils.tracer import tracer
+
+# 408 and 409 are transient on the OpenAI and Anthropic apis, 529 is Anthropic overloaded
+RETRY_STATUSES = (408, 409, 425, 429, 500, 502, 503, 504, 529)
+
+# Headers giving the time until the rate limit window resets, the largest one is waited for
+RESET_HEADERS = (
+    "x-ratelimit-reset-requests",
+    "x-ratelimit-reset-tokens",
+    "anthropic-ratelimit-requests-reset",
+    "anthropic-ratelimit-tokens-reset",
+    "anthropic-ratelimit-input-tokens-reset",
+    "anthropic-ratelimit-output-tokens-reset",
+)
+
+
+def parse_duration(value):
+    """
+    Seconds of a header value: "2", "0.5", "1m30s", "250ms" or an RFC 3339 / HTTP date to wait for,
+    None if it can not be parsed
+    """
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if len(parts) > 0 and "".join(number + unit for number, unit in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(number) * scale[unit] for number, unit in parts)
+    try:
+        if re.match(r"\d{4}-", value):
+            when = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        else:
+            when = parsedate_to_datetime(value)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (ValueError, TypeError):
+        return None
+
+
+def retry_after(response):
+    """
+    Seconds the provider asks to wait before the next attempt, None if it does not say
+    """
+    headers = response.headers
+    if "retry-after-ms" in headers:
+        try:
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        wait = parse_duration(headers["retry-after"])
+        if wait is not None:
+            return wait
+    # The reset headers are only meaningful once the limit is hit
+    if response.status_code != 429:
+        return None
+    waits = [parse_duration(headers[name]) for name in RESET_HEADERS if name in headers]
+    waits = [wait for wait in waits if wait is not None]
+    return max(waits) if len(waits) > 0 else None
+
+
+class RetryPolicy:
+    """
+    Usage:
+        response = policy.run(lambda timeout: session.post(url, json=params, timeout=timeout))
+
+    send is called with the timeout left for the attempt. run returns the first response that
+    is not retryable, a success or not, and the caller decides on it (raise_for_status, ...).
+    The requests exceptions raised by send are retried, except an HTTPError of a status that is
+    not retryable. When the deadline passes the last response is returned, or the last error
+    raised.
+    """
+
+    def __init__(self, deadline=600, base_delay=1.0, max_delay=60.0, attempt_timeout=300,
+                 retry_statuses=RETRY_STATUSES):
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.retry_statuses = set(retry_statuses)
+
+    def is_retryable(self, response):
+        return response.status_code in self.retry_statuses
+
+    def backoff(self, attempt):
+        # Full jitter, the concurrent callers throttled together do not come back together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def delay(self, attempt, response=None):
+        wait = self.backoff(attempt)
+        if response is not None:
+            asked = retry_after(response)
+            if asked is not None:
+                # A little jitter on top, so that the callers told the same time spread out
+                wait = asked + random.uniform(0, self.base_delay)
+        return wait
+
+    def run(self, send, deadline=None, describe=""):
+        deadline = self.deadline if deadline is None else deadline
+        end = time.time() + deadline
+        attempt = 0
+        while True:
+            remaining = end - time.time()
+            response = None
+            try:
+                response = send(max(1.0, min(self.attempt_timeout, remaining)))
+            except requests.exceptions.RequestException as e:
+                # Connection errors, timeouts and broken bodies are retried, an HTTPError of a
+                # client error is not
+                if e.response is not None and not self.is_retryable(e.response):
+                    raise
+                if time.time() >= end:
+                    raise
+                logger.warning("{} attempt {} failed: {}".format(describe, attempt + 1, e))
+            else:
+                if not self.is_retryable(response):
+                    tracer.annotate(attempts=attempt + 1)
+                    return response
+                logger.warning("{} attempt {} received status code {}: {}".format(
+                    describe, attempt + 1, response.status_code, response.text[:500]))
+
+            wait = self.delay(attempt, response)
+            remaining = end - time.time()
+            if wait >= remaining:
+                # Better to give up now than to sleep past the deadline
+                tracer.annotate(attempts=attempt + 1)
+                if response is not None:
+                    logger.error("{} gives up after {} attempts, status code {}".format(
+                        describe, attempt + 1, response.status_code))
+                    return response
+                raise requests.exceptions.Timeout(
+                    "{} gives up after {} attempts, the deadline of {}s passed".format(
+                        describe, attempt + 1, deadline))
+            logger.info("{} waits {:.2f}s before attempt {}".format(describe, wait, attempt + 2))
+            time.sleep(wait)
+            attempt += 1
+
+
+default_retry_policy = RetryPolicy(deadline=float(os.getenv("LLM_RETRY_DEADLINE", 600)))
+
+
+def configure_retry(deadline=None, base_delay=None, max_delay=None):
+    if deadline is not None:
+        default_retry_policy.deadline = deadline
+    if base_delay is not None:
+        default_retry_policy.base_delay = base_delay
+    if max_delay is not None:
+        default_retry_policy.max_delay = max_delay
@@ -0,0 +1,206 @@
+# coding: utf8
+"""
+Streaming of the llm responses. OpenAIApiProxy.call(..., stream_callback=on_delta) reads the
+response as it is generated and calls on_delta(delta, text) with each new piece and the text so
+far; on_delta returning False aborts the call (StreamAborted), e.g. on malformed output. The
+assembled result is returned and cached as without streaming.
+
+    for delta in DeltaStream(lambda on_delta: llm.call(model, messages, stream_callback=on_delta)):
+        print(delta, end="")
+
+The readers here turn the server sent events of the OpenAI compatible and the Anthropic apis
+into the same data as their non streaming responses. A connection broken before the first delta
+is retried like a plain call, after it the call fails with StreamBroken, a retry would send the
+deltas again.
+"""
+import json
+import queue
+import threading
+import requests
+
+
+class StreamAborted(Exception):
+    def __init__(self, text):
+        super().__init__("The llm stream is aborted by the callback after {} chars".format(
+            len(text)))
+        self.text = text
+
+
+class StreamBroken(Exception):
+    def __init__(self, text, error):
+        super().__init__("The llm stream broke after {} chars: {!r}".format(len(text), error))
+        self.text = text
+
+
+def emit(on_delta, delta, text):
+    if on_delta(delta, text) is False:
+        raise StreamAborted(text)
+
+
+def iter_sse(response):
+    """
+    (event, data) of each server sent event, the data lines joined
+    """
+    # text/event-stream has no charset in most of the responses, it is always utf8
+    response.encoding = "utf-8"
+    event, data = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if line == "":
+            if len(data) > 0:
+                yield event, "\n".join(data)
+            event, data = None, []
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].lstrip())
+    if len(data) > 0:
+        yield event, "\n".join(data)
+
+
+def read_openai_stream(response, on_delta):
+    """
+    The chat.completion chunks of an OpenAI compatible api, as the data of a chat.completion
+    """
+    text = ""
+    reasoning = ""
+    data = {"choices": [], "usage": {}}
+    finish_reason = None
+    try:
+        for _, payload in iter_sse(response):
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            if "error" in chunk:
+                raise RuntimeError("Error in the llm stream: {}".format(chunk["error"]))
+            data["id"] = chunk.get("id", data.get("id"))
+            data["model"] = chunk.get("model", data.get("model"))
+            if chunk.get("usage"):
+                data["usage"] = chunk["usage"]
+            for choice in chunk.get("choices") or []:
+                delta = choice.get("delta") or {}
+                if delta.get("reasoning_content"):
+                    reasoning += delta["reasoning_content"]
+                if delta.get("content"):
+                    text += delta["content"]
+                    emit(on_delta, delta["content"], text)
+                finish_reason = choice.get("finish_reason") or finish_reason
+    except requests.exceptions.RequestException as e:
+        if text:
+            raise StreamBroken(text, e) from e
+        raise
+    finally:
+        response.close()
+    message = {"role": "assistant", "content": text}
+    if reasoning:
+        message["reasoning_content"] = reasoning
+    data["choices"] = [{"index": 0, "message": message, "finish_reason": finish_reason}]
+    return data
+
+
+def read_anthropic_stream(response, on_delta):
+    """
+    The events of the Anthropic messages api, as the data of a message
+    """
+    text = ""
+    usage = {}
+    stop_reason = None
+    try:
+        for event, payload in iter_sse(response):
+            chunk = json.loads(payload)
+            event = event or chunk.get("type")
+            if event == "error":
+                raise RuntimeError("Error in the llm stream: {}".format(chunk.get("error")))
+            if event == "message_start":
+                usage.update(chunk["message"].get("usage", {}))
+            elif event == "content_block_delta" and chunk["delta"].get("type") == "text_delta":
+                text += chunk["delta"]["text"]
+                emit(on_delta, chunk["delta"]["text"], text)
+            elif event == "message_delta":
+                usage.update(chunk.get("usage", {}))
+                stop_reason = chunk.get("delta", {}).get("stop_reason", stop_reason)
+            elif event == "message_stop":
+                break
+    except requests.exceptions.RequestException as e:
+        if text:
+            raise StreamBroken(text, e) from e
+        raise
+    finally:
+        response.close()
+    return {"type": "message", "role": "assistant", "content": [{"type": "text", "text": text}],
+            "stop_reason": stop_reason, "usage": usage}
+
+
+def read_client_stream(completion, on_delta):
+    """
+    (text, usage) of the chunks of an openai client stream
+    """
+    text = ""
+    usage = None
+    try:
+        for chunk in completion:
+            usage = chunk.usage or usage
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                emit(on_delta, chunk.choices[0].delta.content, text)
+    finally:
+        completion.close()
+    return text, usage
+
+
+def read_gemini_stream(response, on_delta):
+    text = ""
+    for chunk in response:
+        text += chunk.text
+        emit(on_delta, chunk.text, text)
+    return text
+
+
+class DeltaStream:
+    """
+    Iterator of the deltas of a streaming call, run in a thread. func gets the on_delta callback.
+    After the iteration result holds the return value of func; leaving the loop early (break,
+    close) aborts the call.
+    """
+    DONE = object()
+
+    def __init__(self, func):
+        self.func = func
+        self.queue = queue.Queue()
+        self.aborted = threading.Event()
+        self.result = None
+        self.error = None
+        self.thread = None
+
+    def on_delta(self, delta, text):
+        if self.aborted.is_set():
+            return False
+        self.queue.put(delta)
+
+    def run(self):
+        try:
+            self.result = self.func(self.on_delta)
+        except StreamAborted:
+            pass
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.queue.put(self.DONE)
+
+    def __iter__(self):
+        self.thread = threading.Thread(target=self.run, name="llm_stream", daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                delta = self.queue.get()
+                if delta is self.DONE:
+                    break
+                yield delta
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.aborted.set()
@@ -1,4 +1,5 @@
 #coding: utf8
+import copy
 from copy import deepcopy
 from collections import defaultdict
 import re
@@ -12,6 +13,35 @@ caches = {
     "web_page": None
 }
 
+WEB_PAGE_INDEX_PATTERN = re.compile(r"(<web_page index=)(\d+)(>)")
+
+
+def renumber_search_indices(data, mapping, seen=None):
+    """
+    Apply mapping (old index -> new index) in place to the global_index of the search result
+    pages in data, and to the <web_page index=N> tags of its strings. Return the new data,
+    the strings can not be changed in place.
+    """
+    seen = set() if seen is None else seen
+    if isinstance(data, str):
+        return WEB_PAGE_INDEX_PATTERN.sub(lambda m: "{}{}{}".format(
+            m.group(1), mapping.get(int(m.group(2)), m.group(2)), m.group(3)), data)
+    if not isinstance(data, (dict, list)) or id(data) in seen:
+        return data
+    # The same page may be both in the memory and in the results, map it once
+    seen.add(id(data))
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key == "global_index" and isinstance(value, int):
+                data[key] = mapping.get(value, value)
+            else:
+                data[key] = renumber_search_indices(value, mapping, seen)
+    else:
+        for idx, value in enumerate(data):
+            data[idx] = renumber_search_indices(value, mapping, seen)
+    return data
+
+
 class Memory:
     def __init__(self, root_node, format, config):
         self.root_node = root_node
@@ -32,6 +62,33 @@ class Memory:
         self.global_start_index += 1
         return page
   
+    def fork(self, global_start_index=None):
+        """
+        Make a per-node view of the memory for parallel execution. The view shares
+        the collected info_nodes, but the article and search results are private,
+        so that concurrent actions never observe each other's partial writes
+        """
+        view = copy.copy(self)
+        view.all_search_results = list(self.all_search_results)
+        if global_start_index is not None:
+            view.global_start_index = global_start_index
+        return view
+
+    def merge(self, view, base_article, base_search_cnt, view_start_index, results=None):
+        """
+        Apply the writes of a forked view back to the memory. The views are merged in the
+        BFS order of their nodes; the search indices used by a view, from view_start_index,
+        are renumbered to follow the ones merged before, as if the nodes ran one by one.
+        results: the results written by the node of the view, renumbered as well
+        """
+        self.article += view.article[len(base_article):]
+        pages = view.all_search_results[base_search_cnt:]
+        self.all_search_results.extend(pages)
+        used = view.global_start_index - view_start_index
+        if used > 0 and view_start_index != self.global_start_index:
+            mapping = {view_start_index + k: self.global_start_index + k for k in range(used)}
+            renumber_search_indices([pages, results], mapping)
+        self.global_start_index += max(used, 0)
 
     def init(self):
         self.info_nodes = {
@@ -41,14 +98,21 @@ class Memory:
 
     def save(self, folder):
         import json
-        with open("{}/memory.jsonl".format(folder), "w") as f:
-            f.write(json.dumps({
-                "article": self.article,
-                "all_search_results": self.all_search_results
-            }, ensure_ascii=False))
+        from recursive.checkpoint import atomic_write
+        atomic_write("{}/memory.jsonl".format(folder), json.dumps({
+            "article": self.article,
+            "all_search_results": self.all_search_results,
+            "global_start_index": self.global_start_index
+        }, ensure_ascii=False))
 
     def load(self, folder):
-        return
+        import json
+        with open("{}/memory.jsonl".format(folder)) as f:
+            data = json.loads(f.read())
+        self.article = data["article"]
+        self.all_search_results = data["all_search_results"]
+        self.global_start_index = data.get("global_start_index", len(self.all_search_results) + 1)
+        return self
             
     def database_set(self, key, value):
         # if self.multiprocess_manager is not None:
@@ -0,0 +1,170 @@
+# coding: utf8
+"""
+Approximate tier of the llm cache: a call that misses the exact cache may reuse the result of
+a call whose prompt is nearly the same (e.g. the same page judged with a slightly different
+think), matched by the SimHash of the normalized prompt.
+
+It is opt-in per call site: OpenAIApiProxy.call(..., near_cache_site="selector") only looks
+up the sites enabled by enable_near_cache, each with its own similarity threshold.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+from loguru import logger
+from recursive.cache import obj_to_hash
+
+SIMHASH_BITS = 64
+# 8 bands of 8 bits: two hashes within 7 bits share at least one band (pigeonhole),
+# so the candidates are exact down to a similarity of 1 - 7 / 64
+LSH_BANDS = 8
+BAND_BITS = SIMHASH_BITS // LSH_BANDS
+MAX_DISTANCE = LSH_BANDS - 1
+
+# site -> similarity threshold, set by enable_near_cache
+near_cache_sites = {}
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def enable_near_cache(specs, default_threshold=0.95):
+    """
+    specs: ["selector", "summarizer:0.9", ...], SITE[:THRESHOLD]
+    """
+    near_cache_sites.clear()
+    for spec in specs or []:
+        site, _, threshold = spec.partition(":")
+        threshold = float(threshold) if threshold else default_threshold
+        if int((1 - threshold) * SIMHASH_BITS) > MAX_DISTANCE:
+            raise Exception(
+                "Near cache threshold of {} is below the lowest supported {:.3f}".format(
+                    site, 1 - MAX_DISTANCE / SIMHASH_BITS))
+        near_cache_sites[site] = threshold
+
+
+def normalize_tokens(text):
+    # Digits are masked so that dates and indices do not count, CJK characters are tokens by
+    # themselves
+    text = re.sub(r"\d+", "0", text.lower())
+    return re.findall(r"[a-z0]+|[^\sa-z0]", text)
+
+
+def simhash(text, shingle=3):
+    tokens = normalize_tokens(text)
+    shingles = {}
+    for i in range(max(1, len(tokens) - shingle + 1)):
+        s = " ".join(tokens[i:i + shingle])
+        shingles[s] = shingles.get(s, 0) + 1
+    weights = [0] * SIMHASH_BITS
+    bits = []
+    counts = []
+    for s, cnt in shingles.items():
+        h = int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+        bits.append(format(h, "064b"))
+        counts.append(cnt)
+    # Column-wise over the bit strings, much faster than shifting every hash 64 times
+    for idx, column in enumerate(zip(*bits)):
+        weights[idx] = sum(cnt if bit == "1" else -cnt for bit, cnt in zip(column, counts))
+    value = 0
+    for weight in weights:
+        value = (value << 1) | (1 if weight > 0 else 0)
+    return value
+
+
+def bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (value >> (band * BAND_BITS)) & mask) for band in range(LSH_BANDS)]
+
+
+class NearDuplicateIndex:
+    """
+    SimHash -> cache key, bucketed by site and the non-message call args (model, temperature, ...).
+    Persisted next to the llm cache as {fn}.simhash.jsonl, one line per stored call.
+    """
+
+    def __init__(self, fn, mode="rw"):
+        self.fn = fn
+        self.mode = mode
+        self.lock = threading.Lock()
+        # bucket -> {"hashes": {key: simhash}, "bands": {(band, band_value): [key]}}
+        self.buckets = {}
+        if os.path.isfile(fn):
+            with open(fn) as f:
+                for line in f:
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._index(data["bucket"], data["simhash"], data["key"])
+
+    def _index(self, bucket, value, key):
+        entry = self.buckets.setdefault(bucket, {"hashes": {}, "bands": {}})
+        entry["hashes"][key] = value
+        for band in bands(value):
+            entry["bands"].setdefault(band, []).append(key)
+
+    def add(self, bucket, value, key):
+        with self.lock:
+            if key in self.buckets.get(bucket, {}).get("hashes", {}):
+                return
+            self._index(bucket, value, key)
+            if "w" in self.mode:
+                with open(self.fn, "a") as f:
+                    f.write(json.dumps({"bucket": bucket, "simhash": value, "key": key}) + "\n")
+
+    def query(self, bucket, value, max_distance):
+        """
+        Keys within max_distance bits of value, the closest first
+        """
+        with self.lock:
+            entry = self.buckets.get(bucket)
+            if entry is None:
+                return []
+            candidates = set()
+            for band in bands(value):
+                candidates.update(entry["bands"].get(band, []))
+            found = []
+            for key in candidates:
+                distance = bin(entry["hashes"][key] ^ value).count("1")
+                if distance <= max_distance:
+                    found.append((distance, key))
+        return [key for _, key in sorted(found)]
+
+
+def get_index(cache):
+    with indexes_lock:
+        if cache.fn not in indexes:
+            indexes[cache.fn] = NearDuplicateIndex("{}.simhash.jsonl".format(cache.fn),
+                                                   mode="rw" if "w" in cache.mode else "r")
+        return indexes[cache.fn]
+
+
+def call_signature(site, call_args_dict):
+    """
+    (bucket, simhash) of an llm call, only the messages are compared approximately
+    """
+    bucket = "{}:{}".format(site, obj_to_hash({k: v for k, v in call_args_dict.items()
+                                               if k != "messages"}))
+    text = "\n".join(str(message.get("content", "")) for message in call_args_dict["messages"])
+    return bucket, simhash(text)
+
+
+def near_lookup(cache, site, call_args_dict):
+    """
+    The cached value of the closest similar call, None if there is none
+    """
+    bucket, value = call_signature(site, call_args_dict)
+    max_distance = int((1 - near_cache_sites[site]) * SIMHASH_BITS)
+    for key in get_index(cache).query(bucket, value, max_distance):
+        result = cache.get(key)
+        # The entry may have been evicted
+        if result is not None:
+            logger.debug("NEAR HIT cache: {} {}".format(site, key))
+            return result
+    return None
+
+
+def near_add(cache, site, call_args_dict, key):
+    bucket, value = call_signature(site, call_args_dict)
+    get_index(cache).add(bucket, value, key)
@@ -0,0 +1,141 @@
+# coding: utf8
+import heapq
+from collections import deque
+from recursive.graph import TaskStatus
+
+
+class ReadyQueue:
+    """
+    Event-driven status bookkeeping for GraphRunEngine.
+
+    Instead of a BFS from the root to find the next activate node, and a full
+    recursive forward_exam after every step, it keeps
+        - the number of unfinished parent nodes of each node
+        - the number of unfinished inner nodes of each node
+        - a heap of activate nodes, ordered the same as the BFS from the root
+    and only exams the nodes affected by a status change.
+
+    The ordering key of a node is (layer, path), path is the indices in the
+    topological_task_queue from the root to the node, which is exactly the
+    visiting order of GraphRunEngine.find_need_next_step_nodes.
+    """
+
+    def __init__(self, root_node):
+        self.root_node = root_node
+        self.rebuild()
+
+    def rebuild(self):
+        # key is hashkey
+        self.order_keys = {}
+        self.unresolved = {}
+        self.unfinished_inner = {}
+        self.children = {}
+        self.indexed = set()
+        self.finished = set()
+        self.versions = {}
+        self.heap = []
+        self.seq = 0
+        self.changed = []
+
+        self.order_keys[self.root_node.hashkey] = (self.root_node.node_graph_info["layer"], ())
+        self.unresolved[self.root_node.hashkey] = 0
+        self.children[self.root_node.hashkey] = []
+        queue = deque([self.root_node])
+        while len(queue) > 0:
+            node = queue.popleft()
+            if node.status == TaskStatus.FINISH:
+                self.finished.add(node.hashkey)
+            self._enqueue(node)
+            if len(node.topological_task_queue) > 0:
+                self._index_inner_graph(node)
+                queue.extend(node.topological_task_queue)
+
+    def _index_inner_graph(self, node):
+        path = self.order_keys[node.hashkey][1]
+        inner_nodes = node.topological_task_queue
+        self.unfinished_inner[node.hashkey] = sum(
+            1 for inner_node in inner_nodes if inner_node.status != TaskStatus.FINISH)
+        for idx, inner_node in enumerate(inner_nodes):
+            self.order_keys[inner_node.hashkey] = (inner_node.node_graph_info["layer"],
+                                                   path + (idx,))
+            self.children[inner_node.hashkey] = list(node.inner_graph.graph_edges[inner_node.nid])
+            self.unresolved[inner_node.hashkey] = sum(
+                1 for parent in inner_node.node_graph_info["parent_nodes"]
+                if parent.status != TaskStatus.FINISH)
+        self.indexed.add(node.hashkey)
+
+    def _enqueue(self, node):
+        if not node.is_activate:
+            return
+        self.seq += 1
+        self.versions[node.hashkey] = self.seq
+        heapq.heappush(self.heap, (self.order_keys[node.hashkey], self.seq, node))
+
+    def _is_valid(self, entry):
+        _, seq, node = entry
+        return self.versions.get(node.hashkey) == seq and node.is_activate
+
+    def peek(self):
+        """
+        Return the first activate node in BFS order, None if there is no such node
+        """
+        while len(self.heap) > 0:
+            if self._is_valid(self.heap[0]):
+                return self.heap[0][2]
+            heapq.heappop(self.heap)
+        return None
+
+    def ready_nodes(self):
+        """
+        Return all the activate nodes in BFS order
+        """
+        self.heap = [entry for entry in self.heap if self._is_valid(entry)]
+        heapq.heapify(self.heap)
+        return [entry[2] for entry in sorted(self.heap)]
+
+    def notify(self, node, verbose=True):
+        """
+        Called after the status of node changed, exam the affected nodes and
+        propagate the status changes until nothing changes.
+        """
+        pending = deque([node])
+        while len(pending) > 0:
+            cur = pending.popleft()
+            self.changed.append(cur)
+            self._enqueue(cur)
+
+            affected = []
+            if cur.status == TaskStatus.DOING:
+                if cur.hashkey not in self.indexed:
+                    self._index_inner_graph(cur)
+                affected.extend(inner_node for inner_node in cur.topological_task_queue
+                                if self.unresolved[inner_node.hashkey] == 0)
+                if self.unfinished_inner[cur.hashkey] == 0:
+                    affected.append(cur)
+            elif cur.status == TaskStatus.FINISH and cur.hashkey not in self.finished:
+                self.finished.add(cur.hashkey)
+                for child in self.children.get(cur.hashkey, []):
+                    self.unresolved[child.hashkey] -= 1
+                    if self.unresolved[child.hashkey] == 0:
+                        affected.append(child)
+                outer_node = cur.node_graph_info["outer_node"]
+                if outer_node is not None:
+                    self.unfinished_inner[outer_node.hashkey] -= 1
+                    if self.unfinished_inner[outer_node.hashkey] == 0:
+                        affected.append(outer_node)
+
+            for affected_node in affected:
+                if not affected_node.is_suspend:
+                    continue
+                before = affected_node.status
+                affected_node.do_exam(verbose)
+                if affected_node.status != before:
+                    pending.append(affected_node)
+
+    def drain_changed(self):
+        """
+        Return the nodes whose status changed since the last call, in change order
+        """
+        changed = self.changed
+        self.changed = []
+        return changed
@@ -10,4 +10,7 @@ task_output_file=${output_folder}/result.jsonl
 done_file=${output_folder}/done.txt
 
 
-python engine.py --filename $task_input_file --output-filename $task_output_file --done-flag-file $done_file --model ${MODEL} --engine-backend google --mode report
\ No newline at end of file
+python engine.py --filename $task_input_file --output-filename $task_output_file --done-flag-file $done_file --model ${MODEL} --engine-backend google --mode report
+# Offline replay of the run above, for benchmarking the engine without network:
+# every llm, search and web page call is served by the recorded caches, bench.json goes to each task folder
+# python engine.py --filename $task_input_file --output-filename ${output_folder}/replay.jsonl --model ${MODEL} --engine-backend google --mode report --offline
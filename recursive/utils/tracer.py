@@ -0,0 +1,120 @@
+# coding: utf8
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Records timed spans of a run and exports them in the Chrome trace event format,
+    the file can be opened in chrome://tracing or https://ui.perfetto.dev
+
+    Usage:
+        with tracer.span("engine.step", cat="engine", step=3):
+            ...
+            tracer.annotate(cache="hit")  # add args to the innermost span of this thread
+
+        @tracer.trace("OpenAIApiProxy.call", cat="llm")
+        def call(...):
+            ...
+
+    Disabled by default, a disabled tracer records nothing and costs a flag check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_names = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, cat="default", **args):
+        if not self.enabled:
+            yield args
+            return
+        stack = self._stack()
+        stack.append(args)
+        start = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = repr(e)
+            raise
+        finally:
+            end = time.time()
+            stack.pop()
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": {k: v if isinstance(v, (int, float, str, bool, type(None))) else str(v)
+                         for k, v in args.items()},
+            }
+            with self.lock:
+                self.events.append(event)
+                self.thread_names.setdefault(thread.ident, thread.name)
+
+    def trace(self, name, cat="default"):
+        """
+        Decorator version of span
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(name, cat=cat):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def annotate(self, **args):
+        """
+        Add args to the innermost open span of the current thread
+        """
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if len(stack) > 0:
+            stack[-1].update(args)
+
+    def export(self, fn, clear=True):
+        with self.lock:
+            events = self.events
+            thread_names = dict(self.thread_names)
+            if clear:
+                self.events = []
+                self.thread_names = {}
+        pid = os.getpid()
+        metadata = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                     "args": {"name": thread_name}}
+                    for tid, thread_name in thread_names.items()]
+        tmp_fn = "{}.tmp".format(fn)
+        with open(tmp_fn, "w") as f:
+            json.dump({"traceEvents": metadata + sorted(events, key=lambda e: e["ts"]),
+                       "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        os.replace(tmp_fn, fn)
+
+
+tracer = Tracer()
@@ -0,0 +1,65 @@
+# coding: utf8
+import httpx
+import pytest
+from recursive.cache import Cache
+from recursive.executor.actions.bing_browser import WebPageHelper
+from recursive.llm.mock import serve
+from recursive.memory import caches
+
+
+@pytest.fixture
+def mock_provider(monkeypatch):
+    """
+    start(**settings) runs recursive.llm.mock on a free port, the Mock provider of
+    OpenAIApiProxy is pointed at it; returns the base url of the server
+    """
+    servers = []
+
+    def start(**settings):
+        server = serve(port=0, background=True, **settings)
+        servers.append(server)
+        base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+        monkeypatch.setenv("Mock_BASE_URL", base_url + "/v1")
+        monkeypatch.setenv("Mock_KEY", "mock")
+        return base_url
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def web_page_cache(tmp_path, monkeypatch):
+    cache = Cache(str(tmp_path / "web_page"), blobs=True)
+    monkeypatch.setitem(caches, "web_page", cache)
+    return cache
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    """
+    The urls requested by httpx
+    """
+    urls = []
+    get = httpx.Client.get
+
+    def counted_get(self, url, **kwargs):
+        urls.append(url)
+        return get(self, url, **kwargs)
+    monkeypatch.setattr(httpx.Client, "get", counted_get)
+    return urls
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    """
+    The pages run through WebPageHelper.extract_article
+    """
+    calls = []
+    extract_article = WebPageHelper.extract_article
+
+    def counted_extract(self, html):
+        calls.append(html)
+        return extract_article(self, html)
+    monkeypatch.setattr(WebPageHelper, "extract_article", counted_extract)
+    return calls
@@ -0,0 +1,121 @@
+# coding: utf8
+"""
+A GraphRunEngine on simulated agents, no llm nor search: the planner draws a random DAG of
+sub tasks from the seed and the node path, the executor appends to the article and adds
+search results. The runs of a seed are comparable across scheduling modes.
+"""
+import os
+import random
+import zlib
+from loguru import logger
+from overrides import overrides
+from recursive.agent.agent_base import agent_register, Agent
+from recursive.graph import RegularDummyNode, NodeType, TaskStatus
+from recursive.engine import GraphRunEngine
+
+logger.disable("recursive")
+
+# (action, node path) of the agent calls of the current run
+TRACE = []
+SEED = [0]
+
+
+def path(node):
+    nids = []
+    while node is not None:
+        nids.append(str(node.nid))
+        node = node.node_graph_info["outer_node"]
+    return "/".join(nids[::-1])
+
+
+@agent_register.register_module()
+class SimPlanner(Agent):
+    @overrides
+    def forward(self, node, memory, *args, **kwargs):
+        TRACE.append(("plan", path(node)))
+        rng = random.Random(zlib.crc32(path(node).encode()) + SEED[0])
+        if node.node_graph_info["layer"] >= 3 or node.task_info["task_type"] != "write":
+            return {"result": []}
+        plans = []
+        for i in range(rng.randint(2, 5)):
+            task_type = rng.choice(["write", "think", "search", "search"])
+            dependency = sorted(rng.sample(range(i), rng.randint(0, i)))
+            task = {"id": str(i), "goal": "g{}".format(i), "task_type": task_type,
+                    "dependency": [str(d) for d in dependency]}
+            if task_type == "write":
+                task["length"] = "100"
+            plans.append(task)
+        return {"result": plans}
+
+    @overrides
+    def parse_result(self, agent_output, *args, **kwargs):
+        return agent_output
+
+
+@agent_register.register_module()
+class SimExecutor(Agent):
+    @overrides
+    def forward(self, node, memory, *args, **kwargs):
+        TRACE.append(("execute", path(node)))
+        if node.task_type_tag == "COMPOSITION":
+            memory.article += "\n" + path(node)
+        if node.task_type_tag == "RETRIEVAL":
+            for _ in range(3):
+                memory.add_search_result({"global_index": memory.global_start_index})
+        return {"result": "r" + path(node)}
+
+    @overrides
+    def parse_result(self, agent_output, *args, **kwargs):
+        return agent_output
+
+
+config = {
+    "action_mapping": {
+        "plan": ["SimPlanner", {}],
+        "update": ["DummyRandomUpdateAgent", {}],
+        "execute": ["SimExecutor", {}],
+        "final_aggregate": ["DummyRandomFinalAggregateAgent", {}],
+        "prior_reflect": ["DummyRandomPriorReflectionAgent", {}],
+        "planning_post_reflect": ["DummyRandomPlanningPostReflectionAgent", {}],
+        "execute_post_reflect": ["DummyRandomExecutorPostReflectionAgent", {}],
+    },
+    "task_type2tag": {"COMPOSITION": "write", "REASONING": "think", "RETRIEVAL": "search"},
+    "require_keys": {
+        "COMPOSITION": ["id", "dependency", "goal", "task_type", "length"],
+        "RETRIEVAL": ["id", "dependency", "goal", "task_type"],
+        "REASONING": ["id", "dependency", "goal", "task_type"],
+    },
+}
+config["tag2task_type"] = {v: k for k, v in config["task_type2tag"].items()}
+
+
+def make_engine():
+    root = RegularDummyNode(
+        config=config, nid="",
+        node_graph_info={"outer_node": None, "root_node": None, "parent_nodes": [], "layer": 0},
+        task_info={"goal": "q", "task_type": "write", "length": "1000", "dependency": []},
+        node_type=NodeType.PLAN_NODE)
+    root.node_graph_info["root_node"] = root
+    return GraphRunEngine(root, "xml", config)
+
+
+def run(mode, seed, folder, **kwargs):
+    """
+    mode bfs: the step loop of before the ready queue, find_need_next_step_nodes and forward_exam
+    mode serial / parallel: forward_one_step_untill_done
+    Return (trace, article, result, global indices of the search results, engine)
+    """
+    SEED[0] = seed
+    TRACE.clear()
+    os.makedirs(str(folder), exist_ok=True)
+    engine = make_engine()
+    if mode == "bfs":
+        engine.root_node.status = TaskStatus.READY
+        while engine.forward_one_step_not_parallel() != "done":
+            pass
+        result = engine.root_node.get_node_final_result()["result"]
+    else:
+        result = engine.forward_one_step_untill_done(save_folder=str(folder),
+                                                     parallel=(mode == "parallel"), **kwargs)
+    indices = [page["global_index"] for page in engine.memory.all_search_results]
+    return list(TRACE), engine.memory.article, result, indices, engine
@@ -0,0 +1,45 @@
+# coding: utf8
+import pickle
+from recursive.agent.proxy import AgentProxy
+from recursive.checkpoint import iter_tree
+from recursive.graph import RegularDummyNode, TaskStatus
+from sim_engine import config, make_engine, run
+
+
+def test_agent_of_an_action_is_built_once():
+    agent_proxy = AgentProxy(config)
+    agent = agent_proxy.proxy("plan")
+    assert agent_proxy.proxy("plan") is agent
+    assert agent_proxy.proxy("execute") is not agent
+    # Extra construction args get a fresh agent, which is not kept
+    assert agent_proxy.proxy("plan", "arg") is not agent
+    assert agent_proxy.proxy("plan") is agent
+
+
+def test_nodes_of_a_tree_share_the_proxy_of_the_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _, _, _, _, engine = run("serial", 0, tmp_path / "run")
+    nodes = list(iter_tree(engine.root_node))
+    assert len(nodes) > 1
+    assert all(node.agent_proxy is engine.root_node.agent_proxy for node in nodes)
+    # Another tree gets its own proxy
+    assert make_engine().root_node.agent_proxy is not engine.root_node.agent_proxy
+
+
+def test_status_tables_are_shared_by_the_node_class():
+    engine, engine_2 = make_engine(), make_engine()
+    for name in RegularDummyNode.STATUS_TABLES:
+        assert name not in engine.root_node.__dict__
+        assert getattr(engine.root_node, name) is getattr(engine_2.root_node, name)
+
+
+def test_pickled_nodes_leave_out_the_shared_state(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _, _, _, _, engine = run("serial", 1, tmp_path / "run")
+    agent_proxy = engine.root_node.agent_proxy
+    data = pickle.dumps(engine.root_node)
+    assert b"AgentProxy" not in data
+    root_node = pickle.loads(data)
+    assert root_node.status == TaskStatus.FINISH
+    assert root_node.agent_proxy is not agent_proxy
+    assert all(node.agent_proxy is root_node.agent_proxy for node in iter_tree(root_node))
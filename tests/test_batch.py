@@ -0,0 +1,71 @@
+# coding: utf8
+import json
+import os
+import recursive.engine as engine_module
+from recursive.engine import batch_writing
+
+
+def fake_shard(mode, kwargs):
+    """
+    run_shard in the workers: writes each item of the shard input with its shard, fails on the
+    items whose prompt is fail
+    """
+    with open(kwargs["input_filename"]) as f:
+        items = [json.loads(line) for line in f]
+    with open(kwargs["output_filename"] + ".kwargs", "w") as f:
+        json.dump(kwargs, f)
+    for item in items:
+        if item["prompt"] == "fail":
+            raise RuntimeError("shard failure")
+        with open(kwargs["output_filename"], "a") as f:
+            f.write(json.dumps({**item, "result": "r" + item["prompt"]}) + "\n")
+
+
+def write_items(fn, prompts):
+    with open(fn, "w") as f:
+        for prompt in prompts:
+            f.write(json.dumps({"prompt": prompt}) + "\n")
+
+
+def read_items(fn):
+    with open(fn) as f:
+        return [json.loads(line) for line in f]
+
+
+def batch(tmp_path, **kwargs):
+    batch_writing("report", str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"), None, None,
+                  str(tmp_path / "done"), workers=3, nodes_json_file=str(tmp_path / "nodes.json"),
+                  **kwargs)
+
+
+def test_shards_are_merged_in_input_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine_module, "run_shard", fake_shard)
+    prompts = ["p{}".format(i) for i in range(7)]
+    write_items(tmp_path / "in.jsonl", prompts)
+    batch(tmp_path)
+    assert [item["prompt"] for item in read_items(tmp_path / "out.jsonl")] == prompts
+    assert os.path.exists(tmp_path / "done")
+    shard_kwargs = [json.loads(fn.read_text()) for fn in sorted(tmp_path.glob("*.kwargs"))]
+    assert len(shard_kwargs) == 3
+    # One node tree per shard, the cache files are shared
+    assert [os.path.basename(kwargs["nodes_json_file"]) for kwargs in shard_kwargs] == \
+        ["nodes.shard0.json", "nodes.shard1.json", "nodes.shard2.json"]
+    assert all(kwargs["shared_cache"] for kwargs in shard_kwargs)
+    assert not [name for name in os.listdir(tmp_path) if ".shard" in name and
+                name.endswith(".jsonl")]
+
+
+def test_failed_shard_is_resumed(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine_module, "run_shard", fake_shard)
+    write_items(tmp_path / "in.jsonl", ["p0", "p1", "fail", "p3", "p4", "p5"])
+    batch(tmp_path)
+    # The other shards and the items before the failure are kept, the batch is not done
+    assert [item["prompt"] for item in read_items(tmp_path / "out.jsonl")] == \
+        ["p0", "p1", "p4", "p5"]
+    assert not os.path.exists(tmp_path / "done")
+
+    write_items(tmp_path / "in.jsonl", ["p0", "p1", "p2", "p3", "p4", "p5"])
+    batch(tmp_path)
+    assert [item["prompt"] for item in read_items(tmp_path / "out.jsonl")] == \
+        ["p0", "p1", "p2", "p3", "p4", "p5"]
+    assert os.path.exists(tmp_path / "done")
@@ -0,0 +1,191 @@
+# coding: utf8
+import os
+import time
+import pytest
+import recursive.cache as cache_module
+from recursive.cache import Cache, SqliteCache, compact_cache
+
+NAME = "OpenAIApiProxy.call"
+
+
+def save(cache, i, value=None):
+    cache.save_cache(NAME, {"i": i}, value if value is not None else ["v{}".format(i)])
+
+
+def get(cache, i):
+    return cache.get_cache(NAME, {"i": i})
+
+
+def line_count(fn):
+    with open(fn, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def test_lru_evicts_least_recently_used(tmp_path):
+    cache = Cache(str(tmp_path / "llm"), max_entries=3)
+    for i in range(3):
+        save(cache, i)
+    assert get(cache, 0) == ["v0"]
+    save(cache, 3)
+    assert get(cache, 1) is None
+    assert [get(cache, i) for i in (0, 2, 3)] == [["v0"], ["v2"], ["v3"]]
+
+
+def test_max_bytes_counts_line_bytes(tmp_path):
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn)
+    save(cache, 0, ["中文" * 100])
+    line_bytes = os.path.getsize(fn)
+
+    cache = Cache(fn, max_bytes=3 * line_bytes)
+    for i in range(1, 6):
+        save(cache, i, ["中文" * 100])
+    assert cache.total_bytes <= 3 * line_bytes
+    assert len(cache.cache_kv) == 3
+    assert [get(cache, i) is not None for i in range(6)] == [False] * 3 + [True] * 3
+    # Reloading the file applies the same bounds
+    assert len(Cache(fn, max_bytes=3 * line_bytes).cache_kv) == 3
+
+
+def test_ttl_expires_entries(tmp_path, monkeypatch):
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn, ttl=60)
+    save(cache, 0)
+    assert get(cache, 0) == ["v0"]
+    now = time.time()
+    monkeypatch.setattr(cache_module.time, "time", lambda: now + 120)
+    assert get(cache, 0) is None
+    assert not cache.has(cache.make_key(NAME, {"i": 0}))
+    assert len(Cache(fn, ttl=60).cache_kv) == 0
+    assert len(Cache(fn).cache_kv) == 1
+
+
+def test_compaction_keeps_latest_values(tmp_path, monkeypatch):
+    monkeypatch.setattr(Cache, "compact_min_lines", 20)
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn)
+    for round_idx in range(10):
+        for i in range(5):
+            save(cache, i, ["v{}-{}".format(i, round_idx)])
+    # Compacted whenever the overwritten lines outnumber the live ones
+    assert line_count(fn) <= 20
+    reloaded = Cache(fn)
+    assert [get(reloaded, i) for i in range(5)] == [["v{}-9".format(i)] for i in range(5)]
+
+
+def test_compact_applies_bounds_in_lru_order(tmp_path):
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn)
+    for i in range(6):
+        save(cache, i, ["中文" * 100])
+    get(cache, 0)
+    line_bytes = os.path.getsize(fn) // 6
+    cache.max_bytes = 3 * line_bytes
+    compact_cache(cache)
+    assert os.path.getsize(fn) <= 3 * line_bytes
+    assert set(Cache(fn).cache_kv) == set(cache.make_key(NAME, {"i": i}) for i in (0, 4, 5))
+
+
+def test_compact_drops_broken_lines(tmp_path):
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn)
+    save(cache, 0)
+    with open(fn, "a") as f:
+        f.write('{"key": "broken", "val\n')
+    save(cache, 1)
+    compact_cache(cache)
+    assert line_count(fn) == 2
+    assert [get(Cache(fn), i) for i in range(2)] == [["v0"], ["v1"]]
+
+
+@pytest.mark.parametrize("bounds", [{"max_entries": 3}, {"max_bytes": 3 * len('["v0"]')}])
+def test_sqlite_evicts_least_recently_used(tmp_path, monkeypatch, bounds):
+    monkeypatch.setattr(SqliteCache, "touch_interval", 0)
+    cache = SqliteCache(str(tmp_path / "llm"), **bounds)
+    clock = [time.time()]
+
+    def tick():
+        clock[0] += 1
+        return clock[0]
+    monkeypatch.setattr(cache_module.time, "time", tick)
+    for i in range(3):
+        save(cache, i)
+    get(cache, 0)
+    save(cache, 3)
+    cache.evict()
+    assert [get(cache, i) is not None for i in range(4)] == [True, False, True, True]
+
+
+def test_shared_cache_follows_a_peer_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(Cache, "compact_min_lines", 20)
+    fn = str(tmp_path / "llm")
+    cache, peer = Cache(fn, shared=True), Cache(fn, shared=True)
+    for i in range(5):
+        save(cache, i)
+    for round_idx in range(4):
+        for i in range(5):
+            save(peer, i, ["v{}-{}".format(i, round_idx)])
+    # The peer compacted the file, its lines are counted from the new file only
+    assert line_count(fn) <= 20
+    assert get(cache, 5) is None
+    assert cache.disk_lines == line_count(fn)
+    compactions = []
+    monkeypatch.setattr(Cache, "compact", lambda self: compactions.append(self))
+    save(cache, 5)
+    assert compactions == []
+    assert [get(cache, i) for i in range(5)] == [["v{}-3".format(i)] for i in range(5)]
+
+
+def page(i):
+    # Incompressible, the blobs are about as large as the text
+    return os.urandom(2000).hex() + str(i)
+
+
+def blob_files(fn):
+    return sorted(name for _, _, names in os.walk(fn + ".blobs") for name in names)
+
+
+def test_max_bytes_counts_blobs_and_eviction_removes_them(tmp_path):
+    fn = str(tmp_path / "web_page")
+    cache = Cache(fn, blobs=True)
+    save(cache, 0, cache.put_blob(page(0)))
+    entry_bytes = cache.total_bytes
+    assert entry_bytes > os.path.getsize(fn) + 2000
+
+    cache = Cache(fn, blobs=True, max_bytes=int(3.5 * entry_bytes))
+    for i in range(1, 6):
+        save(cache, i, cache.put_blob(page(i)))
+    assert len(cache.cache_kv) == 3
+    assert [get(cache, i) is not None for i in range(6)] == [False] * 3 + [True] * 3
+    assert len(blob_files(fn)) == 3
+    assert all(cache.get_blob(get(cache, i)["blob"]) is not None for i in range(3, 6))
+
+
+def test_shared_blob_is_kept_while_referenced(tmp_path):
+    fn = str(tmp_path / "web_page")
+    cache = Cache(fn, blobs=True, max_entries=2)
+    text = page(0)
+    # The same page under two urls
+    save(cache, 0, cache.put_blob(text))
+    save(cache, 1, cache.put_blob(text))
+    save(cache, 2, cache.put_blob(page(2)))
+    assert cache.get_blob(get(cache, 1)["blob"]) == text
+    save(cache, 3, cache.put_blob(page(3)))
+    assert len(blob_files(fn)) == 2
+
+
+def test_sqlite_max_bytes_counts_blobs(tmp_path, monkeypatch):
+    cache = SqliteCache(str(tmp_path / "web_page"), blobs=True)
+    value = cache.put_blob(page(0))
+    # The rows are small, the blobs take the room
+    cache.max_bytes = 3 * value["blob_bytes"]
+    clock = [time.time()]
+
+    def tick():
+        clock[0] += 1
+        return clock[0]
+    monkeypatch.setattr(cache_module.time, "time", tick)
+    for i in range(5):
+        save(cache, i, cache.put_blob(page(i)))
+    cache.evict()
+    assert [get(cache, i) is not None for i in range(5)] == [False] * 3 + [True] * 2
@@ -0,0 +1,84 @@
+# coding: utf8
+import json
+import os
+import subprocess
+import sys
+from recursive.cache import Cache, SqliteCache, cache_stats, compact_cache, export_cache, \
+    import_cache, open_cache
+
+LLM = "OpenAIApiProxy.call"
+SEARCH = "SerpApiSearch.search"
+PAGE = "WebPageHelper.download_webpage"
+
+
+def llm_call(i, model):
+    return {"model": model, "messages": [{"role": "user", "content": "q{}".format(i)}]}
+
+
+def line_count(fn):
+    with open(fn) as f:
+        return sum(1 for _ in f)
+
+
+def record(fn):
+    cache = Cache(fn)
+    for i in range(6):
+        cache.save_cache(LLM, llm_call(i, "m{}".format(i % 2)), ["a{}".format(i)])
+    cache.save_cache(LLM, llm_call(0, "m0"), ["latest"])
+    cache.save_cache(SEARCH, {"query": "tides"}, ["r"])
+
+
+def test_stats_and_compact(tmp_path):
+    fn = str(tmp_path / "key-llm")
+    record(fn)
+    stats = cache_stats(open_cache(fn, mode=''))
+    assert stats[LLM]["entries"] == 6 and stats[LLM]["overwritten"] == 1
+    assert stats[LLM]["lines"] == 7
+    assert stats[LLM]["models"] == {"m0": 3, "m1": 3}
+    assert stats[SEARCH]["entries"] == 1
+
+    compact_cache(open_cache(fn))
+    assert line_count(fn) == 7
+    assert Cache(fn).get_cache(LLM, llm_call(0, "m0")) == ["latest"]
+    cache = open_cache(fn)
+    cache.max_entries = 3
+    compact_cache(cache)
+    assert line_count(fn) == 3
+
+
+def test_export_import_round_trip(tmp_path):
+    fn = str(tmp_path / "key-llm")
+    record(fn)
+    bundle = str(tmp_path / "bundle.jsonl.gz")
+    assert export_cache(open_cache(fn, mode=''), bundle, cache_name=LLM, model="m0") == 3
+
+    other_fn = str(tmp_path / "other" / "key-llm")
+    other = SqliteCache(other_fn)
+    other.save_cache(LLM, llm_call(0, "m0"), ["mine"])
+    assert import_cache(other, bundle) == (2, 1)
+    # The existing entry is kept unless overwrite
+    assert other.get_cache(LLM, llm_call(0, "m0")) == ["mine"]
+    assert other.get_cache(LLM, llm_call(2, "m0")) == ["a2"]
+    assert other.get_cache(LLM, llm_call(1, "m1")) is None
+    assert other.get_cache(SEARCH, {"query": "tides"}) is None
+    assert import_cache(other, bundle, overwrite=True) == (3, 0)
+    assert other.get_cache(LLM, llm_call(0, "m0")) == ["latest"]
+
+
+def test_cli_moves_the_blobs_with_the_bundle(tmp_path):
+    fn = str(tmp_path / "key-web_page")
+    cache = Cache(fn, blobs=True)
+    cache.save_cache(PAGE, {"url": "u"}, cache.put_blob("<html>page</html>"))
+    bundle = str(tmp_path / "bundle.jsonl")
+    other_fn = str(tmp_path / "other" / "key-web_page")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for args in (["export", fn, bundle], ["import", bundle, other_fn]):
+        subprocess.run([sys.executable, "-m", "recursive.cache"] + args, cwd=root, check=True,
+                       capture_output=True)
+    with open(bundle) as f:
+        assert json.loads(f.readline())["blob_text"] == "<html>page</html>"
+
+    other = Cache(other_fn, blobs=True)
+    value = other.get_cache(PAGE, {"url": "u"})
+    assert other.get_blob(value["blob"]) == "<html>page</html>"
+    assert value["blob_bytes"] == cache.get_cache(PAGE, {"url": "u"})["blob_bytes"]
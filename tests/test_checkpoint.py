@@ -0,0 +1,90 @@
+# coding: utf8
+import json
+import pytest
+import recursive.checkpoint as checkpoint
+import recursive.engine as engine_module
+import recursive.memory as memory_module
+from sim_engine import make_engine, run
+
+
+class Crash(Exception):
+    pass
+
+
+def tree_state(engine):
+    return (json.dumps(engine.root_node.to_json(), sort_keys=True, default=str),
+            [node.hashkey for node in checkpoint.iter_tree(engine.root_node)],
+            engine.memory.article, engine.memory.all_search_results,
+            engine.memory.global_start_index)
+
+
+@pytest.mark.parametrize("mode", ["serial", "parallel"])
+@pytest.mark.parametrize("seed", range(4))
+def test_journal_replay_equals_live_state(seed, mode, tmp_path, monkeypatch):
+    record = checkpoint.CheckpointJournal.record
+    checked = []
+
+    def record_and_check(self, engine, step, nodes, force_snapshot=False):
+        record(self, engine, step, nodes, force_snapshot)
+        loaded = make_engine()
+        assert loaded.load(self.folder) == step
+        assert tree_state(loaded) == tree_state(engine)
+        checked.append(step)
+    monkeypatch.setattr(checkpoint.CheckpointJournal, "record", record_and_check)
+    run(mode, seed, tmp_path, checkpoint_mode="journal", snapshot_interval=5)
+    assert len(checked) > 10
+
+
+@pytest.mark.parametrize("checkpoint_mode", ["full", "journal"])
+@pytest.mark.parametrize("mode", ["serial", "parallel"])
+@pytest.mark.parametrize("crash_at", [3, 9, 17])
+def test_resume_after_crash(crash_at, mode, checkpoint_mode, tmp_path, monkeypatch):
+    kwargs = dict(checkpoint_mode=checkpoint_mode, snapshot_interval=4)
+    _, article, result, indices, _ = run(mode, 1, tmp_path / "whole", **kwargs)
+
+    name = "forward_one_step_not_parallel" if mode == "serial" else "forward_one_step_parallel"
+    forward = getattr(engine_module.GraphRunEngine, name)
+    calls = []
+
+    def crashing_forward(self, *args, **kwargs):
+        calls.append(1)
+        if len(calls) == crash_at:
+            raise Crash()
+        return forward(self, *args, **kwargs)
+    with monkeypatch.context() as patch:
+        patch.setattr(engine_module.GraphRunEngine, name, crashing_forward)
+        with pytest.raises(Crash):
+            run(mode, 1, tmp_path / "crashed", **kwargs)
+    _, article_2, result_2, indices_2, _ = run(mode, 1, tmp_path / "crashed", resume=True, **kwargs)
+    assert article_2 == article
+    assert result_2 == result
+    assert indices_2 == indices
+
+
+@pytest.mark.parametrize("checkpoint_mode", ["full", "journal"])
+def test_crash_during_snapshot_keeps_previous_one(checkpoint_mode, tmp_path, monkeypatch):
+    kwargs = dict(checkpoint_mode=checkpoint_mode, snapshot_interval=2)
+    _, article, result, indices, _ = run("serial", 3, tmp_path / "whole", **kwargs)
+
+    save = memory_module.Memory.save
+    calls = []
+
+    def crashing_save(self, folder):
+        calls.append(1)
+        if len(calls) == 6:
+            raise Crash()
+        return save(self, folder)
+    with monkeypatch.context() as patch:
+        patch.setattr(memory_module.Memory, "save", crashing_save)
+        with pytest.raises(Crash):
+            run("serial", 3, tmp_path / "crashed", **kwargs)
+    with open(tmp_path / "crashed" / "checkpoint.json") as f:
+        published = json.load(f)
+    loaded = make_engine()
+    assert loaded.load(str(tmp_path / "crashed")) >= published["step"]
+
+    _, article_2, result_2, indices_2, _ = run("serial", 3, tmp_path / "crashed", resume=True,
+                                               **kwargs)
+    assert article_2 == article
+    assert result_2 == result
+    assert indices_2 == indices
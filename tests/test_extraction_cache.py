@@ -0,0 +1,41 @@
+# coding: utf8
+import recursive.executor.actions.bing_browser as bing_browser
+from recursive.executor.actions.bing_browser import WebPageHelper
+
+
+def test_warm_run_skips_download_and_extraction(mock_provider, web_page_cache, fetches,
+                                                extractions):
+    urls = [mock_provider() + "/page/{}".format(name) for name in ("a", "b")]
+    articles = WebPageHelper().urls_to_articles(urls)
+    assert sorted(articles) == sorted(urls)
+    assert WebPageHelper().urls_to_articles(urls) == articles
+    assert len(fetches) == 2 and len(extractions) == 2
+
+
+def test_extractor_version_is_part_of_the_key(mock_provider, web_page_cache, fetches,
+                                              extractions, monkeypatch):
+    url = mock_provider() + "/page/a"
+    articles = WebPageHelper().urls_to_articles([url])
+    monkeypatch.setattr(bing_browser, "EXTRACTOR_VERSION", "other-extractor")
+    assert WebPageHelper().urls_to_articles([url]) == articles
+    # The page comes from the cache, only the extraction runs again
+    assert len(fetches) == 1 and len(extractions) == 2
+
+
+def test_empty_extraction_is_cached(mock_provider, web_page_cache, fetches, extractions,
+                                    monkeypatch):
+    url = mock_provider() + "/page/a"
+    monkeypatch.setattr(WebPageHelper, "extract_article",
+                        lambda self, html: extractions.append(html))
+    assert WebPageHelper().urls_to_articles([url]) == {}
+    assert WebPageHelper().urls_to_articles([url]) == {}
+    assert len(fetches) == 1 and len(extractions) == 1
+
+
+def test_min_char_count_applies_to_cached_text(mock_provider, web_page_cache, fetches,
+                                               extractions):
+    url = mock_provider() + "/page/a"
+    assert WebPageHelper(min_char_count=10 ** 6).urls_to_articles([url]) == {}
+    # A helper with another threshold shares the entry
+    assert url in WebPageHelper().urls_to_articles([url])
+    assert len(fetches) == 1 and len(extractions) == 1
@@ -0,0 +1,63 @@
+# coding: utf8
+import threading
+import pytest
+import requests
+import recursive.llm.llm as llm_module
+from recursive.llm.llm import OpenAIApiProxy, configure_http_pool, get_openai_client, get_session
+
+MODEL = "Mock/mock-model"
+
+
+@pytest.fixture
+def fresh_pool():
+    pool_size = llm_module.http_pool_size
+    configure_http_pool(pool_size)
+    yield
+    configure_http_pool(pool_size)
+
+
+def test_one_session_per_base_url(fresh_pool):
+    session = get_session("http://127.0.0.1:1/v1/chat/completions")
+    assert get_session("http://127.0.0.1:1/other") is session
+    assert get_session("http://127.0.0.1:2/v1/chat/completions") is not session
+    assert session.get_adapter("http://127.0.0.1:1/").poolmanager.connection_pool_kw[
+        "maxsize"] == llm_module.http_pool_size
+    client = get_openai_client("https://openrouter.ai/api/v1", "key")
+    assert get_openai_client("https://openrouter.ai/api/v1", "key") is client
+    assert get_openai_client("https://openrouter.ai/api/v1", "other") is not client
+
+
+def test_configure_http_pool_replaces_the_sessions(fresh_pool):
+    session = get_session("http://127.0.0.1:1/v1")
+    configure_http_pool(4)
+    resized = get_session("http://127.0.0.1:1/v1")
+    assert resized is not session
+    assert resized.get_adapter("http://127.0.0.1:1/").poolmanager.connection_pool_kw[
+        "maxsize"] == 4
+
+
+def test_proxies_share_the_session(mock_provider, fresh_pool, monkeypatch):
+    base_url = mock_provider()
+    used = []
+    request = requests.Session.request
+
+    def counted_request(self, *args, **kwargs):
+        used.append(id(self))
+        return request(self, *args, **kwargs)
+    monkeypatch.setattr(requests.Session, "request", counted_request)
+
+    contents = []
+
+    def work(i):
+        proxy = OpenAIApiProxy(verbose=False)
+        for j in range(5):
+            messages = [{"role": "user", "content": "q{} {}".format(i, j)}]
+            contents.append(proxy.call(MODEL, messages, no_cache=True)[0]["message"]["content"])
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(contents) == 40 and all(contents)
+    assert len(used) == 40
+    assert set(used) == {id(get_session(base_url + "/v1/chat/completions"))}
@@ -0,0 +1,85 @@
+# coding: utf8
+import json
+import re
+import requests
+from recursive.engine import report_writing
+from recursive.llm.mock import MockResponder
+
+
+def chat(base_url, content):
+    params = {"model": "mock", "messages": [{"role": "user", "content": content}]}
+    return requests.post(base_url + "/v1/chat/completions", json=params, timeout=10)
+
+
+def test_completion_is_deterministic(mock_provider):
+    base_url = mock_provider()
+    first = chat(base_url, "write about tides").json()
+    assert first == chat(base_url, "write about tides").json()
+    assert first["choices"][0]["message"]["content"] != \
+        chat(base_url, "write about winds").json()["choices"][0]["message"]["content"]
+    assert first["usage"]["total_tokens"] > 0
+    atom = chat(base_url, "<atomic_task_determination>").json()["choices"][0]["message"]
+    assert re.search(r"<atomic_task_determination>\n(atomic|complex)\n", atom["content"])
+
+
+def plan_of(responder, prompt):
+    _, content = responder.respond([{"role": "user", "content": prompt}])
+    return json.loads(re.search(r"<result>\n(.*)\n</result>", content, re.S).group(1))
+
+
+def test_planning_chain_and_fanout():
+    sub_tasks = plan_of(MockResponder(), "**sub_tasks** `search`")["sub_tasks"]
+    assert [task["dependency"] for task in sub_tasks] == [[], ["1"], ["2"], ["3"]]
+
+    sub_tasks = plan_of(MockResponder(plan_fanout=3), "**sub_tasks** `search`")["sub_tasks"]
+    searches = [task for task in sub_tasks if task["task_type"] == "search"]
+    writes = [task for task in sub_tasks if task["task_type"] == "write"]
+    assert len(searches) == 3 and all(task["dependency"] == [] for task in searches)
+    assert sorted(task["dependency"][0] for task in writes) == \
+        sorted(task["id"] for task in searches)
+    # Without the search task type in the prompt the branches start with a think task
+    sub_tasks = plan_of(MockResponder(plan_fanout=2), "**sub_tasks**")["sub_tasks"]
+    assert [task["task_type"] for task in sub_tasks] == ["think", "write"] * 2
+
+
+def test_search_results_link_served_pages(mock_provider):
+    base_url = mock_provider(topk=4)
+    data = requests.get(base_url + "/search", params={"q": "tides", "format": "json"},
+                        timeout=10).json()
+    assert len(data["results"]) == 4
+    page = requests.get(data["results"][0]["url"], timeout=10)
+    assert page.status_code == 200 and "<article>" in page.text
+    stats = requests.get(base_url + "/stats", timeout=10).json()
+    assert stats == {"search": 1, "page": 1}
+
+
+def test_failures_ask_to_retry_after(mock_provider):
+    base_url = mock_provider(failure_rate=1.0, failure_codes=[429], retry_after=2)
+    response = chat(base_url, "write about tides")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert requests.get(base_url + "/stats", timeout=10).json() == {"llm_failed": 1}
+
+
+def test_offline_replay_of_a_recorded_report(mock_provider, tmp_path, monkeypatch):
+    base_url = mock_provider(plan_rate=0.2, plan_fanout=1, output_tokens=30, topk=1)
+    monkeypatch.setenv("Searxng_BASE_URL", base_url + "/search")
+    monkeypatch.setenv("Searxng_KEY", "mock")
+    monkeypatch.chdir(tmp_path)
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text(json.dumps({"id": "q1", "prompt": "Write a short report on storms"}))
+    (tmp_path / "out").mkdir()
+    recorded, replayed = tmp_path / "out" / "recorded.jsonl", tmp_path / "out" / "result.jsonl"
+
+    report_writing(str(input_file), str(recorded), 0, 1, None, "Mock/mock-model", "Searxng")
+    calls = requests.get(base_url + "/stats", timeout=10).json()
+    # The root task of this prompt is planned, the run searches and reads pages
+    assert calls["llm"] > 2 and calls["search"] > 0 and calls["page"] > 0
+    # The replay is served by the caches alone, nothing listens on the discard port
+    monkeypatch.setenv("Mock_BASE_URL", "http://127.0.0.1:9/v1")
+    monkeypatch.setenv("Searxng_BASE_URL", "http://127.0.0.1:9/search")
+    report_writing(str(input_file), str(replayed), 0, 1, None, "Mock/mock-model", "Searxng",
+                   offline=True)
+    assert replayed.read_text() == recorded.read_text()
+    with open(tmp_path / "records" / "q1" / "bench.json") as f:
+        assert json.load(f)["cache_misses"] == {"search": 0, "llm": 0, "web_page": 0}
@@ -0,0 +1,75 @@
+# coding: utf8
+import pytest
+import requests
+from recursive.cache import Cache
+from recursive.memory import caches
+from recursive.llm.llm import OpenAIApiProxy
+from recursive.near_cache import NearDuplicateIndex, enable_near_cache, near_cache_sites, \
+    simhash, SIMHASH_BITS
+
+MODEL = "Mock/mock-model"
+PAGE = " ".join("the tide on day {} rises with the moon over the bay".format(i) for i in range(40))
+
+
+def distance(a, b):
+    return bin(simhash(a) ^ simhash(b)).count("1")
+
+
+def judge(think):
+    return [{"role": "user", "content": "Judge the page.\n{}\n{}".format(PAGE, think)}]
+
+
+@pytest.fixture
+def near_sites():
+    yield enable_near_cache
+    near_cache_sites.clear()
+
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    cache = Cache(str(tmp_path / "llm"))
+    monkeypatch.setitem(caches, "llm", cache)
+    return cache
+
+
+def test_sites_and_thresholds(near_sites):
+    near_sites(["selector", "summarizer:0.9"])
+    assert near_cache_sites == {"selector": 0.95, "summarizer": 0.9}
+    with pytest.raises(Exception, match="below the lowest supported"):
+        near_sites(["selector:0.8"])
+
+
+def test_simhash_distance():
+    # Digits and case are normalized away
+    assert simhash("Report of 2024, page 3") == simhash("report of 1999, page 12")
+    assert distance(PAGE + " think a", PAGE + " think b") <= 3
+    assert distance(PAGE, "a different page about mountain weather and winds") > \
+        SIMHASH_BITS * 0.05
+
+
+def test_index_finds_the_closest_within_the_distance(tmp_path):
+    fn = str(tmp_path / "llm.simhash.jsonl")
+    index = NearDuplicateIndex(fn)
+    index.add("b", 0b1111, "k4")
+    index.add("b", 0b1, "k1")
+    index.add("other", 0b0, "k0")
+    assert index.query("b", 0b0, 1) == ["k1"]
+    assert index.query("b", 0b0, 4) == ["k1", "k4"]
+    assert index.query("b", 1 << 63, 1) == []
+    # Persisted for the next runs
+    assert NearDuplicateIndex(fn).query("b", 0b0, 4) == ["k1", "k4"]
+
+
+def test_similar_call_is_served_by_the_near_tier(mock_provider, llm_cache, near_sites):
+    base_url = mock_provider()
+    near_sites(["selector"])
+    proxy = OpenAIApiProxy(verbose=False)
+    result = proxy.call(MODEL, judge("think a"), near_cache_site="selector")
+    assert proxy.call(MODEL, judge("think b"), near_cache_site="selector") == result
+    assert llm_cache.get_stats()["OpenAIApiProxy.call"]["near_hits"] == 1
+    assert requests.get(base_url + "/stats", timeout=10).json() == {"llm": 1}
+    # Disabled sites, other call args and dissimilar prompts are exact lookups
+    proxy.call(MODEL, judge("think c"), near_cache_site="summarizer")
+    proxy.call(MODEL, judge("think d"), near_cache_site="selector", temperature=0.5)
+    proxy.call(MODEL, judge("think e " + "and so on " * 80), near_cache_site="selector")
+    assert requests.get(base_url + "/stats", timeout=10).json() == {"llm": 4}
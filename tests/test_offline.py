@@ -0,0 +1,57 @@
+# coding: utf8
+import json
+import pytest
+import recursive.engine as engine_module
+from recursive.cache import Cache, CacheMissError
+from recursive.memory import caches
+from sim_engine import run
+
+NAME = "OpenAIApiProxy.call"
+
+
+def test_strict_cache_serves_recorded_calls_only(tmp_path):
+    fn = str(tmp_path / "llm")
+    Cache(fn).save_cache(NAME, {"i": 0}, ["v0"])
+    cache = Cache(fn, mode="r", strict=True)
+    assert cache.get_cache(NAME, {"i": 0}) == ["v0"]
+    with pytest.raises(CacheMissError):
+        cache.get_cache(NAME, {"i": 1})
+    # A composite call falls back to its cached underlying calls
+    assert cache.get_cache(NAME, {"i": 1}, strict=False) is None
+    assert cache.misses == 1
+    # Read only, the replay never changes the recording
+    cache.save_cache(NAME, {"i": 1}, ["v1"])
+    assert Cache(fn).get_cache(NAME, {"i": 1}) is None
+
+
+def test_offline_caches_are_strict_and_unbounded(tmp_path, monkeypatch):
+    for name in ("search", "llm", "web_page"):
+        monkeypatch.setitem(caches, name, None)
+    engine_module.set_caches(str(tmp_path / "records"), "key", offline=True,
+                             cache_limits={"llm": {"max_entries": 1}})
+    for name in ("search", "llm", "web_page"):
+        assert caches[name].strict and caches[name].mode == "r"
+        assert caches[name].fn == "{}/records/../cache/key-{}".format(tmp_path, name)
+    assert caches["llm"].max_entries is None
+
+
+def test_bench_file_reports_the_run(tmp_path, monkeypatch):
+    cache = Cache(str(tmp_path / "llm"), mode="r", strict=True)
+    for name in ("search", "llm", "web_page"):
+        monkeypatch.setitem(caches, name, None)
+    monkeypatch.setitem(caches, "llm", cache)
+    monkeypatch.chdir(tmp_path)
+    bench_file = str(tmp_path / "bench.json")
+    _, _, _, _, engine = run("serial", 0, tmp_path / "run", bench_file=bench_file)
+    with open(bench_file) as f:
+        bench = json.load(f)
+    assert bench["node_cnt"] == sum(1 for _ in engine_module.iter_tree(engine.root_node))
+    assert bench["steps"] > 0 and bench["wall_time"] > 0
+    assert bench["steps_per_sec"] == pytest.approx(bench["steps"] / bench["wall_time"])
+    assert bench["cache_misses"] == {"llm": 0}
+    engine_module.check_offline_misses()
+
+    with pytest.raises(CacheMissError):
+        cache.get_cache(NAME, {"i": 0})
+    with pytest.raises(Exception, match="missed the recorded caches"):
+        engine_module.check_offline_misses()
@@ -0,0 +1,28 @@
+# coding: utf8
+import pytest
+from sim_engine import run
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_parallel_runs_are_identical(seed, tmp_path):
+    trace, article, result, indices, _ = run("parallel", seed, tmp_path / "a", max_workers=4)
+    trace_2, article_2, result_2, indices_2, _ = run("parallel", seed, tmp_path / "b",
+                                                     max_workers=4)
+    assert sorted(trace_2) == sorted(trace)
+    assert article_2 == article
+    assert result_2 == result
+    assert indices_2 == indices
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_parallel_matches_serial(seed, tmp_path):
+    trace, article, result, indices, _ = run("serial", seed, tmp_path / "serial")
+    trace_par, article_par, result_par, indices_par, engine = run(
+        "parallel", seed, tmp_path / "parallel", max_workers=4)
+    assert sorted(trace_par) == sorted(trace)
+    assert article_par == article
+    assert result_par == result
+    # The search result indices are merged back compact, as a serial run numbers them
+    assert indices_par == indices
+    assert indices_par == list(range(1, len(indices_par) + 1))
+    assert engine.memory.global_start_index == len(indices_par) + 1
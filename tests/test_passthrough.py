@@ -0,0 +1,45 @@
+# coding: utf8
+import pytest
+import sim_engine
+from recursive.engine import GraphRunEngine
+from recursive.graph import TaskStatus
+from sim_engine import make_engine, run
+
+
+def steps_of(mode, seed, folder, monkeypatch):
+    # The engine checkpoints once per step
+    steps = []
+    save = GraphRunEngine.save
+    monkeypatch.setattr(GraphRunEngine, "save",
+                        lambda engine, *args: steps.append(args) or save(engine, *args))
+    trace, article, result, indices, _ = run(mode, seed, folder)
+    return (trace, article, result, indices), len(steps)
+
+
+@pytest.mark.parametrize("mode", ["serial", "parallel"])
+@pytest.mark.parametrize("seed", range(5))
+def test_collapsed_run_matches_one_action_per_step(mode, seed, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    collapsed, collapsed_steps = steps_of(mode, seed, tmp_path / "collapsed", monkeypatch)
+    monkeypatch.setitem(sim_engine.config, "collapse_passthrough", False)
+    expanded, expanded_steps = steps_of(mode, seed, tmp_path / "expanded", monkeypatch)
+    assert [sorted(collapsed[0])] + list(collapsed[1:]) == \
+        [sorted(expanded[0])] + list(expanded[1:])
+    assert collapsed_steps < expanded_steps
+
+
+def test_run_node_step_applies_the_passthrough_actions_inline(monkeypatch):
+    engine = make_engine()
+    engine.root_node.status = TaskStatus.READY
+    # The plan and the passthrough reflection after it, then it stops before the next real action
+    assert engine.run_node_step(engine.root_node, engine.memory) == ["plan", "prior_reflect"]
+    assert engine.root_node.status == TaskStatus.DOING
+    assert engine.run_node_step(engine.root_node, engine.memory) == []
+
+    monkeypatch.setitem(sim_engine.config, "collapse_passthrough", False)
+    engine = make_engine()
+    engine.root_node.status = TaskStatus.READY
+    assert engine.run_node_step(engine.root_node, engine.memory) == ["plan"]
+    assert engine.root_node.status == TaskStatus.PLAN_DONE
+    assert engine.run_node_step(engine.root_node, engine.memory) == ["prior_reflect"]
+    assert engine.root_node.status == TaskStatus.DOING
@@ -0,0 +1,115 @@
+# coding: utf8
+import pytest
+import recursive.llm.rate_limit as rate_limit
+from recursive.llm.rate_limit import (RateLimiter, configure_rate_limits, get_limiter,
+                                      parse_rate_limit)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "time", clock.time)
+    monkeypatch.setattr(rate_limit.time, "sleep", clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def limits():
+    yield configure_rate_limits
+    configure_rate_limits([])
+
+
+def test_parse_rate_limit():
+    assert parse_rate_limit("OpenAI/gpt-4o:rpm=500,tpm=30000") == (
+        "OpenAI/gpt-4o", {"rpm": 500, "tpm": 30000})
+    assert parse_rate_limit("Anthropic:rpm=50") == ("Anthropic", {"rpm": 50})
+    for spec in ("Anthropic", "Anthropic:rpm", "Anthropic:rps=5"):
+        with pytest.raises(Exception):
+            parse_rate_limit(spec)
+
+
+def test_requests_bucket(clock):
+    limiter = RateLimiter("OpenAI/gpt-4o", rpm=60)
+    for _ in range(60):
+        assert limiter.acquire(100) == 0
+    # Empty, one request more is a second of refill
+    assert limiter.acquire(100) == pytest.approx(1.0)
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_tokens_bucket(clock):
+    limiter = RateLimiter("OpenAI/gpt-4o", tpm=1200)
+    assert limiter.acquire(1000) == 0
+    # 800 tokens missing, 1200 per minute
+    assert limiter.acquire(1000) == pytest.approx(40.0)
+    assert limiter.state["tokens"][0] == pytest.approx(0.0)
+
+
+def test_bucket_holds_at_most_a_minute(clock):
+    limiter = RateLimiter("OpenAI/gpt-4o", rpm=60)
+    clock.now += 3600
+    for _ in range(60):
+        limiter.acquire(0)
+    assert limiter.acquire(0) > 0
+
+
+def test_large_prompt_goes_into_debt(clock):
+    limiter = RateLimiter("OpenAI/gpt-4o", tpm=1000)
+    assert limiter.acquire(5000) == 0
+    assert limiter.state["tokens"][0] == pytest.approx(-4000)
+    # The next call waits for the debt to be paid back and its own tokens
+    assert limiter.acquire(100) == pytest.approx(4100 * 60 / 1000, abs=0.01)
+
+
+def test_reconcile_with_usage(clock):
+    limiter = RateLimiter("OpenAI/gpt-4o", tpm=1000)
+    limiter.acquire(100)
+    limiter.reconcile(100, 700)
+    assert limiter.state["tokens"][0] == pytest.approx(300)
+    limiter.reconcile(300, 100)
+    assert limiter.state["tokens"][0] == pytest.approx(500)
+    limiter.reconcile(100, None)
+    assert limiter.state["tokens"][0] == pytest.approx(500)
+
+
+def test_state_file_is_shared(clock, tmp_path):
+    state_file = str(tmp_path / "OpenAI.json")
+    # Two processes, each with its own limiter on the same file
+    first = RateLimiter("OpenAI", rpm=10, state_file=state_file)
+    second = RateLimiter("OpenAI", rpm=10, state_file=state_file)
+    for _ in range(5):
+        first.acquire(0)
+        second.acquire(0)
+    assert first.acquire(0) == pytest.approx(6.0)
+    assert second.state["requests"][0] == pytest.approx(0.0)
+
+
+def test_broken_state_file_starts_full(clock, tmp_path):
+    state_file = tmp_path / "OpenAI.json"
+    state_file.write_text('{"requests": [0.0, ')
+    limiter = RateLimiter("OpenAI", rpm=10, state_file=str(state_file))
+    assert limiter.acquire(0) == 0
+
+
+def test_get_limiter(limits, tmp_path):
+    limits(["OpenAI/gpt-4o:rpm=500,tpm=30000", "OpenAI:rpm=100"], str(tmp_path))
+    model_limiter = get_limiter("OpenAI", "gpt-4o")
+    assert model_limiter.capacity == {"requests": 500, "tokens": 30000}
+    # The provider entry is one bucket for all its other models
+    assert get_limiter("OpenAI", "gpt-4o-mini") is get_limiter("OpenAI", "o3")
+    assert get_limiter("OpenAI", "o3").capacity == {"requests": 100, "tokens": None}
+    assert get_limiter("OpenAI", "o3").state_file == str(tmp_path / "OpenAI.json")
+    assert get_limiter("Anthropic", "claude") is None
@@ -0,0 +1,164 @@
+# coding: utf8
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+import pytest
+import requests
+import recursive.llm.retry as retry_module
+from recursive.llm.retry import RetryPolicy, parse_duration, retry_after
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.text = "status {}".format(status_code)
+
+
+class FakeClock:
+    """
+    time.time and time.sleep of the retry module, sleeping only advances the clock
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(retry_module.time, "time", clock.time)
+    monkeypatch.setattr(retry_module.time, "sleep", clock.sleep)
+    return clock
+
+
+def sender(responses):
+    responses = list(responses)
+
+    def send(timeout):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    return send
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("2", 2.0), ("0.5", 0.5), ("1m30s", 90.0), ("250ms", 0.25), ("1h", 3600.0), ("-3", 0.0),
+    ("soon", None), ("1m30", None),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+def test_parse_duration_of_dates():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 < parse_duration(format_datetime(when, usegmt=True)) <= 30
+    assert 25 < parse_duration(when.isoformat().replace("+00:00", "Z")) <= 30
+    assert parse_duration(format_datetime(when - timedelta(minutes=5), usegmt=True)) == 0.0
+
+
+def test_retry_after_headers():
+    assert retry_after(FakeResponse(429, {"Retry-After": "3"})) == 3.0
+    assert retry_after(FakeResponse(503, {"retry-after-ms": "1500", "Retry-After": "3"})) == 1.5
+    reset = {"x-ratelimit-reset-requests": "2s", "x-ratelimit-reset-tokens": "1m"}
+    assert retry_after(FakeResponse(429, reset)) == 60.0
+    # The reset headers come with every response, they only count once the limit is hit
+    assert retry_after(FakeResponse(503, reset)) is None
+    assert retry_after(FakeResponse(500)) is None
+
+
+@pytest.mark.parametrize("status_code, retryable", [
+    (200, False), (400, False), (401, False), (403, False), (404, False), (422, False),
+    (408, True), (409, True), (425, True), (429, True), (500, True), (502, True), (503, True),
+    (504, True), (529, True),
+])
+def test_classification(status_code, retryable):
+    assert RetryPolicy().is_retryable(FakeResponse(status_code)) == retryable
+
+
+def test_client_error_is_returned_at_once(clock):
+    response = RetryPolicy().run(sender([FakeResponse(401), FakeResponse(200)]))
+    assert response.status_code == 401
+    assert clock.sleeps == []
+
+
+def test_retries_until_success(clock):
+    policy = RetryPolicy(base_delay=1.0, max_delay=8.0)
+    responses = [FakeResponse(500), requests.exceptions.ConnectionError("reset"), FakeResponse(503),
+                 FakeResponse(200)]
+    assert policy.run(sender(responses)).status_code == 200
+    assert len(clock.sleeps) == 3
+    # Full jitter, within the exponential bound of each attempt
+    assert all(0 <= wait <= 2 ** attempt for attempt, wait in enumerate(clock.sleeps))
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError("status {}".format(status_code), response=response)
+
+
+def test_request_exceptions_are_retried(clock):
+    errors = [requests.exceptions.ChunkedEncodingError("broken body"),
+              requests.exceptions.ContentDecodingError("bad gzip"), http_error(502)]
+    assert RetryPolicy().run(sender(errors + [FakeResponse(200)])).status_code == 200
+    assert len(clock.sleeps) == 3
+
+
+def test_client_http_error_is_raised_at_once(clock):
+    with pytest.raises(requests.exceptions.HTTPError):
+        RetryPolicy().run(sender([http_error(403), FakeResponse(200)]))
+    assert clock.sleeps == []
+
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    assert all(0 <= policy.backoff(attempt) <= 5.0 for attempt in range(20))
+
+
+def test_retry_after_is_honoured(clock):
+    policy = RetryPolicy(base_delay=0.5)
+    responses = [FakeResponse(429, {"Retry-After": "7"}), FakeResponse(200)]
+    assert policy.run(sender(responses)).status_code == 200
+    assert 7 <= clock.sleeps[0] <= 7.5
+
+
+def test_deadline_returns_last_response(clock):
+    policy = RetryPolicy(deadline=30, base_delay=1.0, max_delay=1.0)
+    send = sender([FakeResponse(503)] * 100)
+    response = policy.run(send)
+    assert response.status_code == 503
+    assert clock.now - 1000.0 <= 30
+    # Retry-After past the deadline gives up without sleeping
+    clock.sleeps.clear()
+    response = policy.run(sender([FakeResponse(429, {"Retry-After": "60"})]), deadline=30)
+    assert response.status_code == 429
+    assert clock.sleeps == []
+
+
+def test_deadline_raises_the_connection_errors(clock):
+    policy = RetryPolicy(deadline=10, base_delay=1.0, max_delay=1.0)
+    errors = [requests.exceptions.ConnectionError("refused")] * 100
+    with pytest.raises(requests.exceptions.Timeout):
+        policy.run(sender(errors))
+    assert clock.now - 1000.0 <= 10
+
+
+def test_attempt_timeout_fits_the_deadline(clock):
+    policy = RetryPolicy(deadline=100, attempt_timeout=60, base_delay=0.0)
+    timeouts = []
+
+    def slow_failure(timeout):
+        timeouts.append(timeout)
+        clock.now += timeout
+        raise requests.exceptions.Timeout("read timeout")
+    with pytest.raises(requests.exceptions.Timeout):
+        policy.run(slow_failure)
+    assert timeouts == [60, 40]
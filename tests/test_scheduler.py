@@ -0,0 +1,39 @@
+# coding: utf8
+import pytest
+from recursive.graph import TaskStatus
+from recursive.scheduler import ReadyQueue
+from sim_engine import make_engine, run, SEED
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_same_steps_as_bfs(seed, tmp_path):
+    trace, article, result, indices, _ = run("bfs", seed, tmp_path)
+    trace_rq, article_rq, result_rq, indices_rq, _ = run("serial", seed, tmp_path)
+    assert trace_rq == trace
+    assert article_rq == article
+    assert result_rq == result
+    assert indices_rq == indices
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ready_nodes_in_bfs_order(seed):
+    SEED[0] = seed
+    engine = make_engine()
+    engine.root_node.status = TaskStatus.READY
+    engine.ready_queue = ReadyQueue(engine.root_node)
+    steps = 0
+    while True:
+        expected = engine.find_need_next_step_nodes()
+        assert engine.ready_queue.ready_nodes() == expected
+        assert engine.ready_queue.peek() is (expected[0] if len(expected) > 0 else None)
+        if engine.forward_one_step_not_parallel() == "done":
+            break
+        steps += 1
+    assert steps > 10
+
+
+def test_rebuild_from_a_loaded_tree(tmp_path):
+    run("serial", 3, tmp_path)
+    engine = make_engine()
+    engine.load(str(tmp_path))
+    assert ReadyQueue(engine.root_node).ready_nodes() == engine.find_need_next_step_nodes()
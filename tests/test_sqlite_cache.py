@@ -0,0 +1,38 @@
+# coding: utf8
+import os
+import threading
+from recursive.cache import Cache, SqliteCache
+
+NAME = "OpenAIApiProxy.call"
+
+
+def test_migration_keeps_the_jsonl_entries(tmp_path):
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn)
+    for i in range(5):
+        cache.save_cache(NAME, {"i": i}, ["v{}".format(i)])
+    cache.save_cache(NAME, {"i": 0}, ["latest"])
+    SqliteCache.migrate_from_jsonl(fn)
+    sqlite_cache = SqliteCache(fn)
+    assert sqlite_cache.get_cache(NAME, {"i": 0}) == ["latest"]
+    assert sqlite_cache.get_cache(NAME, {"i": 4}) == ["v4"]
+
+
+def test_migration_runs_once_across_openers(tmp_path):
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn)
+    for i in range(50):
+        cache.save_cache(NAME, {"i": i}, ["v{}".format(i)])
+    caches = [None] * 8
+
+    def open_cache(idx):
+        caches[idx] = SqliteCache(fn)
+    threads = [threading.Thread(target=open_cache, args=(idx,)) for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expected = [["v{}".format(i)] for i in range(50)]
+    for sqlite_cache in caches:
+        assert [sqlite_cache.get_cache(NAME, {"i": i}) for i in range(50)] == expected
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
@@ -0,0 +1,151 @@
+# coding: utf8
+import json
+import pytest
+import requests
+from recursive.cache import Cache
+from recursive.memory import caches
+from recursive.llm.llm import OpenAIApiProxy
+from recursive.llm.stream import (
+    DeltaStream, StreamAborted, StreamBroken, read_anthropic_stream, read_openai_stream)
+
+MODEL = "Mock/mock-model"
+MESSAGES = [{"role": "user", "content": "write about tides"}]
+
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    cache = Cache(str(tmp_path / "llm"))
+    monkeypatch.setitem(caches, "llm", cache)
+    return cache
+
+
+def cached(cache):
+    params = {"model": "mock-model", "messages": MESSAGES, "max_tokens": 8192}
+    return cache.get(cache.make_key("OpenAIApiProxy.call", params))
+
+
+def test_stream_matches_the_plain_call(mock_provider, llm_cache):
+    mock_provider()
+    proxy = OpenAIApiProxy(verbose=False)
+    plain = proxy.call(MODEL, MESSAGES, no_cache=True)
+    deltas = []
+    result = proxy.call(MODEL, MESSAGES, stream_callback=lambda delta, text: deltas.append(delta))
+    content = result[0]["message"]["content"]
+    assert content == plain[0]["message"]["content"]
+    assert len(deltas) > 1 and "".join(deltas) == content
+    assert cached(llm_cache)[0]["message"]["content"] == content
+    # A hit is replayed as one delta
+    deltas.clear()
+    assert proxy.call(MODEL, MESSAGES, stream_callback=lambda delta, text: deltas.append(delta)) \
+        == result
+    assert deltas == [content]
+
+
+def test_aborted_stream_is_not_cached(mock_provider, llm_cache):
+    mock_provider()
+    texts = []
+
+    def on_delta(delta, text):
+        texts.append(text)
+        return len(texts) < 2
+    with pytest.raises(StreamAborted) as error:
+        OpenAIApiProxy(verbose=False).call(MODEL, MESSAGES, stream_callback=on_delta)
+    assert error.value.text == texts[-1]
+    assert cached(llm_cache) is None
+
+
+def test_delta_stream(mock_provider, llm_cache):
+    mock_provider()
+    proxy = OpenAIApiProxy(verbose=False)
+    stream = DeltaStream(lambda on_delta: proxy.call(MODEL, MESSAGES, stream_callback=on_delta))
+    text = "".join(stream)
+    assert stream.result[0]["message"]["content"] == text
+
+
+def test_delta_stream_break_aborts_the_call(mock_provider, llm_cache):
+    mock_provider(chunk_latency=0.01)
+    proxy = OpenAIApiProxy(verbose=False)
+    stream = DeltaStream(lambda on_delta: proxy.call(MODEL, MESSAGES, stream_callback=on_delta))
+    for _ in stream:
+        break
+    stream.thread.join(10)
+    assert stream.result is None and stream.error is None
+    assert cached(llm_cache) is None
+
+
+class FakeStream:
+    """
+    A streamed response of the given server sent events lines, error is raised after them
+    """
+    def __init__(self, lines, error=None):
+        self.lines = lines
+        self.error = error
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):
+        yield from self.lines
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def sse(*chunks):
+    lines = []
+    for chunk in chunks:
+        lines += ["data: {}".format(chunk if isinstance(chunk, str) else json.dumps(chunk)), ""]
+    return lines
+
+
+def openai_chunk(content):
+    return {"id": "c", "model": "m", "choices": [{"index": 0, "delta": {"content": content}}]}
+
+
+def test_openai_stream_stops_at_done():
+    response = FakeStream(sse(openai_chunk("a"), openai_chunk("b"), "[DONE]", openai_chunk("c")))
+    data = read_openai_stream(response, lambda delta, text: None)
+    assert data["choices"][0]["message"]["content"] == "ab"
+    assert response.closed
+
+
+def test_openai_stream_error_event():
+    response = FakeStream(sse(openai_chunk("a"), {"error": {"message": "overloaded"}}))
+    with pytest.raises(RuntimeError, match="overloaded"):
+        read_openai_stream(response, lambda delta, text: None)
+    assert response.closed
+
+
+def anthropic_event(event, data):
+    return ["event: " + event, "data: " + json.dumps({"type": event, **data}), ""]
+
+
+def text_delta(text):
+    return anthropic_event("content_block_delta", {"delta": {"type": "text_delta", "text": text}})
+
+
+def test_anthropic_stream():
+    lines = (anthropic_event("message_start", {"message": {"usage": {"input_tokens": 5}}}) +
+             text_delta("a") + text_delta("b") +
+             anthropic_event("message_delta", {"delta": {"stop_reason": "end_turn"},
+                                               "usage": {"output_tokens": 2}}) +
+             anthropic_event("message_stop", {}) +
+             anthropic_event("error", {"error": {"message": "after the stop"}}))
+    data = read_anthropic_stream(FakeStream(lines), lambda delta, text: None)
+    assert data["content"][0]["text"] == "ab"
+    assert data["stop_reason"] == "end_turn"
+    assert data["usage"] == {"input_tokens": 5, "output_tokens": 2}
+
+    lines = anthropic_event("error", {"error": {"message": "overloaded"}})
+    with pytest.raises(RuntimeError, match="overloaded"):
+        read_anthropic_stream(FakeStream(lines), lambda delta, text: None)
+
+
+def test_broken_stream():
+    broken = requests.exceptions.ChunkedEncodingError("connection reset")
+    # Before the first delta the error is the requests one, the retry policy retries it
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        read_openai_stream(FakeStream([], broken), lambda delta, text: None)
+    with pytest.raises(StreamBroken) as error:
+        read_openai_stream(FakeStream(sse(openai_chunk("a")), broken), lambda delta, text: None)
+    assert error.value.text == "a"
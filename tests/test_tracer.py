@@ -0,0 +1,101 @@
+# coding: utf8
+import json
+import threading
+import pytest
+from recursive.utils.tracer import Tracer, tracer
+from sim_engine import run
+
+
+def spans(tracer_, fn):
+    tracer_.export(str(fn))
+    with open(fn) as f:
+        events = json.load(f)["traceEvents"]
+    return [e for e in events if e["ph"] == "X"], [e for e in events if e["ph"] == "M"]
+
+
+def test_disabled_tracer_records_nothing(tmp_path):
+    tracer_ = Tracer()
+    with tracer_.span("a", x=1) as args:
+        tracer_.annotate(y=2)
+    assert args == {"x": 1}
+    assert tracer_.trace("b")(lambda: 3)() == 3
+    assert spans(tracer_, tmp_path / "trace.json") == ([], [])
+
+
+def test_spans_annotations_and_errors(tmp_path):
+    tracer_ = Tracer()
+    tracer_.enable()
+
+    @tracer_.trace("call", cat="llm")
+    def call():
+        tracer_.annotate(cache="hit")
+        return 1
+
+    with tracer_.span("step", cat="engine", step=3):
+        assert call() == 1
+        tracer_.annotate(actions="plan")
+    with pytest.raises(ValueError):
+        with tracer_.span("broken", obj=object()):
+            raise ValueError("x")
+    events, metadata = spans(tracer_, tmp_path / "trace.json")
+    by_name = {e["name"]: e for e in events}
+    assert [e["name"] for e in events] == ["step", "call", "broken"]
+    assert by_name["step"]["args"] == {"step": 3, "actions": "plan"}
+    assert by_name["call"]["args"] == {"cache": "hit"} and by_name["call"]["cat"] == "llm"
+    step, inner = by_name["step"], by_name["call"]
+    assert step["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= step["ts"] + step["dur"]
+    # Non JSON args are exported as strings
+    assert by_name["broken"]["args"]["error"] == "ValueError('x')"
+    assert isinstance(by_name["broken"]["args"]["obj"], str)
+    assert [m["args"]["name"] for m in metadata] == [threading.current_thread().name]
+    # Exporting clears the recorded spans
+    assert spans(tracer_, tmp_path / "trace.json") == ([], [])
+
+
+def test_threads_keep_their_own_span_stack(tmp_path):
+    tracer_ = Tracer()
+    tracer_.enable()
+
+    # Alive together, the thread idents are distinct
+    barrier = threading.Barrier(4)
+
+    def work(i):
+        with tracer_.span("outer", i=i):
+            barrier.wait()
+            with tracer_.span("inner"):
+                tracer_.annotate(i=i)
+
+    threads = [threading.Thread(target=work, args=(i,), name="worker{}".format(i))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    events, metadata = spans(tracer_, tmp_path / "trace.json")
+    names = {m["tid"]: m["args"]["name"] for m in metadata}
+    assert sorted(names.values()) == ["worker{}".format(i) for i in range(4)]
+    assert len(events) == 8
+    # The annotation of each thread went to its own inner span
+    for event in events:
+        assert names[event["tid"]] == "worker{}".format(event["args"]["i"])
+
+
+def test_engine_run_exports_its_trace(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tracer.enable()
+    try:
+        trace, _, _, _, _ = run("parallel", 0, tmp_path / "run", max_workers=4)
+    finally:
+        tracer.disable()
+    with open(tmp_path / "run" / "trace.json") as f:
+        events = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+    steps = [e for e in events if e["name"] == "engine.step"]
+    assert len(steps) > 0
+    assert len(steps) == len([e for e in events if e["name"] == "engine.checkpoint"])
+    # Every agent action gets a span and is listed in the actions of its step
+    actions = [e["name"] for e in events if e["cat"] == "agent"]
+    step_actions = [action for e in steps if "actions" in e["args"]
+                    for action in e["args"]["actions"].split(",")]
+    assert sorted(actions) == sorted(step_actions)
+    assert sorted(action for action in actions if action in ("plan", "execute")) == \
+        sorted(action for action, _ in trace)
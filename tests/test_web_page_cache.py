@@ -0,0 +1,77 @@
+# coding: utf8
+import time
+from recursive.llm.mock import MockHandler
+from recursive.executor.actions.bing_browser import WebPageHelper, NEGATIVE_TTL
+
+PAGE = "WebPageHelper.download_webpage"
+ERROR = WebPageHelper.FETCH_ERROR_CACHE_NAME
+
+
+def counts(cache, name):
+    stat = cache.get_stats().get(name, {})
+    return {key: stat.get(key, 0) for key in ("hits", "misses", "stores")}
+
+
+def test_page_fetch_counts_once(mock_provider, web_page_cache, fetches):
+    url = mock_provider() + "/page/a"
+    helper = WebPageHelper()
+    text = helper.download_webpage(url)
+    assert "Mock page a" in text
+    assert helper.download_webpage(url) == text
+    assert fetches == [url]
+    assert counts(web_page_cache, PAGE) == {"hits": 1, "misses": 1, "stores": 1}
+
+
+def test_failed_fetch_is_skipped_until_its_ttl(mock_provider, web_page_cache, fetches,
+                                               monkeypatch):
+    url = mock_provider() + "/missing"
+    helper = WebPageHelper()
+    assert helper.download_webpage(url) is None
+    assert helper.download_webpage(url) is None
+    assert fetches == [url]
+    # One miss of the page, then one hit of the failure
+    assert counts(web_page_cache, PAGE) == {"hits": 0, "misses": 1, "stores": 0}
+    assert counts(web_page_cache, ERROR) == {"hits": 1, "misses": 0, "stores": 1}
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + NEGATIVE_TTL["http_4xx"] + 1)
+    assert helper.download_webpage(url) is None
+    assert fetches == [url, url]
+
+
+def test_failed_refetch_keeps_the_page(mock_provider, web_page_cache, fetches):
+    url = mock_provider() + "/page/a"
+    helper = WebPageHelper()
+    text = helper.download_webpage(url)
+    MockHandler.settings["failure_rate"] = 1.0
+    assert helper.download_webpage(url, overwrite_cache=True) == text
+    assert len(fetches) == 2
+    # No failure is remembered, the next fetch is a hit
+    assert counts(web_page_cache, ERROR)["stores"] == 0
+    assert helper.download_webpage(url) == text
+    assert len(fetches) == 2
+
+
+def test_extraction_hit_skips_download_and_extraction(mock_provider, web_page_cache,
+                                                      fetches, extractions):
+    url = mock_provider() + "/page/a"
+    helper = WebPageHelper()
+    articles = helper.urls_to_articles([url])
+    assert "Mock page a" in articles[url]["text"]
+    assert helper.urls_to_articles([url]) == articles
+    assert len(fetches) == 1 and len(extractions) == 1
+    extract = WebPageHelper.EXTRACT_CACHE_NAME
+    assert counts(web_page_cache, extract) == {"hits": 1, "misses": 1, "stores": 1}
+    assert counts(web_page_cache, PAGE) == {"hits": 0, "misses": 1, "stores": 1}
+
+
+def test_changed_page_is_extracted_again(mock_provider, web_page_cache, fetches, extractions):
+    url = mock_provider() + "/page/a"
+    helper = WebPageHelper()
+    helper.urls_to_articles([url])
+    # The page is fetched again with another body
+    html = helper.download_webpage(url).replace("Mock page a", "Changed page a")
+    web_page_cache.save_cache(PAGE, {"url": url}, web_page_cache.put_blob(html))
+    articles = helper.urls_to_articles([url])
+    assert "Changed page a" in articles[url]["text"]
+    assert len(fetches) == 1 and len(extractions) == 2
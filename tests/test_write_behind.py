@@ -0,0 +1,88 @@
+# coding: utf8
+import os
+import sqlite3
+import subprocess
+import sys
+import pytest
+from recursive.cache import Cache, SqliteCache
+
+NAME = "OpenAIApiProxy.call"
+
+
+def save(cache, i):
+    cache.save_cache(NAME, {"i": i}, ["v{}".format(i)])
+
+
+def get(cache, i):
+    return cache.get_cache(NAME, {"i": i})
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    calls = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: calls.append(fd) or fsync(fd))
+    return calls
+
+
+def test_queued_lines_are_written_in_one_batch(tmp_path, fsyncs, monkeypatch):
+    # Nothing is written until the flush
+    monkeypatch.setattr(Cache, "flush_interval", 60)
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn, write_behind=True)
+    for i in range(20):
+        save(cache, i)
+    assert get(cache, 19) == ["v19"]
+    assert not os.path.isfile(fn) or os.path.getsize(fn) == 0
+    cache.flush()
+    assert len(fsyncs) == 1
+    with open(fn) as f:
+        assert sum(1 for _ in f) == 20
+    assert [get(Cache(fn), i) for i in range(20)] == [["v{}".format(i)] for i in range(20)]
+
+
+def test_batches_are_bounded_by_flush_size(tmp_path, fsyncs, monkeypatch):
+    monkeypatch.setattr(Cache, "flush_interval", 60)
+    monkeypatch.setattr(Cache, "flush_size", 5)
+    fn = str(tmp_path / "llm")
+    cache = Cache(fn, write_behind=True)
+    for i in range(20):
+        save(cache, i)
+    cache.flush()
+    assert 4 <= len(fsyncs) <= 5
+    assert len(Cache(fn).cache_kv) == 20
+
+
+def test_sqlite_rows_are_served_until_inserted(tmp_path, monkeypatch):
+    monkeypatch.setattr(Cache, "flush_interval", 60)
+    fn = str(tmp_path / "llm")
+    cache = SqliteCache(fn, write_behind=True)
+    for i in range(10):
+        save(cache, i)
+    assert get(cache, 3) == ["v3"]
+    assert cache.has(cache.make_key(NAME, {"i": 3}))
+    cache.flush()
+    assert cache.pending == {}
+    with sqlite3.connect(cache.db_fn) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 10
+    assert get(cache, 3) == ["v3"]
+
+
+SHUTDOWN = """
+import sys
+from recursive.cache import Cache, SqliteCache
+Cache.flush_interval = 60
+cache = (SqliteCache if sys.argv[2] == "sqlite" else Cache)(sys.argv[1], write_behind=True)
+for i in range(100):
+    cache.save_cache("OpenAIApiProxy.call", {"i": i}, ["v{}".format(i)])
+"""
+
+
+@pytest.mark.parametrize("backend", [Cache, SqliteCache])
+def test_queue_is_flushed_at_exit(tmp_path, backend):
+    fn = str(tmp_path / "llm")
+    name = "sqlite" if backend is SqliteCache else "jsonl"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", SHUTDOWN, fn, name], check=True, cwd=root)
+    cache = backend(fn)
+    assert [get(cache, i) for i in range(100)] == [["v{}".format(i)] for i in range(100)]